@@ -29,10 +29,12 @@ from os.path import join, exists
 from random import choices
 import pwem
 import os
-from pyworkflow.utils import Environ
+from pyworkflow.plugin import VarTypes
+from pyworkflow.utils import Environ, strToBoolean
 from pyworkflow.utils import OS
 from tomosegmemtv.constants import TOMOSEGMEMTV_HOME, TOMOSEGMEMTV, TOMOSEGMEMTV_DEFAULT_VERSION, MEMBANNOTATOR, \
-    MEMBANNOTATOR_DEFAULT_VERSION, MEMBANNOTATOR_EM_DIR, TOMOSEGMEMTV_DIR, TOMOSEGMEMTV_EM_DIR, MEMBANNOTATOR_BIN
+    MEMBANNOTATOR_DEFAULT_VERSION, MEMBANNOTATOR_EM_DIR, TOMOSEGMEMTV_DIR, TOMOSEGMEMTV_EM_DIR, MEMBANNOTATOR_BIN, \
+    MCR_CACHE_ROOT, MCR_CACHE_DIR, ANNOTATOR_SESSION_VAR
 
 logger = logging.getLogger(__name__)
 
@@ -46,29 +48,41 @@ class Plugin(pwem.Plugin):
     _homeVar = TOMOSEGMEMTV_HOME
     _pathVars = [TOMOSEGMEMTV_HOME]
     _url = "https://sites.google.com/site/3demimageprocessing/tomosegmemtv"
+    _membSegEnviron = None  # Built once, see getMembSegEnviron
+    _annotatorSession = None  # Warm MembraneAnnotator, see getAnnotatorSession
 
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(TOMOSEGMEMTV_HOME, TOMOSEGMEMTV + '-' + TOMOSEGMEMTV_DEFAULT_VERSION)
+        cls._defineVar(ANNOTATOR_SESSION_VAR, '0', var_type=VarTypes.BOOLEAN,
+                       description='Keep a MembraneAnnotator session alive between tomograms if the installed binary '
+                                   'supports it (experimental). A process is launched per tomogram otherwise.')
 
     @classmethod
     def getMembSegEnviron(cls):
-        """ Setup the environment variables needed to launch pyseg. """
-        environ = Environ(os.environ)
-        runtimePath = cls.getMCRPath()
-
-        # Add required disperse path to PATH and pyto path to PYTHONPATH
-        environ.update({'LD_LIBRARY_PATH': os.pathsep.join([join(runtimePath, 'runtime', 'glnxa64'),
-                                                            join(runtimePath, 'bin', 'glnxa64'),
-                                                            join(runtimePath, 'sys', 'os', 'glnxa64'),
-                                                            join(runtimePath, 'sys', 'opengl', 'lib', 'glnxa64')])
-                        })
-        # centOS distro requires an additional environment variable.
-        if OS.isCentos():
-            logger.info("CentOS detected. Adding extra environment variable")
-            environ.update({'LD_PRELOAD': join(runtimePath, 'bin', 'glnxa64', 'glibc-2.17_shim.so')})
-
-        return environ
+        """ Setup the environment variables needed to launch pyseg. The environment is built only once, and a
+        copy of it is returned, so the callers can modify it. """
+        if cls._membSegEnviron is None:
+            environ = Environ(os.environ)
+            runtimePath = cls.getMCRPath()
+
+            # Add required disperse path to PATH and pyto path to PYTHONPATH
+            environ.update({'LD_LIBRARY_PATH': os.pathsep.join([join(runtimePath, 'runtime', 'glnxa64'),
+                                                                join(runtimePath, 'bin', 'glnxa64'),
+                                                                join(runtimePath, 'sys', 'os', 'glnxa64'),
+                                                                join(runtimePath, 'sys', 'opengl', 'lib', 'glnxa64')])
+                            })
+            # The runtime extracts the application into this cache the first time, so the next launches are faster
+            if MCR_CACHE_ROOT not in environ:
+                from pyworkflow import Config
+                environ[MCR_CACHE_ROOT] = join(Config.SCIPION_USER_DATA, MCR_CACHE_DIR)
+            # centOS distro requires an additional environment variable.
+            if OS.isCentos():
+                logger.info("CentOS detected. Adding extra environment variable")
+                environ.update({'LD_PRELOAD': join(runtimePath, 'bin', 'glnxa64', 'glibc-2.17_shim.so')})
+            cls._membSegEnviron = environ
+
+        return Environ(cls._membSegEnviron)
 
     @classmethod
     def defineBinaries(cls, env):
@@ -105,14 +119,51 @@ class Plugin(pwem.Plugin):
         """ Run membraneAnnotator command from a given protocol. """
         protocol.runJob(cls.getHome(MEMBANNOTATOR_EM_DIR, 'application', MEMBANNOTATOR_BIN), arguments, env=env, cwd=cwd)
 
+    @classmethod
+    def getAnnotatorSession(cls, cwd=None):
+        """ MembraneAnnotator session kept alive between tomograms, so the runtime is loaded only once. It is
+        restarted if a different working directory is requested. The binaries that do not support the session
+        mode are recorded in the runtime cache, so they are probed only once. """
+        if cls._annotatorSession is not None and cls._annotatorSession.cwd != cwd:
+            cls.closeAnnotatorSession()
+        if cls._annotatorSession is None:
+            from tomosegmemtv.annotation import AnnotatorSession, UNSUPPORTED_SESSION_FILE
+            environ = cls.getMembSegEnviron()
+            cls._annotatorSession = AnnotatorSession(cls.getHome(MEMBANNOTATOR_EM_DIR, 'application', MEMBANNOTATOR_BIN),
+                                                     env=environ, cwd=cwd,
+                                                     unsupportedFile=join(environ[MCR_CACHE_ROOT],
+                                                                          UNSUPPORTED_SESSION_FILE))
+        return cls._annotatorSession
+
+    @classmethod
+    def annotateTomogram(cls, protocol, arguments, cwd=None):
+        """ Annotate a tomogram in the warm MembraneAnnotator session if the session mode is enabled (see
+        ANNOTATOR_SESSION_VAR) and supported by the installed binary. A new process is launched otherwise. """
+        if strToBoolean(cls.getVar(ANNOTATOR_SESSION_VAR, '0')) and cls.getAnnotatorSession(cwd).annotate(arguments):
+            return
+        cls.runMembraneAnnotator(protocol, arguments, env=cls.getMembSegEnviron(), cwd=cwd)
+
+    @classmethod
+    def closeAnnotatorSession(cls):
+        if cls._annotatorSession is not None:
+            cls._annotatorSession.close()
+            cls._annotatorSession = None
+
     @classmethod
     def getProgram(cls, program):
         return join(cls.getHome(TOMOSEGMEMTV, 'bin', program))
 
     @classmethod
-    def runTomoSegmenTV(cls, protocol, program, args, cwd=None):
-        """ Run tomoSegmenTV command from a given protocol. """
-        protocol.runJob(cls.getProgram(program), args, cwd=cwd)
+    def runTomoSegmenTV(cls, protocol, program, args, cwd=None, cores=None, numaNode=None):
+        """ Run tomoSegmenTV command from a given protocol. If a list of cores is provided, the program is
+        bound to them (and to the memory of the given NUMA node) with numactl or taskset. """
+        program = cls.getProgram(program)
+        if cores:
+            from tomosegmemtv.scheduling import getPinningCmd, formatCpuList
+            logger.info('Running %s on cores %s (NUMA node %s)' % (os.path.basename(program), formatCpuList(cores),
+                                                                  'any' if numaNode is None else numaNode))
+            program, args = getPinningCmd(program, args, cores, numaNode=numaNode)
+        protocol.runJob(program, args, cwd=cwd)
 
     @classmethod
     def getMCRPath(cls):
@@ -0,0 +1,537 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Status of the membrane annotation. The annotator writes a file tsId/tsId_materials.mrc for each tomogram
+annotated, in the extra dir of the protocol. Instead of checking those files one by one each time the status is
+required, an index of the annotated tomograms is kept in memory (and in a JSON file, so it persists between
+runs), updated by a filesystem watcher: inotify when available, or a periodic scan of the mtime of the tomogram
+directories not annotated yet.
+
+The MembraneAnnotator runtime can also be kept warm between tomograms with an AnnotatorSession, and the
+annotations are kept in an AnnotationStore, keyed by the content of the annotated mask, so they are reused when
+the same mask is annotated again."""
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import os
+import queue
+import select
+import shutil
+import struct
+import subprocess
+import threading
+from os.path import join, isfile, isdir, realpath
+
+from tomosegmemtv.utils import fileLock
+
+logger = logging.getLogger(__name__)
+
+MATERIALS_SUFFIX = '_materials.mrc'
+MATERIALS_DATA_SUFFIX = '_materials.txt'  # Written by the annotator with the materials
+STATUS_INDEX_FILE = 'annotation_status.json'
+SCAN_INTERVAL = 2  # s, for the mtime-scan watcher
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Annotator session protocol: the program launched with SESSION_ARG writes READY_MSG when its runtime is loaded,
+# then reads the arguments of each tomogram to annotate from its standard input (one line each, the same arguments
+# of a single launch) and writes DONE_MSG or ERROR_MSG when the annotation window is closed. QUIT_MSG ends it
+SESSION_ARG = 'sessionMode'
+READY_MSG = 'ready'
+DONE_MSG = 'done'
+ERROR_MSG = 'error'
+QUIT_MSG = 'quit'
+SESSION_START_TIMEOUT = 120  # s, the runtime of a cold start may take a while to load
+UNSUPPORTED_SESSION_FILE = 'unsupported_annotator_sessions'  # Binaries known not to support the session mode
+
+
+STORE_VAR = 'TOMOSEGMEMTV_ANNOTATION_STORE'
+STORE_DIR = 'tomosegmemtv_annotations'  # In the Scipion user data dir if STORE_VAR is not set
+STORE_SIZE_VAR = 'TOMOSEGMEMTV_ANNOTATION_STORE_SIZE'  # Maximum size (GB) of the store
+DEFAULT_STORE_SIZE = 10  # GB
+HASHES_DIR = 'hashes'  # Cached hash of each mask, in a file per mask path
+STORE_LOCK = 'store'  # Lock (store.lock) of the updates of the store shared by several processes
+STORED_MATERIALS = 'materials.mrc'
+STORED_MATERIALS_DATA = 'materials.txt'
+HASH_CHUNK_SIZE = 2 ** 24  # 16 MB
+
+
+def getMaterialsFile(path: str, tsId: str) -> str:
+    return join(path, tsId, tsId + MATERIALS_SUFFIX)
+
+
+def getMaterialsDataFile(path: str, tsId: str) -> str:
+    return join(path, tsId, tsId + MATERIALS_DATA_SUFFIX)
+
+
+def getContentHash(fileName: str, chunkSize: int = HASH_CHUNK_SIZE) -> str:
+    """SHA-256 of the content of a file, read in chunks."""
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class AnnotationStatusIndex:
+    """Annotated tomograms of the given path. The number of tomograms annotated or pending is obtained without
+    accessing the filesystem, and the listeners added are called (from the watcher thread) with the tsId of each
+    tomogram annotated."""
+
+    def __init__(self, path: str, tsIds: list, fileName: str = None):
+        self.path = path
+        self.fileName = fileName or join(path, STATUS_INDEX_FILE)
+        self._tsIds = set(tsIds)
+        self._done = set()
+        self._dirMtimes = {}  # Of the pending tomograms, for the mtime scan
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._load()
+        self.scan()
+
+    # --------------------------- Status -----------------------------------
+    def isDone(self, tsId: str) -> bool:
+        return tsId in self._done
+
+    def getNumberDone(self) -> int:
+        return len(self._done)
+
+    def getNumberPending(self) -> int:
+        return len(self._tsIds) - len(self._done)
+
+    def getDone(self) -> list:
+        with self._lock:
+            return sorted(self._done)
+
+    def getPending(self) -> list:
+        with self._lock:
+            return sorted(self._tsIds - self._done)
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def setDone(self, *tsIds: str):
+        """Mark the given tomograms as annotated, if their materials file exists."""
+        with self._lock:
+            newDone = [tsId for tsId in tsIds if tsId in self._tsIds and tsId not in self._done and
+                       isfile(getMaterialsFile(self.path, tsId))]
+            if not newDone:
+                return
+            self._done.update(newDone)
+            for tsId in newDone:
+                self._dirMtimes.pop(tsId, None)
+            self._save()
+        for tsId in newDone:
+            for listener in self._listeners:
+                listener(tsId)
+
+    # --------------------------- Updates -----------------------------------
+    def scan(self):
+        """Check the pending tomograms whose directory has been modified since the last scan."""
+        modified = []
+        for tsId in self.getPending():
+            try:
+                mtime = os.stat(join(self.path, tsId)).st_mtime_ns
+            except OSError:
+                continue
+            if self._dirMtimes.get(tsId) != mtime:
+                self._dirMtimes[tsId] = mtime
+                modified.append(tsId)
+        self.setDone(*modified)
+
+    def update(self):
+        """Bring the index up to date. Nothing has to be done while a watcher is running."""
+        if self._watcher is None:
+            self.scan()
+
+    def startWatching(self, scanInterval: float = SCAN_INTERVAL):
+        if self._watcher is None:
+            try:
+                self._watcher = InotifyWatcher(self)
+            except OSError as e:
+                logger.info('inotify not available (%s), the annotation status will be updated every %s s'
+                            % (e, scanInterval))
+                self._watcher = ScanWatcher(self, scanInterval)
+            self._watcher.start()
+
+    def stopWatching(self):
+        """Stop the watcher, after a last scan so no event is lost."""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        self.scan()
+
+    # --------------------------- Index file -----------------------------------
+    def _load(self):
+        try:
+            with open(self.fileName) as f:
+                done = json.load(f)['done']
+        except (OSError, ValueError, KeyError):
+            return
+        # The annotations removed since the index was written are pending again
+        self._done = {tsId for tsId in done if tsId in self._tsIds and isfile(getMaterialsFile(self.path, tsId))}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.fileName) or '.', exist_ok=True)
+        tmpFileName = '%s.tmp%i' % (self.fileName, threading.get_ident())
+        with open(tmpFileName, 'w') as f:
+            json.dump({'done': sorted(self._done)}, f, indent=2)
+        os.replace(tmpFileName, self.fileName)
+
+
+class ScanWatcher:
+    """Scan the index periodically."""
+
+    def __init__(self, index: AnnotationStatusIndex, interval: float = SCAN_INTERVAL):
+        self.index = index
+        self.interval = interval
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            self.index.scan()
+
+
+class InotifyWatcher(ScanWatcher):
+    """Watch the directory of each pending tomogram with inotify (called through ctypes, Linux only). The
+    directories created later are watched as soon as they appear. OSError is raised if inotify is not available
+    or the limit of watches of the user is reached."""
+
+    def __init__(self, index: AnnotationStatusIndex, interval: float = 0.5):
+        super().__init__(index, interval)
+        libcName = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libcName, use_errno=True) if libcName else None
+        if libc is None or not hasattr(libc, 'inotify_init'):
+            raise OSError('inotify not supported')
+        self._libc = libc
+        self._fd = self._check(libc.inotify_init())
+        self._wds = {}  # Watch descriptor: tsId (None for the root dir)
+        try:
+            self._addWatch(index.path, IN_CREATE | IN_MOVED_TO, None)
+            for tsId in index.getPending():
+                if isdir(join(index.path, tsId)):
+                    self._addWatch(join(index.path, tsId), IN_CLOSE_WRITE | IN_MOVED_TO, tsId)
+        except OSError:
+            os.close(self._fd)
+            raise
+        # Files written before the directories were watched
+        index.scan()
+
+    @staticmethod
+    def _check(result: int) -> int:
+        if result < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    def _addWatch(self, path: str, mask: int, tsId):
+        wd = self._check(self._libc.inotify_add_watch(self._fd, os.fsencode(path), ctypes.c_uint32(mask)))
+        self._wds[wd] = tsId
+
+    def stop(self):
+        super().stop()
+        os.close(self._fd)
+
+    def _run(self):
+        pending = b''
+        while not self._stopEvent.is_set():
+            ready, _, _ = select.select([self._fd], [], [], self.interval)
+            if not ready:
+                continue
+            pending += os.read(self._fd, 65536)
+            while len(pending) >= IN_EVENT_HEADER.size:
+                wd, mask, _, nameLen = IN_EVENT_HEADER.unpack_from(pending)
+                end = IN_EVENT_HEADER.size + nameLen
+                if len(pending) < end:
+                    break
+                name = os.fsdecode(pending[IN_EVENT_HEADER.size:end].rstrip(b'\0'))
+                pending = pending[end:]
+                self._onEvent(wd, mask, name)
+
+    def _onEvent(self, wd: int, mask: int, name: str):
+        if wd not in self._wds:
+            return
+        tsId = self._wds[wd]
+        if tsId is None:
+            # New directory in the root one
+            if mask & IN_ISDIR and name in self.index._tsIds and not self.index.isDone(name):
+                try:
+                    self._addWatch(join(self.index.path, name), IN_CLOSE_WRITE | IN_MOVED_TO, name)
+                except OSError as e:
+                    logger.warning('Unable to watch the directory of %s: %s' % (name, e))
+                self.index.setDone(name)
+        elif name == tsId + MATERIALS_SUFFIX:
+            self.index.setDone(tsId)
+
+
+class AnnotatorSession:
+    """Long-lived annotator process, so the runtime startup is paid only once. If the program does not support
+    the session mode (it exits or does not answer READY_MSG in time), isSupported returns False and the callers
+    have to launch a process per tomogram. If an unsupportedFile is given, the binaries found not to support it
+    are recorded there, so they are not probed again."""
+
+    def __init__(self, program: str, env=None, cwd=None, startTimeout: float = SESSION_START_TIMEOUT,
+                 unsupportedFile: str = None):
+        self.program = program
+        self.env = env
+        self.cwd = cwd
+        self.startTimeout = startTimeout
+        self.unsupportedFile = unsupportedFile
+        self._proc = None
+        self._lines = queue.Queue()
+        self._supported = False if self._isKnownUnsupported() else None  # Unknown until the first start
+        self._lock = threading.Lock()  # One tomogram at a time
+
+    def _getProgramKey(self) -> str:
+        """Identifier of the installed binary, which changes if it is updated."""
+        st = os.stat(self.program)
+        return '%s %i %i' % (os.path.realpath(self.program), st.st_size, st.st_mtime_ns)
+
+    def _isKnownUnsupported(self) -> bool:
+        try:
+            with open(self.unsupportedFile) as f:
+                return self._getProgramKey() in f.read().splitlines()
+        except (OSError, TypeError):  # No file given or not written yet, or no binary
+            return False
+
+    def _recordUnsupported(self):
+        if self.unsupportedFile:
+            try:
+                os.makedirs(os.path.dirname(self.unsupportedFile), exist_ok=True)
+                with open(self.unsupportedFile, 'a') as f:
+                    f.write(self._getProgramKey() + '\n')
+            except OSError as e:
+                logger.info('Unable to record the annotator session as unsupported: %s' % e)
+
+    def isSupported(self) -> bool:
+        with self._lock:
+            return self._start()
+
+    def _start(self) -> bool:
+        if self._supported is False or (self._proc is not None and self._proc.poll() is None):
+            return bool(self._supported)
+        try:
+            self._proc = subprocess.Popen([self.program, SESSION_ARG], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          text=True, env=self.env, cwd=self.cwd)
+        except OSError as e:
+            logger.info('Unable to start an annotator session: %s' % e)
+            self._supported = False
+            return False
+        self._lines = queue.Queue()
+        threading.Thread(target=self._readLines, args=(self._proc, self._lines), daemon=True).start()
+        self._supported = self._getMessage(self.startTimeout) == READY_MSG
+        if not self._supported:
+            logger.info('%s does not support the session mode, a process will be launched per tomogram'
+                        % os.path.basename(self.program))
+            self._kill()
+            self._recordUnsupported()
+        return self._supported
+
+    @staticmethod
+    def _readLines(proc, lines: queue.Queue):
+        for line in proc.stdout:
+            lines.put(line.strip())
+        lines.put(None)  # End of the process
+
+    def _getMessage(self, timeout=None):
+        """Next message of the protocol, skipping the rest of the output of the program. None if the process
+        ends or the timeout expires."""
+        while True:
+            try:
+                line = self._lines.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if line is None or line in (READY_MSG, DONE_MSG, ERROR_MSG):
+                return line
+            logger.info(line)
+
+    def annotate(self, arguments: str) -> bool:
+        """Annotate a tomogram in the running session, waiting until the user finishes. False if it could not
+        be done in the session, so the caller falls back to a process launch."""
+        with self._lock:
+            if not self._start():
+                return False
+            try:
+                self._proc.stdin.write(arguments.replace('\n', ' ') + '\n')
+                self._proc.stdin.flush()
+            except OSError:
+                self._kill()
+                return False
+            message = self._getMessage()
+            if message is None:
+                # The session died, a new one will be started for the next tomogram
+                self._kill()
+                return False
+            if message == ERROR_MSG:
+                raise RuntimeError('The annotator failed with the arguments %s' % arguments)
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                try:
+                    self._proc.stdin.write(QUIT_MSG + '\n')
+                    self._proc.stdin.close()
+                    self._proc.wait(timeout=10)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self._kill()
+
+    def _kill(self):
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+
+class AnnotationStore:
+    """Annotations (materials volume and data file) keyed by the SHA-256 of the mask annotated, stored in
+    hash[:2]/hash/. The hashes of the masks are cached by path, size and mtime (a small file per path, so
+    looking one up does not depend on the size of the cache), so the unchanged masks are read only once. When the
+    store exceeds its maximum size, the least recently used annotations are removed."""
+
+    def __init__(self, path: str = None, maxSize: float = None):
+        if path is None:
+            path = os.environ.get(STORE_VAR)
+        if not path:
+            from pyworkflow import Config
+            path = join(Config.SCIPION_USER_DATA, STORE_DIR)
+        self.path = path
+        self.maxSize = (maxSize if maxSize is not None else
+                        float(os.environ.get(STORE_SIZE_VAR, DEFAULT_STORE_SIZE)) * 2 ** 30)
+        self._lockFile = join(path, STORE_LOCK)
+
+    def _getHashFile(self, fileName: str) -> str:
+        pathHash = hashlib.sha1(fileName.encode()).hexdigest()
+        return join(self.path, HASHES_DIR, pathHash[:2], pathHash + '.json')
+
+    def getHash(self, fileName: str) -> str:
+        fileName = realpath(fileName)
+        st = os.stat(fileName)
+        key = [fileName, st.st_size, st.st_mtime_ns]
+        hashFile = self._getHashFile(fileName)
+        try:
+            with open(hashFile) as f:
+                cached = json.load(f)
+            if cached[:3] == key:
+                return cached[3]
+        except (OSError, ValueError, TypeError):
+            pass
+        contentHash = getContentHash(fileName)
+        with fileLock(self._lockFile):
+            os.makedirs(os.path.dirname(hashFile), exist_ok=True)
+            tmpFileName = '%s.tmp%i' % (hashFile, os.getpid())
+            with open(tmpFileName, 'w') as f:
+                json.dump(key + [contentHash], f)
+            os.replace(tmpFileName, hashFile)
+        return contentHash
+
+    def _getEntryDir(self, contentHash: str) -> str:
+        return join(self.path, contentHash[:2], contentHash)
+
+    def get(self, maskFile: str, path: str, tsId: str) -> bool:
+        """Copy the stored annotation of the given mask, if any, as the annotation of tsId in path. The files are
+        copied (not linked), so the stored ones are not modified if the tomogram is annotated again, keeping their
+        mtime, so they are not stored again (see put)."""
+        entryDir = self._getEntryDir(self.getHash(maskFile))
+        if not isfile(join(entryDir, STORED_MATERIALS)):
+            return False
+        try:
+            os.utime(entryDir)  # Last use, see _evict
+        except OSError:  # Removed by another process meanwhile
+            return False
+        os.makedirs(join(path, tsId), exist_ok=True)
+        if isfile(join(entryDir, STORED_MATERIALS_DATA)):
+            shutil.copy2(join(entryDir, STORED_MATERIALS_DATA), getMaterialsDataFile(path, tsId))
+        # The materials file is the last one, as its presence marks the tomogram as annotated
+        tmpFile = getMaterialsFile(path, tsId) + '.tmp'
+        shutil.copy2(join(entryDir, STORED_MATERIALS), tmpFile)
+        os.replace(tmpFile, getMaterialsFile(path, tsId))
+        return True
+
+    def put(self, maskFile: str, path: str, tsId: str):
+        """Store the annotation of tsId in path as the one of the given mask, replacing the one already stored
+        for the same mask unless it is not older. Return True if it is stored."""
+        entryDir = self._getEntryDir(self.getHash(maskFile))
+        storedFile = join(entryDir, STORED_MATERIALS)
+        if isfile(storedFile) and os.path.getmtime(getMaterialsFile(path, tsId)) <= os.path.getmtime(storedFile):
+            return False
+        tmpDir = '%s.tmp%i' % (entryDir, os.getpid())
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.makedirs(tmpDir)
+        shutil.copy2(getMaterialsFile(path, tsId), join(tmpDir, STORED_MATERIALS))
+        if isfile(getMaterialsDataFile(path, tsId)):
+            shutil.copy2(getMaterialsDataFile(path, tsId), join(tmpDir, STORED_MATERIALS_DATA))
+        with fileLock(self._lockFile):
+            oldDir = tmpDir + '.old'
+            if isdir(entryDir):
+                os.replace(entryDir, oldDir)
+            os.replace(tmpDir, entryDir)
+            shutil.rmtree(oldDir, ignore_errors=True)
+            self._evict(keep=entryDir)
+        return True
+
+    def _getEntries(self) -> list:
+        """Directory, size (bytes) and last use of each stored annotation."""
+        entries = []
+        for prefixDir in os.scandir(self.path):
+            if not prefixDir.is_dir() or len(prefixDir.name) != 2:  # Not the hash prefix dirs (e.g. HASHES_DIR)
+                continue
+            for entry in os.scandir(prefixDir.path):
+                if entry.is_dir() and '.' not in entry.name:  # Not the ones being written
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                    entries.append((entry.path, size, entry.stat().st_mtime))
+        return entries
+
+    def _evict(self, keep: str = None):
+        """Remove the least recently used annotations, except the given one, until the store fits in its maximum
+        size."""
+        entries = sorted(self._getEntries(), key=lambda entry: entry[2])
+        totalSize = sum(size for _, size, _ in entries)
+        for entryDir, size, _ in entries:
+            if totalSize <= self.maxSize:
+                break
+            if entryDir == keep:
+                continue
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
@@ -0,0 +1,199 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Headless batch segmentation of a directory of MRC files with TomoSegMemTV, without a Scipion project.
+
+Example:
+
+    tomosegmemtv-batch /data/tomos /data/segmentations --jobs 4 --threads 8 --mbThkPix 3 --mbScaleFactor 12
+
+Each tomogram is processed by a worker of a process pool with its own thread budget for the TomoSegMemTV
+programs. The whole chain is run by tomosegmemtv.pipeline.segmentTomogram, as in the protocol, including the
+membrane thickness estimation, the automatic surfaceness threshold and the early abort of the empty tomograms.
+A manifest (JSON) with the outputs, status and timings of each tomogram and stage is written into the output
+directory.
+"""
+import argparse
+import glob
+import json
+import logging
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import makedirs, remove
+from os.path import join, basename, abspath, exists, samefile
+
+from tomosegmemtv import pipeline
+from tomosegmemtv.constants import FLT, MRC, SUFFiXES_2_REMOVE, MB_STRENGTH_TH_MANUAL, MB_STRENGTH_TH_OTSU, \
+    MB_STRENGTH_TH_PERCENTILE
+from tomosegmemtv.utils import binVolume, mrcfile
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+MB_STRENGTH_TH_MODES = {'manual': MB_STRENGTH_TH_MANUAL, 'otsu': MB_STRENGTH_TH_OTSU,
+                        'percentile': MB_STRENGTH_TH_PERCENTILE}
+
+
+def processTomogram(tomoFile: str, outDir: str, params: dict, nThreads: int, keepAllFiles: bool = False,
+                    binning: int = 1) -> dict:
+    """Run the TomoSegMemTV chain on a tomogram (see tomosegmemtv.pipeline.segmentTomogram), binned by the given
+    factor and upsampled back to its size at the end as in the protocol. Intermediate and output files are named
+    as in the protocol. Returns the manifest entry of the tomogram."""
+    tsId = basename(tomoFile).rsplit('.', 1)[0]
+    outFile = lambda suffix: join(outDir, tsId + suffix + MRC)
+    entry = {'tsId': tsId, 'input': abspath(tomoFile), 'output': abspath(outFile(FLT)), 'threads': nThreads,
+             'binning': binning, 'status': 'done', 'error': None, 'stages': {}}
+    tStart = time.time()
+    stageName = None
+    with open(join(outDir, tsId + '.log'), 'w') as log:
+
+        def runStage(stage, *args, **kwargs):
+            nonlocal stageName
+            stageName = stage.__name__
+            nRuns = sum(name.split('_')[0] == stageName for name in entry['stages'])
+            if nRuns:
+                stageName += '_%i' % (nRuns + 1)
+            logger.info(f'{tsId}: running {stageName}...')
+            t0 = time.time()
+            try:
+                return stage(*args, nThreads=nThreads,
+                             runner=lambda program, args: pipeline.runProgram(program, args, stdout=log), **kwargs)
+            finally:
+                entry['stages'][stageName] = round(time.time() - t0, 3)
+
+        inFile = tomoFile
+        try:
+            if binning > 1:
+                # Named as the input, so are the outputs
+                inFile = outFile('')
+                stageName = 'binning'
+                binVolume(tomoFile, inFile, binning)
+            results = pipeline.segmentTomogram(inFile, outDir, params, nThreads=nThreads, runStage=runStage)
+            if binning > 1:
+                stageName = 'upsampling'
+                with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+                    shape = mrc.data.shape
+                    voxelSize = float(mrc.voxel_size.x)
+                pipeline.resize(results['output'], shape, order=1, outFile=results['output'],
+                                scale=binning, voxelSize=voxelSize or None)
+            entry.update(mbThkPix=int(results['mbThkPix']),
+                         surfTh=None if results['surfTh'] is None else float(results['surfTh']),
+                         isEmpty=bool(results['isEmpty']),
+                         surfFraction=float(results['surfStats'].nonZeroFraction))
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            entry['status'] = 'failed'
+            entry['error'] = f'{stageName}: {e}'
+            logger.error(f'{tsId}: {stageName} failed: {e}')
+    entry['totalTime'] = round(time.time() - tStart, 3)
+
+    if not keepAllFiles:
+        for suffix in SUFFiXES_2_REMOVE + ([''] if binning > 1 else []):
+            if exists(outFile(suffix)):
+                remove(outFile(suffix))
+    return entry
+
+
+def _getParser():
+    parser = argparse.ArgumentParser(prog='tomosegmemtv-batch',
+                                     description='Segment the membranes of a directory of tomograms (MRC) with '
+                                                 'TomoSegMemTV, without a Scipion project.')
+    parser.add_argument('inDir', help='Directory containing the tomograms.')
+    parser.add_argument('outDir', help='Directory where the results will be written.')
+    parser.add_argument('--pattern', default='*.mrc', help='Pattern of the tomograms in inDir (default: %(default)s).')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of tomograms processed at the same time.')
+    parser.add_argument('--threads', type=int, default=4, help='Threads used by each TomoSegMemTV program call.')
+    parser.add_argument('--binning', type=int, default=1,
+                        help='Binning factor applied to the tomograms before the segmentation. The segmentations are '
+                             'upsampled to the size of the tomograms.')
+    parser.add_argument('--mbThkPix', type=int, default=1, help='Membrane thickness (voxels).')
+    parser.add_argument('--mbThkCandidates', default=None,
+                        help='Estimate the membrane thickness of each tomogram among these candidates (voxels), e.g. '
+                             '"1-8" or "2 4 6", instead of using --mbThkPix.')
+    parser.add_argument('--mbScaleFactor', type=int, default=10, help='Membrane scale factor (voxels).')
+    parser.add_argument('--whiteOverBlack', action='store_true', help='The membranes are white over black.')
+    parser.add_argument('--mbStrengthThMode', choices=list(MB_STRENGTH_TH_MODES), default='manual',
+                        help='manual: use --mbStrengthTh. otsu, percentile: threshold the surfaceness map of each '
+                             'tomogram with the value determined from its histogram (default: %(default)s).')
+    parser.add_argument('--mbStrengthTh', type=float, default=0.3, help='Membrane-strength threshold.')
+    parser.add_argument('--mbStrengthPercentile', type=float, default=90,
+                        help='Percentile of the surfaceness map used as threshold in the percentile mode.')
+    parser.add_argument('--minMembFraction', type=float, default=1e-4,
+                        help='Minimum fraction of non-zero voxels of the surfaceness map. Under it, the remaining '
+                             'stages are skipped and an empty mask is generated.')
+    parser.add_argument('--sigmaS', type=float, default=1, help='Sigma for the initial gaussian filtering.')
+    parser.add_argument('--sigmaP', type=float, default=0, help='Sigma for the post-processing gaussian filtering.')
+    parser.add_argument('--keepAllFiles', action='store_true', help='Keep the intermediate files.')
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = _getParser().parse_args(argv)
+    pipeline.registerPlugin()
+    from pyworkflow.utils import getListFromRangeString
+    params = {'mbThkPix': args.mbThkPix,
+              'mbThkCandidates': getListFromRangeString(args.mbThkCandidates) if args.mbThkCandidates else None,
+              'mbScaleFactor': args.mbScaleFactor,
+              'blackOverWhite': not args.whiteOverBlack,
+              'mbStrengthThMode': MB_STRENGTH_TH_MODES[args.mbStrengthThMode],
+              'mbStrengthTh': args.mbStrengthTh,
+              'mbStrengthPercentile': args.mbStrengthPercentile,
+              'minMembFraction': args.minMembFraction,
+              'sigmaS': args.sigmaS,
+              'sigmaP': args.sigmaP}
+    tomoFiles = sorted(glob.glob(join(args.inDir, args.pattern)))
+    if not tomoFiles:
+        logger.error(f'No tomograms matching {args.pattern} found in {args.inDir}')
+        return 1
+    makedirs(args.outDir, exist_ok=True)
+    if args.binning > 1 and samefile(args.inDir, args.outDir):
+        logger.error('The binned tomograms would replace the input ones: use another output directory')
+        return 1
+
+    manifest = {'params': params, 'binning': args.binning, 'jobs': args.jobs, 'threads': args.threads,
+                'tomograms': []}
+    tStart = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=pipeline.registerPlugin) as executor:
+        futures = [executor.submit(processTomogram, tomoFile, args.outDir, params, args.threads, args.keepAllFiles,
+                                   args.binning)
+                   for tomoFile in tomoFiles]
+        for future in as_completed(futures):
+            entry = future.result()
+            logger.info(f'{entry["tsId"]}: {entry["status"]} in {entry["totalTime"]} s')
+            manifest['tomograms'].append(entry)
+    manifest['totalTime'] = round(time.time() - tStart, 3)
+    manifest['tomograms'].sort(key=lambda entry: entry['tsId'])
+
+    with open(join(args.outDir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    nFailed = sum(entry['status'] != 'done' for entry in manifest['tomograms'])
+    logger.info(f'{len(tomoFiles) - nFailed} / {len(tomoFiles)} tomograms segmented. Manifest written to '
+                f'{join(args.outDir, MANIFEST)}')
+    return 1 if nFailed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -36,3 +36,38 @@ MEMBANNOTATOR = 'membraneAnnotator'
 MEMBANNOTATOR_BIN = 'MembraneAnnotator'
 MEMBANNOTATOR_DEFAULT_VERSION = '2.0.3'
 MEMBANNOTATOR_EM_DIR = MEMBANNOTATOR + '-' + MEMBANNOTATOR_DEFAULT_VERSION
+
+# TomoSegmemTV programs
+SCALE_SPACE = 'scale_space'
+DT_VOTING = 'dtvoting'
+SURFACENESS = 'surfaceness'
+
+# Generated files suffixes
+S2 = '_s2'
+TV = '_tv'
+SURF = '_surf'
+TV2 = '_tv2'
+FLT = '_flt'
+SUFFiXES_2_REMOVE = [S2, TV, SURF, TV2]
+RESULTS_SUFFIX = '_results.json'  # Values computed for each tomogram (e.g. thresholds), read when creating the output
+
+MRC = '.mrc'
+
+# Membrane-strength threshold modes
+MB_STRENGTH_TH_MANUAL = 0
+MB_STRENGTH_TH_OTSU = 1
+MB_STRENGTH_TH_PERCENTILE = 2
+# Membrane-strength threshold used in the first surfaceness round when it is automatically determined, so the
+# surfaceness map contains the distribution of (almost) all the candidate voxels
+PROBE_MB_STRENGTH_TH = 1e-4
+
+# MembraneAnnotator runtime
+MCR_CACHE_ROOT = 'MCR_CACHE_ROOT'
+MCR_CACHE_DIR = 'tomosegmemtv_mcr_cache'  # In the Scipion user data dir, so it is kept between launches
+# Plugin variable: set to 1 to keep a MembraneAnnotator session alive between tomograms if the installed binary
+# supports it. By default, a process is launched per tomogram
+ANNOTATOR_SESSION_VAR = 'TOMOSEGMEMTV_ANNOTATOR_SESSION'
+
+# Threshold modes of the membrane labelling
+LABEL_TH_MANUAL = 0
+LABEL_TH_OTSU = 1
@@ -0,0 +1,189 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Executors that run the whole chain of each tomogram (see tomosegmemtv.pipeline.segmentTomogram) in-process,
+in local worker processes or in remote workers through ssh. All of them return a concurrent.futures.Future
+whose result is a TaskResult with the name of the worker and the time it took, so the throughput of each node
+can be reported. The remote workers must see the project directory at the same path (shared filesystem) and
+have the plugin installed in the same Python environment.
+"""
+import os
+import pickle
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+WORKER_VAR = 'TOMOSEGMEMTV_WORKER'  # Name of the worker, set by the executors
+
+# Executors
+LOCAL = 0
+LOCAL_PROCESSES = 1
+SSH = 2
+EXECUTOR_NAMES = ['Local', 'Local processes', 'SSH']
+
+
+def getWorkerName() -> str:
+    return os.environ.get(WORKER_VAR) or '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+class TaskResult:
+    """Value returned by a task, with the worker that ran it and how long it took (s)."""
+
+    def __init__(self, value, worker: str, elapsed: float):
+        self.value = value
+        self.worker = worker
+        self.elapsed = elapsed
+
+
+def runTask(func, *args, **kwargs) -> TaskResult:
+    t0 = time.time()
+    value = func(*args, **kwargs)
+    return TaskResult(value, getWorkerName(), time.time() - t0)
+
+
+def _initWorker():
+    from tomosegmemtv.pipeline import registerPlugin
+    registerPlugin()
+
+
+class Executor:
+    """Run tasks (picklable functions with their arguments) and return futures of TaskResults."""
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class LocalExecutor(Executor):
+    """Run the tasks in the calling thread."""
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(runTask(func, *args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class ProcessExecutor(Executor):
+    """Run the tasks in a pool of local worker processes."""
+
+    def __init__(self, nWorkers: int):
+        self._pool = ProcessPoolExecutor(max_workers=max(1, nWorkers), initializer=_initWorker)
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        return self._pool.submit(runTask, func, *args, **kwargs)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+class SshExecutor(Executor):
+    """Run each task in a remote host through ssh. The task is pickled into a file of the shared workDir and
+    executed by 'python -m tomosegmemtv.executors' in the host, which pickles the result back. The hosts are
+    given as 'host' or 'host:slots', being slots the number of tasks run at the same time in the host."""
+
+    def __init__(self, hosts: list, workDir: str, python: str = sys.executable, sshCmd: str = 'ssh'):
+        self.workDir = workDir
+        self.python = python
+        self.sshCmd = sshCmd
+        self._freeSlots = []
+        for host in hosts:
+            host, _, slots = host.strip().partition(':')
+            self._freeSlots.extend([host] * (int(slots) if slots else 1))
+        self._condition = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self._freeSlots)))
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        return self._pool.submit(self._run, func, args, kwargs)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def _run(self, func, args, kwargs) -> TaskResult:
+        with self._condition:
+            while not self._freeSlots:
+                self._condition.wait()
+            host = self._freeSlots.pop(0)
+        taskFile = resultFile = None
+        try:
+            fd, taskFile = tempfile.mkstemp(prefix='task_', suffix='.pkl', dir=self.workDir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((func, args, kwargs), f)
+            resultFile = taskFile.replace('task_', 'result_')
+            remoteCmd = '%s=%s %s -m tomosegmemtv.executors %s %s' % (WORKER_VAR, host, shlex.quote(self.python),
+                                                                      shlex.quote(taskFile),
+                                                                      shlex.quote(resultFile))
+            subprocess.run(shlex.split(self.sshCmd) + [host, remoteCmd], check=True)
+            with open(resultFile, 'rb') as f:
+                result = pickle.load(f)
+        finally:
+            # Also if ssh or the worker failed, so the shared workDir is not filled with stale tasks
+            for fileName in (taskFile, resultFile, resultFile and resultFile + '.tmp'):
+                if fileName and os.path.exists(fileName):
+                    os.remove(fileName)
+            with self._condition:
+                self._freeSlots.append(host)
+                self._condition.notify()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+def getExecutor(executor: int, nWorkers: int = 1, hosts: list = None, workDir: str = None) -> Executor:
+    if executor == LOCAL_PROCESSES:
+        return ProcessExecutor(nWorkers)
+    if executor == SSH:
+        return SshExecutor(hosts or [], workDir or tempfile.gettempdir())
+    return LocalExecutor()
+
+
+def main(taskFile: str, resultFile: str):
+    """Entry point of the remote workers: run the pickled task and pickle its TaskResult or exception."""
+    _initWorker()
+    with open(taskFile, 'rb') as f:
+        func, args, kwargs = pickle.load(f)
+    try:
+        result = runTask(func, *args, **kwargs)
+    except Exception as e:
+        result = e
+    tmpFile = resultFile + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        pickle.dump(result, f)
+    os.replace(tmpFile, resultFile)
+
+
+if __name__ == '__main__':
+    # Run from the imported module, so the results are pickled as tomosegmemtv.executors objects
+    from tomosegmemtv.executors import main as workerMain
+    workerMain(sys.argv[1], sys.argv[2])
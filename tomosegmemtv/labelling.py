@@ -0,0 +1,327 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Automatic separation of the membranes of a saliency map (_flt.mrc) as its connected components. The volume is
+memory-mapped and thresholded in Z slabs, and the components of each slab are labelled independently, with
+provisional labels that are unique in the whole volume, written into a temporary memory-mapped file. The
+components that touch across the border of two consecutive slabs are merged with a union-find structure, and a
+second pass writes the final labels (the components with at least the given size, sorted by decreasing size) into
+a uint16 volume, the same layout of the _materials.mrc files written by the annotator. Only a slab is kept in
+memory at a time.
+
+The label volumes get a sparse index (LabelIndex) in a sidecar .npz file, with the bounding box, the number of
+voxels and the coordinates of each label, so a single membrane can be extracted, counted or cropped without
+reading the whole volume. The coordinates of each label are stored as the differences between the consecutive
+linear indices of its voxels inside its bounding box, which are small and compress very well."""
+import logging
+import os
+from os.path import exists, getmtime, realpath
+
+import numpy as np
+
+from tomosegmemtv.utils import SLAB_SIZE, iterSlabs, mrcfile, getNearestIndices
+
+logger = logging.getLogger(__name__)
+
+# Neighbourhood of the voxels: 1 --> faces (6), 2 --> faces and edges (18), 3 --> faces, edges and corners (26)
+DEFAULT_CONNECTIVITY = 3
+DEFAULT_MIN_SIZE = 1000  # Voxels
+MAX_LABELS = np.iinfo(np.uint16).max
+LABELS_TMP_SUFFIX = '_labels_tmp.npy'
+INDEX_SUFFIX = '_index.npz'
+
+
+class UnionFind:
+    """Disjoint sets of the integers [0, n), with path halving. The array of parents grows on demand."""
+
+    def __init__(self, n: int = 0):
+        self._parent = np.arange(max(n, 1), dtype=np.int64)
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def extend(self, n: int):
+        """Add n singleton sets."""
+        newN = self._n + n
+        if newN > len(self._parent):
+            parent = np.arange(max(newN, 2 * len(self._parent)), dtype=np.int64)
+            parent[:self._n] = self._parent[:self._n]
+            self._parent = parent
+        self._n = newN
+
+    def find(self, a: int) -> int:
+        parent = self._parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return int(a)
+
+    def union(self, a: int, b: int):
+        rootA, rootB = self.find(a), self.find(b)
+        if rootA != rootB:
+            # The smallest one is kept as root, so the roots do not depend on the order of the unions
+            self._parent[max(rootA, rootB)] = min(rootA, rootB)
+
+    def getRoots(self) -> np.ndarray:
+        """Root of each element, computed for all of them at once by pointer jumping."""
+        roots = self._parent[:self._n].copy()
+        while True:
+            nextRoots = roots[roots]
+            if np.array_equal(nextRoots, roots):
+                return roots
+            roots = nextRoots
+
+
+def getBorderOffsets(connectivity: int = DEFAULT_CONNECTIVITY):
+    """(dy, dx) offsets of the neighbours in the next slice of a voxel for the given connectivity."""
+    return [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if 1 + abs(dy) + abs(dx) <= connectivity]
+
+
+def getBorderPairs(prevSlice: np.ndarray, nextSlice: np.ndarray, connectivity: int = DEFAULT_CONNECTIVITY):
+    """Unique pairs of labels of two consecutive slices that are neighbours."""
+    ny, nx = prevSlice.shape
+    pairs = []
+    for dy, dx in getBorderOffsets(connectivity):
+        prevLabels = prevSlice[max(0, -dy):ny - max(0, dy), max(0, -dx):nx - max(0, dx)]
+        nextLabels = nextSlice[max(0, dy):ny - max(0, -dy), max(0, dx):nx - max(0, -dx)]
+        touching = (prevLabels > 0) & (nextLabels > 0)
+        pairs.append(np.stack([prevLabels[touching], nextLabels[touching]], axis=1))
+    pairs = np.concatenate(pairs)
+    return np.unique(pairs, axis=0) if len(pairs) else pairs
+
+
+def labelComponents(fileName: str, outFileName: str, threshold: float, minSize: int = DEFAULT_MIN_SIZE,
+                    connectivity: int = DEFAULT_CONNECTIVITY, slabSize: int = SLAB_SIZE) -> np.ndarray:
+    """Label the connected components of the voxels of an MRC file with values greater than the threshold. The
+    components with less than minSize voxels are discarded, and the rest are labelled from 1 in decreasing order of
+    size (only the MAX_LABELS largest ones fit into the uint16 output). The labels are written into outFileName and
+    the sizes of the labelled components are returned (the size of the label i is the element i - 1)."""
+    from scipy.ndimage import label, generate_binary_structure
+    structure = generate_binary_structure(3, connectivity)
+    tmpFile = os.path.splitext(outFileName)[0] + LABELS_TMP_SUFFIX
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as inMrc:
+        data = inMrc.data
+        voxelSize = inMrc.voxel_size
+        provLabels = np.lib.format.open_memmap(tmpFile, mode='w+', dtype=np.uint32, shape=data.shape)
+        try:
+            # First pass: provisional labels of each slab, sizes and merges across the slab borders
+            unionFind = UnionFind(1)  # 0 is the background
+            sizes = [np.zeros(1, dtype=np.int64)]
+            prevSlice = None
+            for z0, slab in iterSlabs(data, slabSize):
+                slabLabels, nSlabLabels = label(slab > threshold, structure=structure)
+                slabLabels = slabLabels.astype(np.uint32)
+                if nSlabLabels:
+                    slabLabels[slabLabels > 0] += len(unionFind) - 1
+                    sizes.append(np.bincount(slabLabels.ravel(), minlength=len(unionFind) + nSlabLabels)[
+                                 len(unionFind):])
+                    unionFind.extend(nSlabLabels)
+                if prevSlice is not None:
+                    for prevLabel, nextLabel in getBorderPairs(prevSlice, slabLabels[0], connectivity):
+                        unionFind.union(int(prevLabel), int(nextLabel))
+                provLabels[z0:z0 + slabSize] = slabLabels
+                prevSlice = slabLabels[-1]
+            provLabels.flush()
+
+            # Sizes of the merged components and lookup table from the provisional labels to the final ones
+            roots = unionFind.getRoots()
+            compSizes = np.bincount(roots, weights=np.concatenate(sizes), minlength=len(roots)).astype(np.int64)
+            compSizes[0] = 0
+            kept = np.flatnonzero(compSizes >= max(minSize, 1))
+            kept = kept[np.argsort(-compSizes[kept], kind='stable')]
+            if len(kept) > MAX_LABELS:
+                logger.warning('%i components found in %s, only the %i largest ones are labelled' %
+                               (len(kept), fileName, MAX_LABELS))
+                kept = kept[:MAX_LABELS]
+            rootLut = np.zeros(len(roots), dtype=np.uint16)
+            rootLut[kept] = np.arange(1, len(kept) + 1)
+            lut = rootLut[roots]
+
+            # Second pass: final labels
+            with mrcfile.new_mmap(outFileName, data.shape, mrc_mode=6, overwrite=True) as outMrc:
+                for z0, slab in iterSlabs(provLabels, slabSize):
+                    outMrc.data[z0:z0 + slabSize] = lut[slab]
+                outMrc.voxel_size = voxelSize
+                outMrc.update_header_stats()
+        finally:
+            del provLabels
+            os.remove(tmpFile)
+    return compSizes[kept]
+
+
+def getLabelIndexFile(fileName: str) -> str:
+    return os.path.splitext(fileName)[0] + INDEX_SUFFIX
+
+
+class LabelIndex:
+    """Sparse index of the labels (non-zero values) of a label volume: for each label, its bounding box (z, y, x
+    of the first voxel and of the one after the last one), its number of voxels and its coordinates."""
+
+    def __init__(self, shape, labels: np.ndarray, counts: np.ndarray, bboxes: np.ndarray, deltas: np.ndarray):
+        self.shape = tuple(int(dim) for dim in shape)
+        self.labels = labels
+        self.counts = counts
+        self.bboxes = bboxes
+        self.deltas = deltas
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    @classmethod
+    def fromVoxels(cls, shape, voxelLabels: np.ndarray, linearInds: np.ndarray) -> 'LabelIndex':
+        """Index of the voxels with the given linear indices (C order) and labels, computed at once for all the
+        labels."""
+        order = np.lexsort((linearInds, voxelLabels))
+        voxelLabels, linearInds = voxelLabels[order], linearInds[order]
+        labels, starts, counts = np.unique(voxelLabels, return_index=True, return_counts=True)
+        if not len(labels):
+            return cls(shape, labels, counts.astype(np.int64), np.zeros((0, 6), dtype=np.int64),
+                       np.zeros(0, dtype=np.uint32))
+        coords = np.unravel_index(linearInds, shape)
+        bboxes = np.stack([np.minimum.reduceat(c, starts) for c in coords] +
+                          [np.maximum.reduceat(c, starts) + 1 for c in coords], axis=1).astype(np.int64)
+        # Linear indices inside the bounding box of each voxel's label, increasing along the voxels of a label
+        origins = np.repeat(bboxes[:, :3], counts, axis=0)
+        boxDims = np.repeat(bboxes[:, 3:] - bboxes[:, :3], counts, axis=0)
+        relInds = ((coords[0] - origins[:, 0]) * boxDims[:, 1] + coords[1] - origins[:, 1]) * boxDims[:, 2] + \
+            coords[2] - origins[:, 2]
+        deltas = relInds.copy()
+        deltas[1:] -= relInds[:-1]
+        deltas[starts] = relInds[starts]
+        deltas = deltas.astype(np.uint32 if deltas.max() <= np.iinfo(np.uint32).max else np.uint64)
+        return cls(shape, labels, counts.astype(np.int64), bboxes, deltas)
+
+    @classmethod
+    def build(cls, fileName: str, slabSize: int = SLAB_SIZE) -> 'LabelIndex':
+        """Index of an MRC file, read in Z slabs."""
+        with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+            data = mrc.data
+            sliceSize = data.shape[1] * data.shape[2]
+            voxelLabels, linearInds = [], []
+            for z0, slab in iterSlabs(data, slabSize):
+                inds = np.flatnonzero(slab)
+                voxelLabels.append(slab.ravel()[inds])
+                linearInds.append(inds.astype(np.int64) + z0 * sliceSize)
+            return cls.fromVoxels(data.shape, np.concatenate(voxelLabels), np.concatenate(linearInds))
+
+    @classmethod
+    def load(cls, fileName: str) -> 'LabelIndex':
+        with np.load(fileName) as npz:
+            return cls(npz['shape'], npz['labels'], npz['counts'], npz['bboxes'], npz['deltas'])
+
+    def save(self, fileName: str):
+        tmpFile = fileName + '.tmp.npz'
+        np.savez_compressed(tmpFile, shape=np.array(self.shape), labels=self.labels, counts=self.counts,
+                            bboxes=self.bboxes, deltas=self.deltas)
+        os.replace(tmpFile, fileName)
+
+    def getLabels(self) -> list:
+        return self.labels.tolist()
+
+    def getNumberOfLabels(self) -> int:
+        return len(self.labels)
+
+    def _getPos(self, label: int) -> int:
+        pos = int(np.searchsorted(self.labels, label))
+        if pos == len(self.labels) or self.labels[pos] != label:
+            raise KeyError('Label %s not found' % label)
+        return pos
+
+    def getCount(self, label: int) -> int:
+        return int(self.counts[self._getPos(label)])
+
+    def getBoundingBox(self, label: int):
+        """First voxel (z, y, x) of the bounding box of a label and the one after the last one."""
+        bbox = self.bboxes[self._getPos(label)]
+        return tuple(bbox[:3].tolist()), tuple(bbox[3:].tolist())
+
+    def getSlices(self, label: int, margin: int = 0) -> tuple:
+        """Slices of the bounding box of a label, extended with a margin, to crop a volume of the same shape."""
+        origin, end = self.getBoundingBox(label)
+        return tuple(slice(max(0, o - margin), min(dim, e + margin)) for o, e, dim in zip(origin, end, self.shape))
+
+    def getCoordinates(self, label: int) -> np.ndarray:
+        """Coordinates (z, y, x) of the voxels of a label, in C order."""
+        pos = self._getPos(label)
+        relInds = np.cumsum(self.deltas[self.offsets[pos]:self.offsets[pos + 1]], dtype=np.int64)
+        bbox = self.bboxes[pos]
+        return np.stack(np.unravel_index(relInds, bbox[3:] - bbox[:3]), axis=1) + bbox[:3]
+
+    def getMask(self, label: int, margin: int = 0):
+        """Mask of a label cropped to its bounding box (extended with a margin) and its origin (z, y, x)."""
+        slices = self.getSlices(label, margin)
+        origin = np.array([sl.start for sl in slices])
+        mask = np.zeros([sl.stop - sl.start for sl in slices], dtype=bool)
+        mask[tuple((self.getCoordinates(label) - origin).T)] = True
+        return mask, tuple(origin.tolist())
+
+    def getVoxels(self):
+        """Labels and linear indices (C order) of all the indexed voxels."""
+        relInds = np.cumsum(self.deltas, dtype=np.int64)
+        relInds -= np.repeat(relInds[self.offsets[:-1]] - self.deltas[self.offsets[:-1]], self.counts)
+        origins = np.repeat(self.bboxes[:, :3], self.counts, axis=0)
+        boxDims = np.repeat(self.bboxes[:, 3:] - self.bboxes[:, :3], self.counts, axis=0)
+        coords = [origins[:, 2] + relInds % boxDims[:, 2],
+                  origins[:, 1] + relInds // boxDims[:, 2] % boxDims[:, 1],
+                  origins[:, 0] + relInds // (boxDims[:, 2] * boxDims[:, 1])]
+        linearInds = np.ravel_multi_index(coords[::-1], self.shape) if len(relInds) else relInds
+        return np.repeat(self.labels, self.counts), linearInds
+
+    def resized(self, outShape) -> 'LabelIndex':
+        """Index of the volume resized to the given shape (z, y, x) with nearest neighbour interpolation, computed
+        from this one without reading the resized volume. Each voxel is mapped to the block of output voxels that
+        take their value from it (empty when downsampling discards it)."""
+        voxelLabels, linearInds = self.getVoxels()
+        coords = np.unravel_index(linearInds, self.shape)
+        starts, lengths = [], []
+        for coord, inDim, outDim in zip(coords, self.shape, outShape):
+            nearest = getNearestIndices(inDim, outDim)
+            start = np.searchsorted(nearest, coord, side='left')
+            starts.append(start)
+            lengths.append(np.searchsorted(nearest, coord, side='right') - start)
+        nOut = lengths[0] * lengths[1] * lengths[2]
+        voxelInds = np.repeat(np.arange(len(nOut)), nOut)
+        # Position of each output voxel in the block of its input voxel
+        k = np.arange(int(nOut.sum())) - np.repeat(np.cumsum(nOut) - nOut, nOut)
+        lengthY, lengthX = lengths[1][voxelInds], lengths[2][voxelInds]
+        outCoords = (starts[0][voxelInds] + k // (lengthY * lengthX),
+                     starts[1][voxelInds] + k // lengthX % lengthY,
+                     starts[2][voxelInds] + k % lengthX)
+        outLinearInds = np.ravel_multi_index(outCoords, outShape) if len(k) else k
+        return LabelIndex.fromVoxels(outShape, voxelLabels[voxelInds], outLinearInds)
+
+
+def isLabelIndexUpToDate(fileName: str) -> bool:
+    indexFile = getLabelIndexFile(fileName)
+    return exists(indexFile) and getmtime(indexFile) >= getmtime(realpath(fileName))
+
+
+def getLabelIndex(fileName: str, slabSize: int = SLAB_SIZE) -> LabelIndex:
+    """Index of a label volume, read from its sidecar file if it is newer than the volume, and built (and saved)
+    otherwise."""
+    if isLabelIndexUpToDate(fileName):
+        return LabelIndex.load(getLabelIndexFile(fileName))
+    index = LabelIndex.build(fileName, slabSize=slabSize)
+    index.save(getLabelIndexFile(fileName))
+    return index
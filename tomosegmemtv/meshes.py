@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Surface meshes of the labelled membranes, so they can be displayed in 3D without loading the full volumes. The
+iso-surface of each label of an annotation (_materials.mrc), or of a thresholded membrane map (_flt.mrc), is
+extracted with marching cubes in Z slabs read from the memory-mapped volume. Consecutive slabs share their border
+slice, so the vertices of the seams are identical and they are welded. Each mesh is decimated by vertex clustering
+to a triangle budget and the meshes are cached next to the volume, in a .npz file with the arrays
+verts_<label> (x, y, z in voxels), faces_<label> and the parameters used. Marching cubes is taken from
+scikit-image, which is an optional dependency."""
+import os
+from os.path import exists, getmtime
+
+import numpy as np
+
+from tomosegmemtv.utils import SLAB_SIZE, mrcfile
+
+MESHES_SUFFIX = '_meshes.npz'
+DEFAULT_MAX_TRIANGLES = 100000  # Per label
+WELD_DECIMALS = 4
+
+
+def getMeshesFile(fileName: str) -> str:
+    return os.path.splitext(fileName)[0] + MESHES_SUFFIX
+
+
+def _getMarchingCubes():
+    try:
+        from skimage.measure import marching_cubes
+    except ImportError:
+        raise ImportError('scikit-image is required to extract the membrane meshes. Install it in the Scipion '
+                          'environment with: pip install scikit-image')
+    return marching_cubes
+
+
+def weldVertices(verts: np.ndarray, faces: np.ndarray, decimals: int = WELD_DECIMALS):
+    """Merge the vertices with the same coordinates (e.g. the ones of the seams between slabs)."""
+    if not len(verts):
+        return verts, faces
+    uniqueVerts, inverse = np.unique(np.round(verts, decimals), axis=0, return_inverse=True)
+    return uniqueVerts, inverse.reshape(-1)[faces]
+
+
+def _removeDegenerateFaces(faces: np.ndarray) -> np.ndarray:
+    """Remove the faces with repeated vertices and the duplicated ones (same vertices in any order)."""
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    _, inds = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    return faces[np.sort(inds)]
+
+
+def clusterVertices(verts: np.ndarray, faces: np.ndarray, cellSize: float):
+    """Vertex clustering decimation: the vertices in the same cell of a grid are replaced by their mean."""
+    cells = np.floor(verts / cellSize).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    newVerts = np.zeros((len(counts), 3))
+    np.add.at(newVerts, inverse, verts)
+    newVerts /= counts[:, None]
+    return newVerts, _removeDegenerateFaces(inverse[faces])
+
+
+def decimateMesh(verts: np.ndarray, faces: np.ndarray, maxTriangles: int = DEFAULT_MAX_TRIANGLES):
+    """Decimate a mesh by vertex clustering, increasing the cell size until it has at most maxTriangles faces."""
+    if len(faces) <= maxTriangles:
+        return verts, faces
+    # The number of faces of a surface decreases with the square of the cell size
+    cellSize = np.sqrt(len(faces) / maxTriangles)
+    while True:
+        newVerts, newFaces = clusterVertices(verts, faces, cellSize)
+        if len(newFaces) <= maxTriangles:
+            # Vertices not used by any face anymore are dropped
+            used, newInds = np.unique(newFaces, return_inverse=True)
+            return newVerts[used], newInds.reshape(newFaces.shape)
+        cellSize *= 1.25
+
+
+def extractMeshes(fileName: str, threshold: float = None, labels=None, maxTriangles: int = DEFAULT_MAX_TRIANGLES,
+                  slabSize: int = SLAB_SIZE) -> dict:
+    """Surface of each label of an MRC file ({label: (verts, faces)}, vertices as x, y, z in voxels). If a
+    threshold is given, the voxels over it are considered a single label (1), e.g. for the membrane maps. The
+    labels can be restricted to the given ones."""
+    marchingCubes = _getMarchingCubes()
+    parts = {}
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        nz = data.shape[0]
+        for z0 in range(0, max(nz - 1, 1), slabSize):
+            z1 = min(z0 + slabSize, nz - 1)  # Border slice shared with the next slab
+            slab = np.asarray(data[z0:z1 + 1])
+            slab = (slab > threshold).astype(np.uint8) if threshold is not None else slab
+            slabLabels = np.unique(slab)
+            slabLabels = slabLabels[slabLabels != 0]
+            if labels is not None:
+                slabLabels = [label for label in slabLabels if label in labels]
+            # The surfaces are closed at the borders of the volume padding them with background
+            padZ = (1 if z0 == 0 else 0, 1 if z1 == nz - 1 else 0)
+            for label in slabLabels:
+                mask = np.pad((slab == label).astype(np.float32), (padZ, (1, 1), (1, 1)))
+                verts, faces, _, _ = marchingCubes(mask, level=0.5)
+                verts += (z0 - padZ[0], -1, -1)
+                nVerts = sum(len(v) for v, _ in parts.get(int(label), []))
+                parts.setdefault(int(label), []).append((verts, faces + nVerts))
+
+    meshes = {}
+    for label, labelParts in parts.items():
+        verts = np.concatenate([v for v, _ in labelParts])
+        faces = np.concatenate([f for _, f in labelParts])
+        verts, faces = weldVertices(verts, faces)
+        verts, faces = decimateMesh(verts, faces, maxTriangles)
+        meshes[label] = (verts[:, ::-1].astype(np.float32), faces.astype(np.int32))  # z, y, x -> x, y, z
+    return meshes
+
+
+def saveMeshes(meshes: dict, fileName: str, **params):
+    tmpFile = fileName + '.tmp.npz'
+    arrays = {}
+    for label, (verts, faces) in meshes.items():
+        arrays['verts_%i' % label] = verts
+        arrays['faces_%i' % label] = faces
+    np.savez_compressed(tmpFile, params=np.array(repr(sorted(params.items()))), **arrays)
+    os.replace(tmpFile, fileName)
+
+
+def loadMeshes(fileName: str) -> dict:
+    meshes = {}
+    with np.load(fileName) as npz:
+        for name in npz.files:
+            if name.startswith('verts_'):
+                label = int(name[len('verts_'):])
+                meshes[label] = (npz[name], npz['faces_%i' % label])
+    return meshes
+
+
+def getMeshes(fileName: str, threshold: float = None, maxTriangles: int = DEFAULT_MAX_TRIANGLES,
+              slabSize: int = SLAB_SIZE) -> dict:
+    """Meshes of an MRC file, read from the cache if it is newer than the file and was computed with the same
+    parameters, and extracted (and cached) otherwise."""
+    meshesFile = getMeshesFile(fileName)
+    params = {'threshold': threshold, 'maxTriangles': maxTriangles}
+    if exists(meshesFile) and getmtime(meshesFile) >= getmtime(os.path.realpath(fileName)):
+        with np.load(meshesFile) as npz:
+            upToDate = str(npz['params']) == repr(sorted(params.items()))
+        if upToDate:
+            return loadMeshes(meshesFile)
+    meshes = extractMeshes(fileName, threshold=threshold, maxTriangles=maxTriangles, slabSize=slabSize)
+    saveMeshes(meshes, meshesFile, **params)
+    return meshes
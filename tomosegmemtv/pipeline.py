@@ -0,0 +1,438 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Python API of the TomoSegMemTV segmentation chain.
+
+Each stage (scale space, tensor voting, surfaceness, saliency and resize) is exposed as a function that accepts
+a path to an MRC file, a NumPy array or a memory-map, and returns the result memory-mapped from an MRC file.
+The files written by a stage (its output if outFile is not given, and its input if it is not already an MRC
+file) go into the given workDir, which is managed by the caller.
+The stages can also be chained lazily with :class:`Pipeline`:
+
+    from tomosegmemtv.pipeline import Pipeline
+    flt = (Pipeline('tomo.mrc', workDir='tmp', nThreads=8)
+           .scaleSpace(mbThkPix=3)
+           .tensorVoting(mbScaleFactor=10)
+           .surfaceness(mbStrengthTh=0.3)
+           .tensorVoting(mbScaleFactor=10, whiteOverBlack=True)
+           .saliency(sigmaS=1, sigmaP=0)
+           .run('tomo_flt.mrc'))
+
+The same command builders and runners are used by the protocols.
+"""
+import logging
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+from os import remove
+from os.path import join, exists, isdir, basename
+
+import numpy as np
+
+from tomosegmemtv.constants import SCALE_SPACE, DT_VOTING, SURFACENESS, MRC, S2, TV, SURF, TV2, FLT, \
+    MB_STRENGTH_TH_MANUAL, MB_STRENGTH_TH_OTSU, PROBE_MB_STRENGTH_TH
+from tomosegmemtv.utils import resizeVolume, resizeFile, getNonZeroStats, getOtsuThreshold, thresholdVolume, \
+    writeEmptyVolume, estimateMembraneThickness, mrcfile
+
+logger = logging.getLogger(__name__)
+
+PLUGIN_NAME = 'tomosegmemtv'
+SHM_DIR = '/dev/shm'  # Used to keep the intermediate files in memory
+
+
+# --------------------------- COMMAND builders -----------------------------------
+def getScaleSpaceArgs(inFile: str, outFile: str, mbThkPix, nThreads: int) -> str:
+    outputCmd = '-s %s ' % mbThkPix
+    outputCmd += '%s ' % inFile
+    outputCmd += '%s ' % outFile
+    outputCmd += ' -t %i' % nThreads
+    return outputCmd
+
+
+def getTensorVotingArgs(inFile: str, outFile: str, mbScaleFactor, nThreads: int,
+                        whiteOverBlack: bool = False) -> str:
+    outputCmd = '-s %s ' % mbScaleFactor
+    if whiteOverBlack:
+        outputCmd += '-w '
+    outputCmd += '%s ' % inFile
+    outputCmd += '%s ' % outFile
+    outputCmd += ' -t %i' % nThreads
+    return outputCmd
+
+
+def getSurfArgs(inFile: str, outFile: str, mbStrengthTh, nThreads: int) -> str:
+    outputCmd = '-m %s ' % mbStrengthTh
+    outputCmd += '%s ' % inFile
+    outputCmd += '%s ' % outFile
+    outputCmd += ' -t %i' % nThreads
+    return outputCmd
+
+
+def getSalArgs(inFile: str, outFile: str, sigmaS, sigmaP, nThreads: int) -> str:
+    outputCmd = '-S '
+    outputCmd += '-s %s ' % sigmaS
+    outputCmd += '-p %s ' % sigmaP
+    outputCmd += '%s ' % inFile
+    outputCmd += '%s ' % outFile
+    outputCmd += ' -t %i' % nThreads
+    return outputCmd
+
+
+# --------------------------- RUNNERS -----------------------------------
+def registerPlugin():
+    """Define the plugin variables (e.g. TOMOSEGMEMTV_HOME) out of Scipion, as it does when loading the plugins."""
+    from tomosegmemtv import Plugin
+    if not Plugin.getHome():
+        import pwem
+        pwem.Domain.registerPlugin(PLUGIN_NAME)
+
+
+def runProgram(program: str, args: str, cwd: str = None, stdout=None):
+    """Default runner: execute a TomoSegMemTV program in a subprocess. The output is written into the given
+    file object if provided."""
+    from tomosegmemtv import Plugin
+    registerPlugin()
+    subprocess.run([Plugin.getProgram(program)] + shlex.split(args), check=True, cwd=cwd, stdout=stdout,
+                   stderr=subprocess.STDOUT if stdout else None)
+
+
+class ProcessRunner:
+    """Runner that executes the programs in subprocesses that can be killed from another thread with cancel(), as
+    when two copies of a stage are run at the same time. The programs are bound to the given cores if
+    provided."""
+
+    def __init__(self, cores=None, numaNode: int = None, cwd: str = None):
+        self.cores = cores
+        self.numaNode = numaNode
+        self.cwd = cwd
+        self._process = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def __call__(self, program: str, args: str):
+        from tomosegmemtv import Plugin
+        from tomosegmemtv.scheduling import getPinningCmd
+        registerPlugin()
+        program = Plugin.getProgram(program)
+        if self.cores:
+            program, args = getPinningCmd(program, args, self.cores, numaNode=self.numaNode)
+        cmd = [program] + shlex.split(args)
+        with self._lock:
+            if self._cancelled:
+                raise subprocess.CalledProcessError(-signal.SIGTERM, cmd)
+            logger.info('Running command: %s' % ' '.join(cmd))
+            self._process = subprocess.Popen(cmd, cwd=self.cwd)
+        returnCode = self._process.wait()
+        if returnCode:
+            raise subprocess.CalledProcessError(returnCode, cmd)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._process and self._process.poll() is None:
+                self._process.kill()
+
+
+# --------------------------- VOLUME I/O -----------------------------------
+def loadMmap(fileName: str) -> np.memmap:
+    """Memory-map the data of an MRC file (read only)."""
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        return mrc.data
+
+
+def writeMrc(data: np.ndarray, fileName: str, voxelSize: float = None) -> str:
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(data, dtype=np.float32) if data.dtype == np.float64 else np.asarray(data))
+        if voxelSize:
+            mrc.voxel_size = voxelSize
+    return fileName
+
+
+def _getMrcFileName(volume) -> str:
+    """File name of the MRC file whose whole data is the given memory-map, or None."""
+    fileName = getattr(volume, 'filename', None)
+    if isinstance(volume, np.memmap) and fileName and fileName.endswith(MRC):
+        with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            fileShape = (int(header.nz), int(header.ny), int(header.nx))
+            if volume.shape == fileShape and volume.offset == 1024 + int(header.nsymbt):
+                return fileName
+    return None
+
+
+def asMrcFile(volume, workDir: str = None, name: str = 'input') -> str:
+    """Path of an MRC file containing the given volume (path, array or memory-map). Arrays and memory-maps not
+    backed by a whole MRC file are written into workDir, which is then required."""
+    if isinstance(volume, str):
+        return volume
+    fileName = _getMrcFileName(volume)
+    if fileName:
+        return fileName
+    return writeMrc(volume, join(_checkWorkDir(workDir, name), name + MRC))
+
+
+def _getOutFile(outFile: str, workDir: str, name: str) -> str:
+    return outFile if outFile else join(_checkWorkDir(workDir, name), name + MRC)
+
+
+def _checkWorkDir(workDir: str, name: str) -> str:
+    # Not a temporary directory, which nobody would remove
+    if not workDir:
+        raise ValueError(f'A workDir is required to write the file {name}{MRC}')
+    return workDir
+
+
+# --------------------------- STAGES -----------------------------------
+def _runStage(program, argsBuilder, volume, outFile, workDir, runner, name, **kwargs) -> np.memmap:
+    inFile = asMrcFile(volume, workDir, name + '_in')
+    outFile = _getOutFile(outFile, workDir, name)
+    (runner or runProgram)(program, argsBuilder(inFile, outFile, **kwargs))
+    return loadMmap(outFile)
+
+
+def scaleSpace(volume, mbThkPix, outFile: str = None, nThreads: int = 1, workDir: str = None,
+               runner=None) -> np.memmap:
+    """Gaussian scale-space filtering (program scale_space)."""
+    return _runStage(SCALE_SPACE, getScaleSpaceArgs, volume, outFile, workDir, runner, 'scale_space',
+                     mbThkPix=mbThkPix, nThreads=nThreads)
+
+
+def tensorVoting(volume, mbScaleFactor, whiteOverBlack: bool = False, outFile: str = None, nThreads: int = 1,
+                 workDir: str = None, runner=None) -> np.memmap:
+    """Dense tensor voting (program dtvoting). The input features are expected to be dark over a light
+    background unless whiteOverBlack is set, which is always the case for surfaceness maps."""
+    return _runStage(DT_VOTING, getTensorVotingArgs, volume, outFile, workDir, runner, 'tensor_voting',
+                     mbScaleFactor=mbScaleFactor, nThreads=nThreads, whiteOverBlack=whiteOverBlack)
+
+
+def surfaceness(volume, mbStrengthTh, outFile: str = None, nThreads: int = 1, workDir: str = None,
+                runner=None) -> np.memmap:
+    """Surfaceness map (program surfaceness)."""
+    return _runStage(SURFACENESS, getSurfArgs, volume, outFile, workDir, runner, 'surfaceness',
+                     mbStrengthTh=mbStrengthTh, nThreads=nThreads)
+
+
+def saliency(volume, sigmaS=1, sigmaP=0, outFile: str = None, nThreads: int = 1, workDir: str = None,
+             runner=None) -> np.memmap:
+    """Saliency map (program surfaceness with option -S)."""
+    return _runStage(SURFACENESS, getSalArgs, volume, outFile, workDir, runner, 'saliency',
+                     sigmaS=sigmaS, sigmaP=sigmaP, nThreads=nThreads)
+
+
+def resize(volume, outShape, order: int = 0, outFile: str = None, workDir: str = None,
+           voxelSize: float = None, scale=None) -> np.memmap:
+    """Resize a volume to the given shape (z, y, x) with nearest neighbour (order 0, used for label volumes, whose
+    values are kept) or linear (order 1) interpolation. By default, the volume is scaled to fill the output shape.
+    A scale can be given instead, e.g. the binning factor to upsample a binned volume registered with the unbinned
+    one (see utils.getResizeCoords). The files are resized by Z slabs, without loading them into memory. If not
+    provided, the voxel size is scaled according to the scale along X. The output file can be the input one."""
+    outFile = _getOutFile(outFile, workDir, 'resized')
+    fileName = volume if isinstance(volume, str) else _getMrcFileName(volume)
+    if fileName:
+        resizeFile(fileName, outFile, outShape, order=order, scale=scale, voxelSize=voxelSize)
+    else:
+        writeMrc(resizeVolume(np.asarray(volume), outShape, order=order, scale=scale), outFile,
+                 voxelSize=voxelSize)
+    return loadMmap(outFile)
+
+
+def runTiled(stage, volume, *, nTiles: int, halo: int, outFile: str = None, workDir: str = None,
+             **kwargs) -> np.memmap:
+    """Run a stage on nTiles slabs along Z instead of on the whole volume, to reduce the memory needed by the
+    program. Each slab is extended with halo slices on both sides, which are discarded when composing the
+    output, so the filters and votes near the slab borders see the same neighbourhood as in the whole volume.
+    The parameters of the stage (e.g. mbScaleFactor) are given as keyword arguments."""
+    inFile = asMrcFile(volume, workDir, stage.__name__ + '_in')
+    data = loadMmap(inFile)
+    with mrcfile.open(inFile, header_only=True, permissive=True) as mrc:
+        voxelSize = float(mrc.voxel_size.x)
+    nz = data.shape[0]
+    bounds = np.linspace(0, nz, max(1, min(nTiles, nz)) + 1).astype(int)
+    outFile = _getOutFile(outFile, workDir, stage.__name__)
+    tilesDir = tempfile.mkdtemp(prefix='tiles_', dir=workDir)
+    try:
+        with mrcfile.new_mmap(outFile, shape=data.shape, mrc_mode=2, overwrite=True) as out:
+            for i, (z0, z1) in enumerate(zip(bounds[:-1], bounds[1:])):
+                h0, h1 = max(0, z0 - halo), min(nz, z1 + halo)
+                tileInFile = writeMrc(np.asarray(data[h0:h1]), join(tilesDir, f'tile_{i:03d}_in{MRC}'))
+                tile = stage(tileInFile, outFile=join(tilesDir, f'tile_{i:03d}{MRC}'), workDir=tilesDir, **kwargs)
+                out.data[z0:z1] = tile[z0 - h0:z1 - h0]
+                del tile
+            if voxelSize:
+                out.voxel_size = voxelSize
+    finally:
+        shutil.rmtree(tilesDir, ignore_errors=True)
+    return loadMmap(outFile)
+
+
+# --------------------------- WHOLE chain -----------------------------------
+def getAutoSurfTh(surfStats, mbStrengthThMode: int, mbStrengthPercentile=None) -> float:
+    """Threshold of the surfaceness map determined from its statistics (Otsu or percentile), applied instead of
+    the membrane-strength threshold of the program in the automatic modes."""
+    if mbStrengthThMode == MB_STRENGTH_TH_OTSU:
+        return getOtsuThreshold(surfStats)
+    return surfStats.getPercentile(mbStrengthPercentile)
+
+
+def segmentTomogram(tomoFile: str, outDir: str, params: dict, nThreads: int = 1, runStage=None) -> dict:
+    """Run the whole TomoSegMemTV chain on a tomogram, as ProtTomoSegmenTV does: membrane thickness estimation
+    (if params['mbThkCandidates'] is not empty), scale space, tensor voting, surfaceness (with the manual or
+    automatic membrane-strength threshold), early abort if (almost) no membrane voxels are detected, second
+    tensor voting and saliency. The files are written into outDir, named after the tomogram with the suffixes
+    of the intermediate results.
+
+    The params are those of the protocol: mbThkPix, mbThkCandidates, blackOverWhite, mbScaleFactor,
+    mbStrengthThMode, mbStrengthTh, mbStrengthPercentile, minMembFraction, sigmaS and sigmaP. Each stage is run
+    with runStage(stage, *args, **kwargs), e.g. to retry it or bind it to some cores, or with nThreads and the
+    default runner if not provided. It is a module function, so it can be sent to the workers of an executor
+    (see tomosegmemtv.executors). Returns a dict with the determined mbThkPix, the threshold applied to the
+    surfaceness map in the automatic modes (surfTh, None in the manual one), the statistics of the surfaceness
+    map, if the mask is empty and the output file."""
+    from pyworkflow.utils import cyanStr, yellowStr
+    if runStage is None:
+        runStage = lambda stage, *args, **kwargs: stage(*args, nThreads=nThreads, **kwargs)
+    tsId = basename(tomoFile).rsplit('.', 1)[0]
+    outFile = lambda suffix: join(outDir, tsId + suffix + MRC)
+
+    # Membrane thickness estimation
+    mbThkPix = params['mbThkPix']
+    if params.get('mbThkCandidates'):
+        logger.info(cyanStr(f'======> {tsId}: estimating the membrane thickness...'))
+        mbThkPix = estimateMembraneThickness(tomoFile, params['mbThkCandidates'],
+                                             blackOverWhite=params['blackOverWhite'])
+        logger.info(cyanStr(f'======> {tsId}: estimated membrane thickness = {mbThkPix} voxels'))
+    results = {'mbThkPix': mbThkPix, 'output': outFile(FLT)}
+    # Scale space
+    logger.info(cyanStr(f'======> {tsId}: running program {SCALE_SPACE}...'))
+    runStage(scaleSpace, tomoFile, mbThkPix, outFile=outFile(S2))
+    # Tensor voting
+    logger.info(cyanStr(f'======> {tsId}: running program {DT_VOTING} round 1...'))
+    runStage(tensorVoting, outFile(S2), params['mbScaleFactor'], whiteOverBlack=not params['blackOverWhite'],
+             outFile=outFile(TV))
+    # Surfaceness
+    logger.info(cyanStr(f'======> {tsId}: running program {SURFACENESS} round 1...'))
+    isManualTh = params['mbStrengthThMode'] == MB_STRENGTH_TH_MANUAL
+    mbStrengthTh = params['mbStrengthTh'] if isManualTh else PROBE_MB_STRENGTH_TH
+    runStage(surfaceness, outFile(TV), mbStrengthTh, outFile=outFile(SURF))
+    surfStats = getNonZeroStats(outFile(SURF))
+    logger.info(cyanStr(f'======> {tsId}: surfaceness map stats: {surfStats}'))
+    surfTh = None
+    if not isManualTh:
+        surfTh = getAutoSurfTh(surfStats, params['mbStrengthThMode'], params['mbStrengthPercentile'])
+        logger.info(cyanStr(f'======> {tsId}: applying the automatically determined surfaceness threshold '
+                            f'{surfTh:.4g}...'))
+        thresholdVolume(outFile(SURF), surfTh)
+        surfStats = getNonZeroStats(outFile(SURF))
+        logger.info(cyanStr(f'======> {tsId}: thresholded surfaceness map stats: {surfStats}'))
+    results.update(surfTh=surfTh, surfStats=surfStats,
+                   isEmpty=surfStats.nonZeroFraction < params['minMembFraction'])
+    # Early abort: skip the remaining steps if (almost) no membrane voxels were detected
+    if results['isEmpty']:
+        logger.info(yellowStr(f'======> {tsId}: non-zero fraction of the surfaceness map under '
+                              f'{params["minMembFraction"]}. Skipping the remaining steps and generating an empty '
+                              f'mask.'))
+        writeEmptyVolume(outFile(FLT), outFile(SURF))
+        return results
+    # Tensor voting - second round (to fill potential gaps and increase the robustness of the surfaceness map)
+    logger.info(cyanStr(f'======> {tsId}: running program {DT_VOTING} round 2...'))
+    # After the first tensor voting, the image will be always white over black
+    runStage(tensorVoting, outFile(SURF), params['mbScaleFactor'], whiteOverBlack=True, outFile=outFile(TV2))
+    # Saliency - second round (apply again the surfaceness program, but this time to produce the saliency)
+    logger.info(cyanStr(f'======> {tsId}: running program {SURFACENESS} round 2...'))
+    runStage(saliency, outFile(TV2), params['sigmaS'], params['sigmaP'], outFile=outFile(FLT))
+    return results
+
+
+# --------------------------- LAZY chaining -----------------------------------
+class Pipeline:
+    """Lazy chain of stages. Each method appends a stage and returns the pipeline, and nothing is executed
+    until run() is called. The result goes into workDir if no output file is given to run(). The intermediate
+    results are written into workDir too, or into a temporary directory in shared memory if inMemory is set, and
+    they are removed at the end unless keepIntermediates is set."""
+
+    def __init__(self, volume, workDir: str, nThreads: int = 1, inMemory: bool = False,
+                 keepIntermediates: bool = False, runner=None):
+        self.volume = volume
+        self.nThreads = nThreads
+        self.inMemory = inMemory
+        self.workDir = _checkWorkDir(workDir, 'pipeline results')
+        self.keepIntermediates = keepIntermediates
+        self.runner = runner
+        self.stages = []
+
+    def _addStage(self, func, **kwargs) -> 'Pipeline':
+        self.stages.append((func, kwargs))
+        return self
+
+    def scaleSpace(self, mbThkPix) -> 'Pipeline':
+        return self._addStage(scaleSpace, mbThkPix=mbThkPix)
+
+    def tensorVoting(self, mbScaleFactor, whiteOverBlack: bool = False) -> 'Pipeline':
+        return self._addStage(tensorVoting, mbScaleFactor=mbScaleFactor, whiteOverBlack=whiteOverBlack)
+
+    def surfaceness(self, mbStrengthTh) -> 'Pipeline':
+        return self._addStage(surfaceness, mbStrengthTh=mbStrengthTh)
+
+    def saliency(self, sigmaS=1, sigmaP=0) -> 'Pipeline':
+        return self._addStage(saliency, sigmaS=sigmaS, sigmaP=sigmaP)
+
+    def resize(self, outShape, order: int = 0) -> 'Pipeline':
+        return self._addStage(resize, outShape=outShape, order=order)
+
+    def _getIntermediatesDir(self) -> str:
+        if self.inMemory and isdir(SHM_DIR):
+            return tempfile.mkdtemp(prefix='tomosegmemtv_', dir=SHM_DIR)
+        return self.workDir
+
+    def run(self, outFile: str = None) -> np.memmap:
+        """Execute the stages and return the result of the last one, written into outFile if provided."""
+        intermediatesDir = self._getIntermediatesDir()
+        result = self.volume
+        intermediates = []
+        try:
+            for i, (func, kwargs) in enumerate(self.stages):
+                isLast = i == len(self.stages) - 1
+                stageOutFile = join(self.workDir if isLast else intermediatesDir, f'{i:02d}_{func.__name__}{MRC}')
+                if isLast and outFile:
+                    stageOutFile = outFile
+                if func is resize:
+                    result = func(result if isinstance(result, str) else asMrcFile(result, intermediatesDir),
+                                  outFile=stageOutFile, **kwargs)
+                else:
+                    result = func(result, outFile=stageOutFile, nThreads=self.nThreads, workDir=intermediatesDir,
+                                  runner=self.runner, **kwargs)
+                if not isLast:
+                    intermediates.append(stageOutFile)
+        finally:
+            if not self.keepIntermediates:
+                if intermediatesDir != self.workDir:
+                    shutil.rmtree(intermediatesDir, ignore_errors=True)
+                for fileName in intermediates:
+                    if exists(fileName):
+                        remove(fileName)
+        return result
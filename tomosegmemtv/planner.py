@@ -0,0 +1,239 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Execution plans of the protocols, estimated from the MRC headers only: steps of each tomogram, peak memory
+of each stage, disk needed and wall time, computed from the throughput calibration stored by previous
+executions (see tomosegmemtv.scheduling.ThroughputModel).
+
+The memory of each stage is modelled as a number of bytes per voxel of the volume it processes (float32 input,
+output and the fields computed by the programs), so the estimates are coarse upper bounds.
+"""
+import json
+import os
+import shutil
+from os.path import join, exists, dirname, abspath
+
+from tomosegmemtv.scheduling import ThroughputModel, getStageWork
+
+CALIBRATION_VAR = 'TOMOSEGMEMTV_CALIBRATION'  # Overrides the default calibration file
+CALIBRATION_FILE = 'tomosegmemtv_throughput.json'
+PLAN_FILE = 'plan.json'
+FLOAT_BYTES = 4
+# Peak memory per voxel (bytes)
+STAGE_RAM = {'scaleSpace': 16,
+             'tensorVoting': 48,  # Input, output and the tensor field (6 components) with its eigenvalues
+             'surfaceness': 32,
+             'saliency': 32,
+             'resize': 16}
+# Throughput (voxels per second and thread, see getStageWork) used if the stage has not been calibrated yet
+DEFAULT_THROUGHPUT = {'scaleSpace': 2e6,
+                      'tensorVoting': 1e5,
+                      'surfaceness': 1e6,
+                      'saliency': 1e6,
+                      'resize': 5e6}
+SEGMENTATION_STAGES = ['scaleSpace', 'tensorVoting', 'surfaceness', 'tensorVoting', 'saliency']
+N_INTERMEDIATES = 4  # Scale space, tensor voting, surfaceness and second tensor voting
+
+
+def getCalibrationFile() -> str:
+    calibrationFile = os.environ.get(CALIBRATION_VAR)
+    if not calibrationFile:
+        from pyworkflow import Config
+        calibrationFile = join(Config.SCIPION_USER_DATA, CALIBRATION_FILE)
+    return calibrationFile
+
+
+def getTotalMemory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def getAvailableMemory() -> int:
+    """Memory available for new processes (MemAvailable), or the total memory if it cannot be read."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return getTotalMemory()
+
+
+def getFreeDisk(path: str) -> int:
+    """Free disk in the filesystem of the given path, which may not exist yet."""
+    path = abspath(path)
+    while not exists(path) and dirname(path) != path:
+        path = dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def formatBytes(nBytes: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nBytes) < 1024:
+            return '%.1f %s' % (nBytes, unit)
+        nBytes /= 1024
+    return '%.1f TB' % nBytes
+
+
+def formatTime(seconds: float) -> str:
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return '%i:%02i:%02i' % (hours, rest // 60, rest % 60)
+
+
+class Plan:
+    """Steps of each tomogram with their estimated peak memory, disk and time, processed in groups of nSlots
+    tomograms at the same time."""
+
+    def __init__(self, protocol: str, nSlots: int = 1, nThreads: int = 1, tomos: list = None):
+        self.protocol = protocol
+        self.nSlots = max(1, nSlots)
+        self.nThreads = nThreads
+        self.tomos = tomos or []
+
+    def addTomo(self, tsId: str, steps: list, finalDisk: int = 0, extraDisk: int = 0):
+        """Steps are dicts with the keys step, stage, ram (bytes), disk (bytes written) and time (s). The disk of
+        the outputs kept at the end is finalDisk, and extraDisk is the one used only while processing it."""
+        self.tomos.append({'tsId': tsId, 'steps': steps, 'finalDisk': finalDisk, 'extraDisk': extraDisk})
+
+    def getTomoTime(self, tomo: dict) -> float:
+        return sum(step['time'] for step in tomo['steps'])
+
+    def getPeakRam(self) -> int:
+        """The tomograms using the most memory running their biggest stage at the same time."""
+        peaks = sorted((max([step['ram'] for step in tomo['steps']] or [0]) for tomo in self.tomos), reverse=True)
+        return sum(peaks[:self.nSlots])
+
+    def getDisk(self) -> int:
+        extra = sorted((tomo['extraDisk'] for tomo in self.tomos), reverse=True)
+        return sum(tomo['finalDisk'] for tomo in self.tomos) + sum(extra[:self.nSlots])
+
+    def getWallTime(self) -> float:
+        """Longest processing time first on nSlots, as the protocols schedule the tomograms."""
+        slots = [0.] * self.nSlots
+        for tomoTime in sorted((self.getTomoTime(tomo) for tomo in self.tomos), reverse=True):
+            slots[slots.index(min(slots))] += tomoTime
+        return max(slots)
+
+    def getSummary(self) -> list:
+        return [f'Plan of {len(self.tomos)} tomograms, {self.nSlots} at the same time with {self.nThreads} '
+                f'threads each:',
+                f'    - Peak memory: {formatBytes(self.getPeakRam())}',
+                f'    - Disk: {formatBytes(self.getDisk())}',
+                f'    - Wall time: {formatTime(self.getWallTime())}']
+
+    def __str__(self):
+        lines = self.getSummary()
+        for tomo in self.tomos:
+            lines.append(f'{tomo["tsId"]} ({formatTime(self.getTomoTime(tomo))}):')
+            for step in tomo['steps']:
+                lines.append(f'    {step["step"]:<20} {step["stage"] or "":<14} RAM {formatBytes(step["ram"]):>10}  '
+                             f'disk {formatBytes(step["disk"]):>10}  time {formatTime(step["time"])}')
+        return '\n'.join(lines)
+
+    def toDict(self) -> dict:
+        return {'protocol': self.protocol, 'nSlots': self.nSlots, 'nThreads': self.nThreads,
+                'peakRam': self.getPeakRam(), 'disk': self.getDisk(), 'wallTime': self.getWallTime(),
+                'tomos': self.tomos}
+
+    def save(self, fileName: str):
+        with open(fileName, 'w') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+    @classmethod
+    def load(cls, fileName: str) -> 'Plan':
+        with open(fileName) as f:
+            planDict = json.load(f)
+        return cls(planDict['protocol'], planDict['nSlots'], planDict['nThreads'], planDict['tomos'])
+
+
+def _getStageTime(throughput: ThroughputModel, stage: str, work: float, nThreads: int) -> float:
+    rate = throughput.getRate(stage) if throughput else None
+    return work / ((rate or DEFAULT_THROUGHPUT[stage]) * max(1, nThreads))
+
+
+def planSegmentation(tomoDims: dict, nSlots: int, nThreads: int, mbScaleFactor, binning: int = 1,
+                     keepAllFiles: bool = False, throughput: ThroughputModel = None) -> Plan:
+    """Plan of ProtTomoSegmenTV. The tomograms dimensions are given as {tsId: (nx, ny, nz)}."""
+    plan = Plan('ProtTomoSegmenTV', nSlots, nThreads)
+    for tsId, (nx, ny, nz) in tomoDims.items():
+        nVoxels = nx * ny * nz
+        nBinnedVoxels = nVoxels // binning ** 3
+        volumeSize = nBinnedVoxels * FLOAT_BYTES
+        steps = [{'step': 'convertInputStep', 'stage': None, 'ram': 0, 'disk': volumeSize if binning > 1 else 0,
+                  'time': 0}]
+        for stage in SEGMENTATION_STAGES:
+            work = getStageWork(stage, nBinnedVoxels, mbScaleFactor)
+            steps.append({'step': 'runTomoSegmenTV', 'stage': stage, 'ram': STAGE_RAM[stage] * nBinnedVoxels,
+                          'disk': volumeSize, 'time': _getStageTime(throughput, stage, work, nThreads)})
+        if binning > 1:
+            steps.append({'step': 'runTomoSegmenTV', 'stage': 'resize', 'ram': STAGE_RAM['resize'] * nVoxels,
+                          'disk': nVoxels * FLOAT_BYTES - volumeSize,
+                          'time': _getStageTime(throughput, 'resize', nVoxels, 1)})
+        steps.append({'step': 'createOutputStep', 'stage': None, 'ram': 0, 'disk': 0, 'time': 0})
+        inputDisk = volumeSize if binning > 1 else 0
+        intermediatesDisk = N_INTERMEDIATES * volumeSize
+        finalDisk = inputDisk + nVoxels * FLOAT_BYTES
+        if keepAllFiles:
+            plan.addTomo(tsId, steps, finalDisk=finalDisk + intermediatesDisk)
+        else:
+            plan.addTomo(tsId, steps, finalDisk=finalDisk, extraDisk=intermediatesDisk)
+    return plan
+
+
+def planResize(maskDims: dict, nSlots: int, throughput: ThroughputModel = None) -> Plan:
+    """Plan of ProtResizeSegmentedVolume. The dimensions are given as {tsId: ((nx, ny, nz) of the mask,
+    (nx, ny, nz) of the tomogram)}."""
+    plan = Plan('ProtResizeSegmentedVolume', nSlots, 1)
+    for tsId, (maskDim, tomoDim) in maskDims.items():
+        nInVoxels = maskDim[0] * maskDim[1] * maskDim[2]
+        nOutVoxels = tomoDim[0] * tomoDim[1] * tomoDim[2]
+        outSize = nOutVoxels * FLOAT_BYTES
+        steps = [{'step': 'resizeStep', 'stage': 'resize',
+                  'ram': FLOAT_BYTES * nInVoxels + (STAGE_RAM['resize'] - FLOAT_BYTES) * nOutVoxels,
+                  'disk': outSize, 'time': _getStageTime(throughput, 'resize', nOutVoxels, 1)},
+                 {'step': 'createOutputStep', 'stage': None, 'ram': 0, 'disk': 0, 'time': 0}]
+        plan.addTomo(tsId, steps, finalDisk=outSize)
+    return plan
+
+
+def checkResources(plan: Plan, outDir: str) -> list:
+    """Warnings of the plan not fitting in the machine memory, in the memory currently available or in the free
+    disk. They do not prevent the execution, as the estimates are coarse upper bounds."""
+    warnings = []
+    peakRam = plan.getPeakRam()
+    if peakRam > getTotalMemory():
+        warnings.append(f'The estimated peak memory ({formatBytes(peakRam)}) of processing {plan.nSlots} tomograms '
+                        f'at the same time exceeds the memory of the machine ({formatBytes(getTotalMemory())}). '
+                        f'Reduce the number of Scipion threads or bin the tomograms.')
+    elif peakRam > getAvailableMemory():
+        warnings.append(f'The estimated peak memory ({formatBytes(peakRam)}) of processing {plan.nSlots} tomograms '
+                        f'at the same time exceeds the memory currently available '
+                        f'({formatBytes(getAvailableMemory())}).')
+    disk = plan.getDisk()
+    freeDisk = getFreeDisk(outDir)
+    if disk > freeDisk:
+        warnings.append(f'The estimated disk needed ({formatBytes(disk)}) exceeds the free disk '
+                        f'({formatBytes(freeDisk)}) in {outDir}.')
+    return warnings
@@ -0,0 +1,165 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Background staging of the next tomograms to annotate. The files linked in the directory of each tomogram
+(tomogram and mask, usually on network storage) are copied onto a local scratch directory, with the names of the
+links, so the annotator can be given the copies and open them from local disk. The links themselves are never
+modified, so nothing points to the scratch directory if the process dies. The copies are removed when the
+prefetcher is closed."""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join, basename, realpath
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_VAR = 'TOMOSEGMEMTV_SCRATCH'  # Local scratch dir, the system temporary one if not set
+DEFAULT_N_AHEAD = 0
+MIN_FREE_FRACTION = 0.1  # Of the scratch file system, kept free after staging a tomogram
+
+
+def getScratchDir() -> str:
+    return os.environ.get(SCRATCH_VAR) or tempfile.gettempdir()
+
+
+class Prefetcher:
+    """Stage the files linked for each tomogram ({tsId: [link paths]}, in annotation order), keeping nAhead
+    tomograms staged after the one being annotated."""
+
+    def __init__(self, links: dict, scratchDir: str = None, nAhead: int = DEFAULT_N_AHEAD):
+        self.links = {tsId: list(tsIdLinks) for tsId, tsIdLinks in links.items()}
+        self.sources = {link: realpath(link) for tsIdLinks in self.links.values() for link in tsIdLinks}
+        self.scratchDir = tempfile.mkdtemp(prefix='tomosegmemtv_prefetch_', dir=scratchDir or getScratchDir())
+        self.nAhead = nAhead
+        self._order = list(self.links)
+        self._skipped = set()  # Tomograms not to stage (e.g. already annotated)
+        self._staged = {}  # tsId: {link: local copy}
+        self._current = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, currentTsId: str = None):
+        self._current = currentTsId
+        self._thread.start()
+
+    def setCurrent(self, tsId: str):
+        """Tomogram being annotated: the next ones are staged, the previous ones can be released."""
+        with self._cond:
+            self._current = tsId
+            self._cond.notify_all()
+
+    def skip(self, tsId: str):
+        """Do not stage a tomogram (e.g. because it has just been annotated)."""
+        with self._cond:
+            self._skipped.add(tsId)
+            self._cond.notify_all()
+
+    def isStaged(self, tsId: str) -> bool:
+        with self._cond:
+            return tsId in self._staged
+
+    def getStagedFile(self, link: str) -> str:
+        """Local copy of a linked file, or the link itself if it has not been staged. The copies of the current
+        tomogram are not released, so call setCurrent before opening them."""
+        with self._cond:
+            for copies in self._staged.values():
+                if link in copies:
+                    return copies[link]
+        return link
+
+    def _getWanted(self) -> list:
+        """Tomograms that should be staged: the next nAhead ones after the current one, in order."""
+        start = self._order.index(self._current) + 1 if self._current in self._order else 0
+        candidates = self._order[start:] + self._order[:start]
+        return [tsId for tsId in candidates if tsId not in self._skipped and tsId != self._current][:self.nAhead]
+
+    def _getReleasable(self) -> list:
+        """Staged tomograms not wanted anymore, except the current one, so they give their scratch space back."""
+        wanted = self._getWanted()
+        return [tsId for tsId in self._staged if tsId not in wanted and tsId != self._current]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._getReleasable() and \
+                        all(tsId in self._staged for tsId in self._getWanted()):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                released = self._getReleasable()
+                tsId = next((tsId for tsId in self._getWanted() if tsId not in self._staged), None)
+            for oldTsId in released:
+                self._release(oldTsId)
+            if tsId is None:
+                continue
+            try:
+                copies = self._stage(tsId)
+            except Exception as e:
+                logger.warning('Unable to prefetch %s: %s' % (tsId, e))
+                shutil.rmtree(join(self.scratchDir, tsId), ignore_errors=True)
+                with self._cond:
+                    self._skipped.add(tsId)
+                continue
+            with self._cond:
+                self._staged[tsId] = copies
+
+    def _stage(self, tsId: str) -> dict:
+        # The scratch is often a small local disk or memory (tmpfs), so the tomograms that do not fit are not staged
+        size = sum(os.path.getsize(self.sources[link]) for link in self.links[tsId])
+        usage = shutil.disk_usage(self.scratchDir)
+        if size > usage.free - MIN_FREE_FRACTION * usage.total:
+            raise OSError('not enough free space in %s (%i MB needed)' % (self.scratchDir, size // 2 ** 20))
+        tsIdDir = join(self.scratchDir, tsId)
+        os.makedirs(tsIdDir, exist_ok=True)
+        copies = {}
+        for link in self.links[tsId]:
+            # Same names as the links, as the annotator finds the mask next to the tomogram by its name
+            localFile = join(tsIdDir, basename(link))
+            tmpFile = localFile + '.tmp'
+            shutil.copyfile(self.sources[link], tmpFile)
+            os.replace(tmpFile, localFile)
+            copies[link] = localFile
+        logger.info('%s staged into %s' % (tsId, tsIdDir))
+        return copies
+
+    def _release(self, tsId: str):
+        with self._cond:
+            copies = self._staged.pop(tsId, None)
+        if copies is not None:
+            shutil.rmtree(join(self.scratchDir, tsId), ignore_errors=True)
+
+    def close(self):
+        """Stop the staging and remove the copies."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._cond:
+            self._staged.clear()
+        shutil.rmtree(self.scratchDir, ignore_errors=True)
@@ -0,0 +1,80 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Multi-resolution previews of the tomograms and annotations: a pyramid of binned copies (bin 2, 4 and 8 by
+default) stored in a cache directory. Each level is computed chunk-wise from the previous one (see
+tomosegmemtv.utils.binVolume), and it is rebuilt when it is older than the file it comes from."""
+import os
+from os.path import join, exists, getmtime, realpath
+
+from pyworkflow.utils import removeBaseExt
+
+from tomosegmemtv.constants import MRC
+from tomosegmemtv.utils import binVolume, mrcfile
+
+PYRAMID_DIR = 'pyramid'
+PYRAMID_BINNINGS = [2, 4, 8]
+
+
+def getPyramidDir(materialsFile: str) -> str:
+    """Cache of the pyramids of an annotation and its tomogram, next to the annotation."""
+    return join(os.path.dirname(materialsFile), PYRAMID_DIR)
+
+
+def getLevelFile(fileName: str, binning: int, cacheDir: str) -> str:
+    if binning == 1:
+        return fileName
+    return join(cacheDir, '%s_bin%i%s' % (removeBaseExt(fileName), binning, MRC))
+
+
+def isUpToDate(levelFile: str, fileName: str) -> bool:
+    return exists(levelFile) and getmtime(levelFile) >= getmtime(realpath(fileName))
+
+
+def getPyramidLevels(fileName: str, cacheDir: str, binnings=PYRAMID_BINNINGS) -> list:
+    """Binning factors of the levels available for a file (1 is the file itself), from the coarsest one."""
+    return sorted([binning for binning in binnings if isUpToDate(getLevelFile(fileName, binning, cacheDir),
+                                                                 fileName)] + [1], reverse=True)
+
+
+def buildPyramid(fileName: str, cacheDir: str, binnings=PYRAMID_BINNINGS, labels: bool = False) -> list:
+    """Compute the levels of a file that are missing or outdated. Each one is binned from the finest level it
+    can be obtained from, so the full size file is read only once. The levels smaller than a voxel in any
+    dimension are skipped. Return the levels available, as getPyramidLevels."""
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        minDim = min(mrc.data.shape)
+    binnings = [binning for binning in binnings if binning <= minDim]
+    os.makedirs(cacheDir, exist_ok=True)
+    built = [1]
+    for binning in sorted(binnings):
+        levelFile = getLevelFile(fileName, binning, cacheDir)
+        if not isUpToDate(levelFile, fileName):
+            sourceBinning = max(b for b in built if binning % b == 0)
+            tmpFile = levelFile + '.tmp'
+            binVolume(getLevelFile(fileName, sourceBinning, cacheDir), tmpFile, binning // sourceBinning,
+                      labels=labels)
+            os.replace(tmpFile, levelFile)
+        built.append(binning)
+    return getPyramidLevels(fileName, cacheDir, binnings)
@@ -0,0 +1,211 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Progress and ETA of the protocols, per tomogram and stage. The work of each stage is estimated from the
+voxels of the tomograms (read from the headers) and its throughput, measured on the stages already finished in
+the run or taken from the stored calibration (see tomosegmemtv.planner). The status is written into a JSON file
+that can be scraped by monitoring tools:
+
+    {"updated": "2024-05-01T10:00:00", "percent": 42.0, "eta": 3600.0, "etaTime": "2024-05-01T11:00:00",
+     "tomos": {"TS_01": {"status": "running", "stage": "tensorVoting", "percent": 35.2, "eta": 900.0}, ...}}
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from tomosegmemtv.planner import DEFAULT_THROUGHPUT, formatTime
+from tomosegmemtv.scheduling import ThroughputModel, getStageWork
+
+STATUS_FILE = 'status.json'
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+UPDATE_INTERVAL = 30  # s
+
+
+class ProgressTracker:
+    """Follow the stages of each tomogram. The tomograms are given as {tsId: voxels processed}, in the order they
+    are scheduled, and processed nSlots at the same time."""
+
+    def __init__(self, tomos: dict, stages: list, fileName: str, nSlots: int = 1, nThreads: int = 1,
+                 mbScaleFactor=10, throughput: ThroughputModel = None):
+        self.fileName = fileName
+        self.nSlots = max(1, nSlots)
+        self.nThreads = max(1, nThreads)
+        self.mbScaleFactor = mbScaleFactor
+        self.throughput = throughput or ThroughputModel()
+        self._tomos = {tsId: {'status': PENDING, 'voxels': nVoxels, 'stages': list(stages), 'done': 0,
+                              'stageStart': None, 'start': None}
+                       for tsId, nVoxels in tomos.items()}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._updater = None
+
+    def loadStatus(self):
+        """Mark as done the tomograms done in the status file written by a previous run, e.g. when the protocol is
+        continued and their steps are not run again."""
+        try:
+            with open(self.fileName) as f:
+                tomosStatus = json.load(f)['tomos']
+        except (OSError, ValueError, KeyError):
+            return
+        with self._lock:
+            for tsId, tomo in self._tomos.items():
+                if tomosStatus.get(tsId, {}).get('status') == DONE:
+                    tomo.update(status=DONE, done=len(tomo['stages']))
+
+    # --------------------------- Events -----------------------------------
+    def startTomo(self, tsId: str):
+        with self._lock:
+            self._tomos[tsId].update(status=RUNNING, start=time.time())
+        self.write()
+
+    def startStage(self, tsId: str, stage: str):
+        with self._lock:
+            tomo = self._tomos[tsId]
+            if stage in tomo['stages'][tomo['done']:]:
+                # Stages skipped (e.g. not run) before this one are considered done
+                tomo['done'] = tomo['stages'].index(stage, tomo['done'])
+            tomo['stageStart'] = time.time()
+        self.write()
+
+    def finishStage(self, tsId: str):
+        with self._lock:
+            tomo = self._tomos[tsId]
+            tomo['done'] = min(tomo['done'] + 1, len(tomo['stages']))
+            tomo['stageStart'] = None
+        self.write()
+
+    def finishTomo(self, tsId: str, failed: bool = False):
+        """The remaining stages (e.g. after an early abort) are considered done."""
+        with self._lock:
+            tomo = self._tomos[tsId]
+            tomo.update(status=FAILED if failed else DONE, stageStart=None)
+            if not failed:
+                tomo['done'] = len(tomo['stages'])
+        self.write()
+
+    # --------------------------- Estimates -----------------------------------
+    def _getStageTime(self, stage: str, nVoxels: int) -> float:
+        work = getStageWork(stage, nVoxels, self.mbScaleFactor)
+        expectedTime = self.throughput.getExpectedTime(stage, work, self.nThreads)
+        return expectedTime if expectedTime is not None else work / (DEFAULT_THROUGHPUT[stage] * self.nThreads)
+
+    def _getTomoTimes(self, tomo: dict, now: float) -> (float, float):
+        """Expected total time and remaining time of a tomogram."""
+        stageTimes = [self._getStageTime(stage, tomo['voxels']) for stage in tomo['stages']]
+        if tomo['status'] in (DONE, FAILED):
+            return sum(stageTimes), 0.
+        remaining = sum(stageTimes[tomo['done']:])
+        if tomo['stageStart'] is not None and tomo['done'] < len(stageTimes):
+            # The running stage may take longer than expected: keep a small part of it pending
+            elapsed = now - tomo['stageStart']
+            remaining -= min(elapsed, 0.99 * stageTimes[tomo['done']])
+        return sum(stageTimes), remaining
+
+    def getStatus(self) -> dict:
+        now = time.time()
+        with self._lock:
+            tomosStatus = {}
+            totalTime, remainingTime = 0., 0.
+            runningRemaining, pendingTimes = [], []
+            for tsId, tomo in self._tomos.items():
+                tomoTime, remaining = self._getTomoTimes(tomo, now)
+                totalTime += tomoTime
+                remainingTime += remaining
+                if tomo['status'] == RUNNING:
+                    runningRemaining.append(remaining)
+                elif tomo['status'] == PENDING:
+                    pendingTimes.append(remaining)
+                tomoStatus = {'status': tomo['status'],
+                              'percent': round(100 * (1 - remaining / tomoTime), 1) if tomoTime else 100.,
+                              'eta': round(remaining, 1)}
+                if tomo['status'] == RUNNING and tomo['done'] < len(tomo['stages']):
+                    tomoStatus['stage'] = tomo['stages'][tomo['done']]
+                tomosStatus[tsId] = tomoStatus
+        eta = self._getEta(runningRemaining, pendingTimes)
+        return {'updated': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                'percent': round(100 * (1 - remainingTime / totalTime), 1) if totalTime else 100.,
+                'eta': round(eta, 1),
+                'etaTime': datetime.fromtimestamp(now + eta).isoformat(timespec='seconds'),
+                'tomos': tomosStatus}
+
+    def _getEta(self, runningRemaining: list, pendingTimes: list) -> float:
+        """The pending tomograms are run in order in the first slot getting free."""
+        slots = sorted(runningRemaining + [0.] * max(0, self.nSlots - len(runningRemaining)))
+        for tomoTime in pendingTimes:
+            slots[0] += tomoTime
+            slots.sort()
+        return max(slots) if slots else 0.
+
+    # --------------------------- Status file -----------------------------------
+    def write(self):
+        status = self.getStatus()
+        os.makedirs(os.path.dirname(self.fileName) or '.', exist_ok=True)
+        tmpFileName = '%s.tmp%i' % (self.fileName, threading.get_ident())
+        with open(tmpFileName, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmpFileName, self.fileName)
+
+    def startUpdating(self, interval: float = UPDATE_INTERVAL):
+        """Rewrite the status file periodically, so the ETA of the running stages is updated. The updating thread
+        is started only once, until stopUpdating is called."""
+        def update():
+            while not self._stopEvent.wait(interval):
+                self.write()
+
+        with self._lock:
+            if self._updater is None:
+                self._updater = threading.Thread(target=update, daemon=True)
+                self._updater.start()
+
+    def stopUpdating(self):
+        self._stopEvent.set()
+        if self._updater is not None:
+            self._updater.join()
+        self.write()
+
+
+def getProgressSummary(fileName: str) -> list:
+    """Summary lines of a status file."""
+    try:
+        with open(fileName) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return []
+    nDone = sum(tomo['status'] == DONE for tomo in status['tomos'].values())
+    if nDone == len(status['tomos']):
+        return []
+    lines = [f'Progress: {status["percent"]:.1f} % ({nDone} of {len(status["tomos"])} tomograms), ETA '
+             f'{formatTime(status["eta"])} ({status["etaTime"]}, updated {status["updated"]})']
+    for tsId, tomo in status['tomos'].items():
+        if tomo['status'] == RUNNING:
+            lines.append(f'    - {tsId}: {tomo.get("stage", "")} {tomo["percent"]:.1f} %, ETA {formatTime(tomo["eta"])}')
+        elif tomo['status'] == FAILED:
+            lines.append(f'    - {tsId}: failed')
+    return lines
@@ -26,3 +26,4 @@
 from .protocol_annotate_membranes import ProtAnnotateMembranes
 from .protocol_tomosegmentv import ProtTomoSegmenTV
 from .protocol_resize_tomomask import ProtResizeSegmentedVolume
+from .protocol_label_membranes import ProtLabelMembranes
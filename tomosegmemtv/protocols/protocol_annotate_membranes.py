@@ -23,17 +23,23 @@
 # *
 # **************************************************************************
 import glob
+import importlib.util
+import os
 from enum import Enum
-from os.path import join, basename
+from os.path import join, basename, exists
 
 from pwem.protocols import EMProtocol
-from pyworkflow.object import Integer
-from pyworkflow.protocol import PointerParam
+from pyworkflow.object import Integer, Set
+from pyworkflow.protocol import PointerParam, IntParam, BooleanParam, GE, LEVEL_ADVANCED
 from pyworkflow.utils import removeBaseExt, makePath, createLink, replaceBaseExt, Message
 from tomo.objects import SetOfTomoMasks, TomoMask
-
-from tomosegmemtv.viewers_interactive.memb_annotator_tomo_viewer import MembAnnotatorDialog
-from tomosegmemtv.viewers_interactive.memb_annotator_tree import MembAnnotatorProvider
+from tomosegmemtv import Plugin
+from tomosegmemtv.annotation import AnnotationStatusIndex, AnnotationStore, getMaterialsFile, STORE_VAR, \
+    STORE_SIZE_VAR, DEFAULT_STORE_SIZE
+from tomosegmemtv.labelling import getLabelIndex
+from tomosegmemtv.meshes import getMeshes, DEFAULT_MAX_TRIANGLES, MESHES_SUFFIX
+from tomosegmemtv.previews import buildPyramid, getPyramidDir
+from tomosegmemtv.prefetch import Prefetcher, DEFAULT_N_AHEAD, SCRATCH_VAR
 
 EXT_MRC = '.mrc'
 FLT_SUFFIX = '_flt'
@@ -60,8 +66,12 @@ class ProtAnnotateMembranes(EMProtocol):
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
         self._objectsToGo = Integer()
+        self._reusedAnnotations = Integer()
         self._provider = None
         self._tomoMaskDict = None
+        self._statusIndex = None
+        self._prefetcher = None
+        self._registered = None  # tsIds of the output set
         
     def _defineParams(self, form):
         form.addSection(label=Message.LABEL_INPUT)
@@ -79,6 +89,45 @@ class ProtAnnotateMembranes(EMProtocol):
                       help='Select the the set of tomogram used for obtaining the Tomo Masks. This set will'
                            'only be used for visualization purpose in order to simplify the annotation. Of the '
                            'tomo masks.')
+        form.addParam('prefetchTomos', IntParam,
+                      label='Tomograms to prefetch',
+                      default=DEFAULT_N_AHEAD,
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='While a tomogram is being annotated, the files of the next ones (tomogram and mask) are '
+                           'copied in background onto a local scratch directory, so they open faster if they are '
+                           'on network storage. Set the variable %s to a local disk with enough free space, as the '
+                           'system temporary directory used otherwise is often kept in memory. The tomograms that '
+                           'do not fit are opened from their original location. The copies are removed when the '
+                           'annotator is closed. Set to 0 (default) to open all the files from their original '
+                           'location.' % SCRATCH_VAR)
+        form.addParam('reuseAnnotations', BooleanParam,
+                      label='Reuse the previous annotations?',
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The annotations are kept in a store (the directory set in the variable %s, or one in '
+                           'the Scipion user data directory), indexed by the content of the annotated mask. If set '
+                           'to Yes, the masks annotated before (in this or another protocol) with exactly the same '
+                           'content get their previous annotation, so only the new ones have to be annotated. The '
+                           'reused annotations can be edited as the rest. The masks are read once to compute '
+                           'their content hash, and the least recently used annotations are removed when the store '
+                           'exceeds %i GB (or the size set in the variable %s).'
+                           % (STORE_VAR, DEFAULT_STORE_SIZE, STORE_SIZE_VAR))
+        form.addParam('buildMeshes', BooleanParam,
+                      label='Extract the membrane meshes?',
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If set to Yes, the surface of each annotated membrane is extracted (marching cubes, '
+                           'requires scikit-image) and stored next to the annotation, in the file '
+                           'tsId/tsId_materials%s, so the membranes can be displayed in 3D without loading the '
+                           'volumes.' % MESHES_SUFFIX)
+        form.addParam('meshTriangles', IntParam,
+                      label='Maximum triangles per membrane',
+                      default=DEFAULT_MAX_TRIANGLES,
+                      validators=[GE(100)],
+                      condition='buildMeshes',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The meshes with more triangles are decimated (by vertex clustering) to this size.')
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -115,6 +164,16 @@ class ProtAnnotateMembranes(EMProtocol):
             else:
                 createLink(tomoMask.getFileName(), self.getfltFile(tomoMask) + EXT_MRC)
 
+        if self.reuseAnnotations.get():
+            store = AnnotationStore()
+            reused = [tsId for tsId, tomoMask in self._tomoMaskDict.items()
+                      if not exists(self._getCurrentTomoMaskFile(tsId)) and
+                      store.get(tomoMask.getFileName(), self._getExtraPath(), tsId)]
+            if reused:
+                print('\n==> Annotations reused from %s: %s' % (store.path, ', '.join(reused)))
+            self._reusedAnnotations.set(len(reused))
+            self._store(self._reusedAnnotations)
+
     def getfltFile(self, tomoMask, suffix=''):
         tsId = tomoMask.getTsId()
         return self._getExtraPath(tsId, removeBaseExt(tomoMask.getFileName().replace('_flt', '')) + suffix)
@@ -125,20 +184,54 @@ class ProtAnnotateMembranes(EMProtocol):
 
 
     def runMembraneAnnotator(self):
+        # The tomo masks already annotated (e.g. in a previous session) are registered in the output set, and the
+        # rest as soon as their annotation is written, so the next protocols can start processing them
+        self._registerAnnotated(*self._statusIndex.getDone())
+        self._statusIndex.addListener(self._registerAnnotated)
+
         # There are still some objects which haven't been annotated --> launch GUI
         self._getAnnotationStatus()
         if self._objectsToGo.get() > 0:
-            MembAnnotatorDialog(None, self._getExtraPath(), provider=self._provider, prot=self)
+            # GUI imported here, so the headless workers do not load the Tk stack when importing the protocols
+            from tomosegmemtv.viewers_interactive.memb_annotator_tomo_viewer import MembAnnotatorDialog
+            self._statusIndex.startWatching()
+            self._startPrefetching()
+            try:
+                MembAnnotatorDialog(None, self._getExtraPath(), provider=self._provider, prot=self)
+            finally:
+                self._statusIndex.stopWatching()
+                Plugin.closeAnnotatorSession()
+                if self._prefetcher is not None:
+                    self._prefetcher.close()
+                    self._prefetcher = None
 
-        # All the objetcs have been annotated --> create output objects
+        # All the objetcs have been annotated --> close the output
         self._getAnnotationStatus()
+        self._registerAnnotated(*self._statusIndex.getDone())
+        if self.reuseAnnotations.get():
+            self._storeAnnotations()
         if self._objectsToGo.get() == 0:
-            print("\n==> Generating the outputs")
-            labelledSet = self._genOutputSetOfTomoMasks()
-            self._defineOutputs(**{outputObjects.tomoMasks.name: labelledSet})
-            self._defineSourceRelation(self.inputTomoMasks.get(), labelledSet)
+            print("\n==> All the tomo masks annotated, closing the output")
+            with self._lock:
+                labelledSet = self._getOutputSetOfTomoMasks()
+                labelledSet.setStreamState(Set.STREAM_CLOSED)
+                labelledSet.write()
+                self._store(labelledSet)
 
         self._store()
+        # The output does not depend on them, so they are built once it is stored
+        self._buildAnnotationData()
+
+    def notifyAnnotationStart(self, tsId: str):
+        """ Called by the annotator dialog when a tomogram is opened, so the next ones are prefetched. """
+        if self._prefetcher is not None:
+            self._prefetcher.setCurrent(tsId)
+
+    def getAnnotatorTomoFile(self, tomoMask):
+        """ Tomogram given to the annotator: its local copy if it has been prefetched (the mask is copied next
+        to it), or the link in the extra dir otherwise. """
+        tomoFile = self.getfltFile(tomoMask, EXT_MRC)
+        return self._prefetcher.getStagedFile(tomoFile) if self._prefetcher is not None else tomoFile
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
@@ -149,6 +242,8 @@ class ProtAnnotateMembranes(EMProtocol):
                 summary.append('*%i* remaining segmentations to be annotated.' % objects2go)
             else:
                 summary.append('All segmentations have been already annotated.')
+        if self._reusedAnnotations.get():
+            summary.append('*%i* annotations reused from previous protocols.' % self._reusedAnnotations.get())
         return summary
 
     def _validate(self):
@@ -158,6 +253,9 @@ class ProtAnnotateMembranes(EMProtocol):
         if self.inputTomos.get():
             if abs(self.inputTomos.get().getSamplingRate() - self.inputTomoMasks.get().getSamplingRate()) > tolerance:
                 error.append('The sampling rate of the tomograms does not match the sampling rate of the input masks')
+        if self.buildMeshes.get() and importlib.util.find_spec('skimage') is None:
+            error.append('scikit-image is required to extract the membrane meshes. Install it in the Scipion '
+                         'environment with: pip install scikit-image')
 
         return error
 
@@ -167,29 +265,107 @@ class ProtAnnotateMembranes(EMProtocol):
         self._tomoMaskDict = {tomoMask.getTsId(): tomoMask.clone() for tomoMask in self.inputTomoMasks.get().iterItems()}
         if self.inputTomos.get():
             self._tomoDict = {tomo.getTsId(): tomo.clone() for tomo in self.inputTomos.get().iterItems()}
-        self._provider = MembAnnotatorProvider(list(self._tomoMaskDict.values()), self._getExtraPath(), 'membAnnotator')
+        self._statusIndex = AnnotationStatusIndex(self._getExtraPath(), list(self._tomoMaskDict.keys()))
+        from tomosegmemtv.viewers_interactive.memb_annotator_tree import MembAnnotatorProvider
+        from tomosegmemtv.viewers_interactive.paged_tree import PagedSet
+        # The tree reads its own clones of the page shown
+        self._provider = MembAnnotatorProvider(PagedSet(self.inputTomoMasks.get()), self._getExtraPath(),
+                                               'membAnnotator', statusIndex=self._statusIndex)
         self._getAnnotationStatus()
 
     def _getAnnotationStatus(self):
-        """Check if all the tomo masks have been annotated and store current status in a text file"""
-        doneTomes = [self._provider.getObjectInfo(tomo)['tags'] == 'done' for tomo in list(self._tomoMaskDict.values())]
-        self._objectsToGo.set(len(self._tomoMaskDict) - sum(doneTomes))
+        """Check if all the tomo masks have been annotated. The status is kept by an index updated from the
+        filesystem events, stored in the extra dir"""
+        self._statusIndex.update()
+        self._objectsToGo.set(self._statusIndex.getNumberPending())
+
+    def _startPrefetching(self):
+        nAhead = self.prefetchTomos.get()
+        if not nAhead:
+            return
+        # Files linked in convertInputStep for the tomograms not annotated yet
+        links = {}
+        for tsId in self._statusIndex.getPending():
+            links[tsId] = [fn for fn in sorted(glob.glob(self._getExtraPath(tsId, '*' + EXT_MRC)))
+                           if os.path.islink(fn)]
+        self._prefetcher = Prefetcher(links, nAhead=nAhead)
+        self._statusIndex.addListener(self._prefetcher.skip)
+        self._prefetcher.start()
+
+    def _storeAnnotations(self):
+        """Keep the new annotations in the store, so they can be reused."""
+        store = AnnotationStore()
+        for tsId in self._statusIndex.getDone():
+            try:
+                store.put(self._tomoMaskDict[tsId].getFileName(), self._getExtraPath(), tsId)
+            except OSError as e:
+                print('Unable to store the annotation of %s in %s: %s' % (tsId, store.path, e))
+
+    def _buildAnnotationData(self):
+        """Preview pyramids, label indexes and meshes (if requested) of the annotations. An annotation that
+        cannot be processed is reported and skipped, so it does not prevent the rest from being built."""
+        for tsId in self._statusIndex.getDone():
+            try:
+                self._buildPreviews(tsId)
+                self._buildLabelIndex(tsId)
+                if self.buildMeshes.get():
+                    self._buildMeshes(tsId)
+            except (OSError, ValueError) as e:
+                print('Unable to build the previews, label index or meshes of %s: %s' % (tsId, e))
+
+    def _buildPreviews(self, tsId: str):
+        """Preview pyramids of the annotation and its tomogram, used by the results viewer. Only the missing or
+        outdated levels are computed."""
+        materialsFile = self._getCurrentTomoMaskFile(tsId)
+        cacheDir = getPyramidDir(materialsFile)
+        buildPyramid(materialsFile, cacheDir, labels=True)
+        tomoFile = self._tomoMaskDict[tsId].getVolName()
+        if tomoFile and os.path.exists(tomoFile):
+            buildPyramid(tomoFile, cacheDir)
+
+    def _buildLabelIndex(self, tsId: str):
+        """Sparse index of the labels of the annotation, so the membranes can be extracted without reading the
+        whole volume. The existing one is reused if the annotation has not changed."""
+        getLabelIndex(self._getCurrentTomoMaskFile(tsId))
+
+    def _buildMeshes(self, tsId: str):
+        """Meshes of the annotated membranes. The cached ones are reused if the annotation has not changed."""
+        getMeshes(self._getCurrentTomoMaskFile(tsId), maxTriangles=self.meshTriangles.get())
 
     def _getCurrentTomoMaskFile(self, tsId: str):
-        return self._getExtraPath(tsId, tsId + '_materials.mrc')
-
-    def _genOutputSetOfTomoMasks(self):
-        tomoMaskSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite', suffix='annotated')
-        inTomoSet = self.inputTomoMasks.get()
-        tomoMaskSet.copyInfo(inTomoSet)
-        counter = 1
-        for inTomo in inTomoSet:
-            tomoMask = TomoMask()
-            inTomoFile = inTomo.getVolName()
-            tomoMask.copyInfo(inTomo)
-            tomoMask.setLocation((counter, self._getCurrentTomoMaskFile(inTomo.getTsId())))
-            tomoMask.setVolName(inTomoFile)
-            tomoMaskSet.append(tomoMask)
-            counter += 1
+        return getMaterialsFile(self._getExtraPath(), tsId)
 
+    def _getOutputSetOfTomoMasks(self):
+        tomoMaskSet = getattr(self, outputObjects.tomoMasks.name, None)
+        if tomoMaskSet:
+            tomoMaskSet.enableAppend()
+        else:
+            tomoMaskSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite', suffix='annotated')
+            tomoMaskSet.copyInfo(self.inputTomoMasks.get())
+            tomoMaskSet.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(**{outputObjects.tomoMasks.name: tomoMaskSet})
+            self._defineSourceRelation(self.inputTomoMasks, tomoMaskSet)
         return tomoMaskSet
+
+    def _registerAnnotated(self, *tsIds: str):
+        """Add the annotated tomo masks to the output set, if they have not been added yet. It is called from the
+        thread that watches the annotations as well."""
+        with self._lock:
+            tomoMaskSet = self._getOutputSetOfTomoMasks()
+            if self._registered is None:
+                self._registered = {tomoMask.getTsId() for tomoMask in tomoMaskSet.iterItems()} \
+                    if tomoMaskSet.getSize() else set()
+            newTsIds = [tsId for tsId in tsIds if tsId not in self._registered]
+            if not newTsIds:
+                return
+            counters = {tsId: counter for counter, tsId in enumerate(self._tomoMaskDict, start=1)}
+            for tsId in newTsIds:
+                inTomo = self._tomoMaskDict[tsId]
+                tomoMask = TomoMask()
+                tomoMask.copyInfo(inTomo)
+                tomoMask.setLocation((counters[tsId], self._getCurrentTomoMaskFile(tsId)))
+                tomoMask.setVolName(inTomo.getVolName())
+                tomoMaskSet.append(tomoMask)
+                self._registered.add(tsId)
+            tomoMaskSet.write()
+            self._store(tomoMaskSet)
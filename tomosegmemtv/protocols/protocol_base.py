@@ -22,10 +22,17 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import json
+import logging
+import os
+from os.path import exists
+
 from pwem.protocols import EMProtocol
 from pyworkflow.object import Set
-from pyworkflow.protocol import PointerParam
+from pyworkflow.protocol import PointerParam, BooleanParam
 from tomo.objects import SetOfTomoMasks, TomoMask, Tomogram
+from tomosegmemtv.constants import RESULTS_SUFFIX
+from tomosegmemtv.planner import Plan, PLAN_FILE, checkResources
 
 
 class ProtocolBase(EMProtocol):
@@ -41,6 +48,16 @@ class ProtocolBase(EMProtocol):
                       label='Tomograms',
                       help=helpMsg)
 
+    @staticmethod
+    def insertDryRunParam(form):
+        form.addParam('dryRun', BooleanParam,
+                      label='Only plan the execution (dry run)?',
+                      default=False,
+                      help='If set to Yes, nothing is processed. Only the headers of the input files are read to '
+                           'list the steps of each tomogram and to estimate the peak memory, the disk needed and '
+                           'the wall time, using the throughput measured in previous executions. The plan is '
+                           'written into the run log, the summary and the file extra/%s.' % PLAN_FILE)
+
     def getInTomos(self, isPointer=False):
         return self.inTomos if isPointer else self.inTomos.get()
 
@@ -59,14 +76,61 @@ class ProtocolBase(EMProtocol):
 
         return outTomoMasks
 
-    def addTomoMask(self,inTomo: Tomogram, outFileName: str):
+    def addTomoMask(self, inTomo: Tomogram, outFileName: str, volName: str = None, **extraAttrs):
+        """Add a TomoMask to the output set. Its tomogram (volName) is the input one unless given. The extra
+        attributes (pyworkflow objects) are set to the TomoMask, so they must be provided for all the elements of
+        the set."""
         outputTomoMasks = self.getOutputSetOfTomomasks()
         tomoMask = TomoMask()
         tomoMask.copyInfo(inTomo)
         tomoMask.setFileName(outFileName)
-        tomoMask.setVolName(inTomo.getFileName())
+        tomoMask.setVolName(volName or inTomo.getFileName())
+        for attrName, attrValue in extraAttrs.items():
+            setattr(tomoMask, attrName, attrValue)
 
         outputTomoMasks.append(tomoMask)
         outputTomoMasks.update(tomoMask)
         outputTomoMasks.write()
-        self._store(outputTomoMasks)
\ No newline at end of file
+        self._store(outputTomoMasks)
+
+    # --------------------------- RESULTS functions -----------------------------------
+    def _getResultsFile(self, tsId: str) -> str:
+        return self._getExtraPath(f'{tsId}{RESULTS_SUFFIX}')
+
+    def _saveResults(self, tsId: str, **results):
+        """Store the values computed for a tomogram by a step, so they are available to the output step even if
+        the protocol is continued after the step was run."""
+        resultsFile = self._getResultsFile(tsId)
+        tmpFile = resultsFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(results, f, indent=2)
+        os.replace(tmpFile, resultsFile)
+
+    def _loadResults(self, tsId: str) -> dict:
+        """Values stored by _saveResults, or an empty dict if there are none."""
+        try:
+            with open(self._getResultsFile(tsId)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # --------------------------- PLAN functions -----------------------------------
+    def _getPlan(self):
+        """Execution plan of the protocol, estimated from the headers of the input files, or None if the protocol
+        does not provide one."""
+        return None
+
+    def planStep(self):
+        plan = self._getPlan()
+        if plan is not None:
+            plan.save(self._getExtraPath(PLAN_FILE))
+            logging.info(str(plan))
+
+    def getPlanSummary(self) -> list:
+        planFile = self._getExtraPath(PLAN_FILE)
+        return Plan.load(planFile).getSummary() if exists(planFile) else []
+
+    def _checkPlanResources(self) -> list:
+        """Warnings of the estimated peak memory and disk of the execution plan."""
+        plan = self._getPlan()
+        return checkResources(plan, self.getWorkingDir()) if plan is not None else []
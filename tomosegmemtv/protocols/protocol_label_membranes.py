@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+from enum import Enum
+
+from pyworkflow.object import Integer, Float
+from pyworkflow.protocol import PointerParam, FloatParam, IntParam, EnumParam, GE, STEPS_PARALLEL, LEVEL_ADVANCED
+from pyworkflow.utils import Message, makePath, cyanStr
+from tomo.objects import SetOfTomoMasks
+from tomosegmemtv.annotation import getMaterialsFile
+from tomosegmemtv.constants import LABEL_TH_MANUAL, LABEL_TH_OTSU
+from tomosegmemtv.labelling import labelComponents, getLabelIndex, DEFAULT_MIN_SIZE, DEFAULT_CONNECTIVITY
+from tomosegmemtv.protocols.protocol_base import ProtocolBase
+from tomosegmemtv.utils import getNonZeroStats, getOtsuThreshold
+
+N_LABELS_ATTR = '_nMembranes'
+LABEL_TH_ATTR = '_labelThreshold'
+
+
+class outputObjects(Enum):
+    tomoMasks = SetOfTomoMasks
+
+
+class ProtLabelMembranes(ProtocolBase):
+    """Automatic separation of the segmented membranes.
+
+    The segmented volumes (saliency maps, *_flt.mrc*) are thresholded and their connected components are labelled,
+    so each membrane gets a different label. The volumes are processed by blocks of slices read from disk, and the
+    components that continue across the blocks are merged, so the tomograms are not loaded into memory. The
+    components smaller than the given size are discarded.
+
+    The output TomoMasks are written with the same layout of the ones generated by the annotation protocol
+    (*tsId/tsId_materials.mrc*), so they can be used instead of the manually annotated ones.
+    """
+
+    _label = 'label segmented membranes'
+    _possibleOutputs = outputObjects
+    stepsExecutionMode = STEPS_PARALLEL
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tomoMaskDict = None
+
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam('inTomoMasks', PointerParam,
+                      pointerClass='SetOfTomoMasks',
+                      allowsNull=False,
+                      important=True,
+                      label='Input segmentations (TomoMasks)',
+                      help='Segmented membranes, e.g. the saliency maps generated by the TomoSegMemTV protocol.')
+        form.addParam('thresholdMode', EnumParam,
+                      choices=['manual', 'Otsu'],
+                      default=LABEL_TH_OTSU,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Threshold mode',
+                      help='*manual*: the voxels with values greater than the introduced threshold are labelled.\n'
+                           '*Otsu*: the threshold is determined for each TomoMask applying the Otsu method to the '
+                           'histogram of its non-zero values. The threshold used for each TomoMask is stored in '
+                           'the corresponding output TomoMask.')
+        form.addParam('threshold', FloatParam,
+                      default=0,
+                      condition='thresholdMode == %i' % LABEL_TH_MANUAL,
+                      label='Threshold',
+                      help='The voxels with values greater than this threshold are considered membrane.')
+        form.addParam('minSize', IntParam,
+                      default=DEFAULT_MIN_SIZE,
+                      validators=[GE(1)],
+                      label='Minimum membrane size (voxels)',
+                      help='The connected components with less voxels are discarded.')
+        form.addParam('connectivity', EnumParam,
+                      choices=['faces (6)', 'faces and edges (18)', 'faces, edges and corners (26)'],
+                      default=DEFAULT_CONNECTIVITY - 1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Connectivity',
+                      help='Neighbours of a voxel considered to be part of the same membrane.')
+        form.addParallelSection(threads=1, mpi=0)
+
+    def _insertAllSteps(self):
+        self._initialize()
+        stepIds = []
+        for tsId in self.tomoMaskDict.keys():
+            labelId = self._insertFunctionStep(self.labelStep, tsId,
+                                               prerequisites=None,
+                                               needsGPU=False)
+            cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
+                                              prerequisites=labelId,
+                                              needsGPU=False)
+            stepIds.append(cOutId)
+        self._insertFunctionStep(self._closeOutputSet,
+                                 prerequisites=stepIds,
+                                 needsGPU=False)
+
+    def _initialize(self):
+        self.tomoMaskDict = {tomoMask.getTsId(): tomoMask.clone() for tomoMask in self.inTomoMasks.get()}
+
+    def labelStep(self, tsId: str):
+        fileName = self.tomoMaskDict[tsId].getFileName()
+        if self.thresholdMode.get() == LABEL_TH_OTSU:
+            threshold = getOtsuThreshold(getNonZeroStats(fileName))
+        else:
+            threshold = self.threshold.get()
+        logging.info(cyanStr(f'===> {tsId}: labelling the components of {fileName} with values greater than '
+                             f'{threshold:.4g}...'))
+        makePath(self._getExtraPath(tsId))
+        sizes = labelComponents(fileName, self._getLabelledFileName(tsId), threshold, minSize=self.minSize.get(),
+                                connectivity=self.connectivity.get() + 1)
+        logging.info(cyanStr(f'======> {tsId}: {len(sizes)} membranes labelled'))
+        getLabelIndex(self._getLabelledFileName(tsId))
+        self._saveResults(tsId, threshold=float(threshold))
+
+    def createOutputStep(self, tsId: str):
+        # Read from disk, so they are available if the protocol is continued after the labelling
+        nLabels = len(getLabelIndex(self._getLabelledFileName(tsId)).labels)
+        threshold = self._loadResults(tsId).get('threshold')
+        inTomoMask = self.tomoMaskDict[tsId]
+        with self._lock:
+            # Referred to the tomogram of the input TomoMask, as the annotated ones
+            self.addTomoMask(inTomoMask, self._getLabelledFileName(tsId), volName=inTomoMask.getVolName(),
+                             **{N_LABELS_ATTR: Integer(nLabels),
+                                LABEL_TH_ATTR: Float(threshold)})
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        tomoMasks = getattr(self, outputObjects.tomoMasks.name, None)
+        if tomoMasks:
+            for tomoMask in tomoMasks.iterItems():
+                threshold = getattr(tomoMask, LABEL_TH_ATTR).get()
+                summary.append('%s: *%s* membranes labelled (threshold %s)' %
+                               (tomoMask.getTsId(), getattr(tomoMask, N_LABELS_ATTR).get(),
+                                'unknown' if threshold is None else '%.4g' % threshold))
+        return summary
+
+    # --------------------------- UTIL functions -----------------------------------
+    def getInTomos(self, isPointer=False):
+        # The output is referred to the input TomoMasks
+        return self.inTomoMasks if isPointer else self.inTomoMasks.get()
+
+    def _getLabelledFileName(self, tsId: str) -> str:
+        return getMaterialsFile(self._getExtraPath(), tsId)
@@ -22,19 +22,22 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import logging
+import time
 from enum import Enum
 from os import symlink
 from os.path import exists, join
-import mrcfile
-from scipy.ndimage import zoom
-import numpy as np
 
 from pwem.convert.headers import setMRCSamplingRate
 from pwem.emlib.image import ImageHandler
 from pyworkflow.protocol import PointerParam, STEPS_PARALLEL
-from pyworkflow.utils import Message, removeBaseExt, getExt, getParentFolder
+from pyworkflow.utils import Message, removeBaseExt, getExt, getParentFolder, yellowStr
 from tomo.objects import SetOfTomoMasks
+from tomosegmemtv.labelling import LabelIndex, getLabelIndex, getLabelIndexFile, isLabelIndexUpToDate
+from tomosegmemtv.planner import Plan, planResize, getCalibrationFile
 from tomosegmemtv.protocols.protocol_base import ProtocolBase
+from tomosegmemtv.scheduling import ThroughputModel
+from tomosegmemtv import pipeline
 
 
 class outputObjects(Enum):
@@ -79,10 +82,14 @@ class ProtResizeSegmentedVolume(ProtocolBase):
                                 helpMsg='These tomograms will be used to be the ones to which the resized TomoMasks '
                                         'will be referred to. Thus, the resized segmentations will be of the same size '
                                         'of those tomograms.')
+        self.insertDryRunParam(form)
         form.addParallelSection(threads=1, mpi=0)
 
     def _insertAllSteps(self):
         self._initialize()
+        if self.dryRun.get():
+            self._insertFunctionStep(self.planStep, needsGPU=False)
+            return
         stepIds = []
         for tsId in self.tomoMaskDict.keys():
             rsId = self._insertFunctionStep(self.resizeStep, tsId,
@@ -112,23 +119,20 @@ class ProtResizeSegmentedVolume(ProtocolBase):
     def resizeStep(self, tsId: str):
         tomoMask = self.tomoMaskDict[tsId]
         fileName = tomoMask.getFileName()
-        x, y, z, _ = self.ih.getDimensions(tomoMask)
         nx, ny, nz, _ = self.ih.getDimensions(self.inTomosDict[tsId])
-        with mrcfile.open(fileName, permissive=True) as mrc:
-            originalMask = np.round_(mrc.data)
-
-        rx = nx / x
-        ry = ny / y
-        rz = nz / z
-
-        resizedMask = zoom(originalMask, (rx, ry, rz), order=0)
-
-        # Save resized data into a mrc file
+        # Resize (nearest neighbour, so the labels are kept) and save the resized data into a mrc file
         resizedFileName = self._getResizedMaskFileName(tsId)
-        with mrcfile.open(resizedFileName, mode='w+') as mrc:
-            mrc.set_data(np.round_(resizedMask))
-
+        t0 = time.time()
+        pipeline.resize(fileName, (nz, ny, nx), order=0, outFile=resizedFileName)
         self.resizedFileList.append(resizedFileName)
+        # Throughput calibration used to plan later executions
+        throughputModel = ThroughputModel()
+        throughputModel.record('resize', nx * ny * nz, time.time() - t0)
+        with self._lock:
+            try:
+                throughputModel.save(getCalibrationFile())
+            except OSError as e:
+                logging.info(yellowStr(f'Unable to save the throughput calibration: {e}'))
 
     def createOutputStep(self, tsId: str):
         with self._lock:
@@ -142,13 +146,37 @@ class ProtResizeSegmentedVolume(ProtocolBase):
             annotationDataFile = join(self.inTomoMasksDir, removeBaseExt(resizedFile) + '.txt')
             if exists(annotationDataFile):
                 symlink(annotationDataFile, self._getExtraPath(removeBaseExt(resizedFile) + '.txt'))
+        # Indexed after updating the header of the resized file, so the index is not older than it
+        self._resizeLabelIndex(self.tomoMaskDict[tsId].getFileName(), self._getResizedMaskFileName(tsId))
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
-        summary = []
+        summary = self.getPlanSummary()
         return summary
 
+    def _warnings(self):
+        return self._checkPlanResources() if self.inTomoMasks.get() and self.inTomos.get() else []
+
     # --------------------------- UTIL functions -----------------------------------
+    def _getPlan(self) -> Plan:
+        ih = ImageHandler()
+        tomoDims = {tomo.getTsId(): ih.getDimensions(tomo)[:3] for tomo in self.inTomos.get()}
+        maskDims = {tomoMask.getTsId(): (ih.getDimensions(tomoMask)[:3], tomoDims[tomoMask.getTsId()])
+                    for tomoMask in self.inTomoMasks.get() if tomoMask.getTsId() in tomoDims}
+        return planResize(maskDims, max(1, self.getScipionThreads() - 1),
+                          throughput=ThroughputModel.load(getCalibrationFile()))
+
+    @staticmethod
+    def _resizeLabelIndex(fileName: str, resizedFileName: str):
+        """Sparse index of the labels of the resized volume. If the input one is indexed, its index is resized,
+        so the resized volume is not read. Otherwise, the label volumes (annotations) are indexed."""
+        resized = pipeline.loadMmap(resizedFileName)
+        if isLabelIndexUpToDate(fileName):
+            resizedIndex = LabelIndex.load(getLabelIndexFile(fileName)).resized(resized.shape)
+            resizedIndex.save(getLabelIndexFile(resizedFileName))
+        elif resized.dtype.kind in 'ui':
+            getLabelIndex(resizedFileName)
+
     def _getResizedMaskFileName(self, tsId: str):
         tomoMask = self.tomoMaskDict[tsId]
         ext = getExt(tomoMask.getFileName())
@@ -22,34 +22,48 @@
 # *  e-mail address 'scipion-users@lists.sourceforge.net'
 # *
 # **************************************************************************
+import inspect
 import logging
+import math
 import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
 from os import remove
-from os.path import abspath
+from os.path import abspath, exists, basename
 from pwem.emlib.image import ImageHandler
-from pyworkflow.protocol import IntParam, GT, FloatParam, BooleanParam, LEVEL_ADVANCED, STEPS_PARALLEL
-from pyworkflow.utils import Message, removeBaseExt, createLink, cyanStr
+from pyworkflow.object import Boolean, Float, Integer, String
+from pyworkflow.protocol import IntParam, GT, GE, FloatParam, BooleanParam, EnumParam, Range, NumericListParam, \
+    StringParam, LEVEL_ADVANCED, STEPS_PARALLEL
+from pyworkflow.utils import Message, removeBaseExt, createLink, cyanStr, yellowStr, getListFromRangeString
 from tomo.objects import SetOfTomoMasks
 from tomosegmemtv import Plugin
+from tomosegmemtv import pipeline
+from tomosegmemtv.constants import SCALE_SPACE, S2, TV, SURF, TV2, FLT, SUFFiXES_2_REMOVE, MRC, \
+    MB_STRENGTH_TH_MANUAL, MB_STRENGTH_TH_PERCENTILE, PROBE_MB_STRENGTH_TH
+from tomosegmemtv.executors import getExecutor, runTask, EXECUTOR_NAMES, LOCAL, SSH
+from tomosegmemtv.planner import Plan, planSegmentation, getCalibrationFile, SEGMENTATION_STAGES
+from tomosegmemtv.progress import ProgressTracker, getProgressSummary, STATUS_FILE
 from tomosegmemtv.protocols.protocol_base import ProtocolBase
+from tomosegmemtv.scheduling import CoreAllocator, ThreadBudget, StageGate, ThroughputModel, formatCpuList, \
+    getSegmentationCost, getStageWork, getKillSignal, runWithBackup, killChildProcesses, BACKUP
+from tomosegmemtv.utils import binVolume
 
 logger = logging.getLogger(__name__)
 
-# TomoSegmemTV programs
-SCALE_SPACE = 'scale_space'
-DT_VOTING = 'dtvoting'
-SURFACENESS = 'surfaceness'
-
-# Generated files suffixes
-S2 = '_s2'
-TV = '_tv'
-SURF = '_surf'
-TV2 = '_tv2'
-FLT = '_flt'
-SUFFiXES_2_REMOVE = [S2, TV, SURF, TV2]
-
-MRC = '.mrc'
+# Attributes added to each output TomoMask
+EMPTY_MASK_ATTR = '_tsmEmptyMask'
+SURF_FRACTION_ATTR = '_tsmSurfFraction'
+SURF_TH_ATTR = '_tsmSurfTh'  # Threshold of the surfaceness map in the automatic modes
+MB_THK_PIX_ATTR = '_tsmMbThkPix'
+RECOVERED_ATTR = '_tsmRecovered'
+WORKER_ATTR = '_tsmWorker'
+WORKER_THROUGHPUT_ATTR = '_tsmWorkerThroughput'  # Voxels (of the processed volume) per second
+MIN_STAGE_TIMEOUT = 120  # s
 
 
 class outputObjects(Enum):
@@ -94,6 +108,7 @@ class ProtTomoSegmenTV(ProtocolBase):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.tomoMaskListDelineated = []
+        self.recoveredDict = {}
 
     def _defineParams(self, form):
         """ Define the input parameters that will be used.
@@ -104,10 +119,27 @@ class ProtTomoSegmenTV(ProtocolBase):
         form.addSection(label=Message.LABEL_INPUT)
         self.insertInTomosParam(form)
 
+        form.addParam('estimateMbThk', BooleanParam,
+                      default=False,
+                      label='Estimate the membrane thickness?',
+                      help='If set to Yes, the membrane thickness (auto) will be estimated for each tomogram before '
+                           'the scale-space step. A set of blocks is randomly sampled from the tomogram and a '
+                           'scale-normalized membrane response is computed for each of the candidate thicknesses, '
+                           'sharing the Fourier transform of each block among all of them. The candidate with the '
+                           'maximum response is used. The thickness used for each tomogram is stored in the '
+                           'corresponding output TomoMask.')
+        form.addParam('mbThkCandidates', NumericListParam,
+                      default='1-8',
+                      condition='estimateMbThk',
+                      label='Candidate membrane thicknesses (voxels)',
+                      help='Membrane thicknesses (integers) evaluated in the estimation. Examples:\n'
+                           '"1-8" --> [1, 2, 3, 4, 5, 6, 7, 8]\n'
+                           '"2 4 6" --> [2, 4, 6]')
         form.addParam('mbThkPix', IntParam,
                       allowsNull=False,
                       default=1,
                       validators=[GT(0)],
+                      condition='not estimateMbThk',
                       label='Membrane thickness (voxels)',
                       help='It basically represents the standard deviation of a Gaussian filtering. '
                            'This parameter should represent the thickness (in pixels) of the membranes sought.'
@@ -136,12 +168,49 @@ class ProtTomoSegmenTV(ProtocolBase):
                              'are black (darker) over white (lighter) background. This is normally the case '
                              'in cryo-tomography.'
                       )
+        form.addParam('binning', IntParam,
+                      default=1,
+                      validators=[GE(1)],
+                      label='Internal binning factor',
+                      help='If greater than 1, the input tomograms are binned by this factor (averaging blocks of '
+                           'voxels) before the segmentation, which is carried out at the reduced size (about '
+                           'binning^3 times less computation), and the resulting saliency map is upsampled back to '
+                           'the size of the input tomograms. Thus, the output TomoMasks have the same size and '
+                           'sampling rate as the input tomograms.\n'
+                           'All the parameters expressed in voxels (e.g. the membrane thickness or the membrane '
+                           'scale factor) refer to the binned tomograms.')
         group = form.addGroup('Membrane delineation',
                               expertLevel=LEVEL_ADVANCED)
+        group.addParam('mbStrengthThMode', EnumParam,
+                       choices=['manual', 'Otsu', 'percentile'],
+                       default=MB_STRENGTH_TH_MANUAL,
+                       display=EnumParam.DISPLAY_HLIST,
+                       expertLevel=LEVEL_ADVANCED,
+                       label='Membrane-strength threshold mode',
+                       help='*manual*: the introduced membrane-strength threshold is used.\n'
+                            '*Otsu*: the threshold is automatically determined for each tomogram applying the Otsu '
+                            'method to the histogram of the surfaceness map.\n'
+                            '*percentile*: the threshold is automatically determined for each tomogram as the value '
+                            'of the given percentile of the histogram of the surfaceness map.\n\n'
+                            'In the automatic modes, the first surfaceness round is carried out with a very low '
+                            'threshold (%s). The histogram of the resulting surfaceness map is computed reading it in '
+                            'chunks, the threshold is picked from it and the voxels of the map under the threshold '
+                            'are discarded before going on with the remaining steps. The threshold applied to the '
+                            'surfaceness map of each tomogram is stored in the corresponding output TomoMask.' %
+                            PROBE_MB_STRENGTH_TH)
+        group.addParam('mbStrengthPercentile', FloatParam,
+                       default=90,
+                       validators=[Range(0, 100)],
+                       condition='mbStrengthThMode == %i' % MB_STRENGTH_TH_PERCENTILE,
+                       expertLevel=LEVEL_ADVANCED,
+                       label='Membrane-strength percentile',
+                       help='Percentile of the histogram of the non-zero values of the surfaceness map used as '
+                            'membrane-strength threshold.')
         group.addParam('mbStrengthTh', FloatParam,
                        allowsNull=False,
                        default=0.3,
                        validators=[GT(0)],
+                       condition='mbStrengthThMode == %i' % MB_STRENGTH_TH_MANUAL,
                        expertLevel=LEVEL_ADVANCED,
                        label='Membrane-strength threshold',
                        help='Allows the user to specify a threshold for the membrane-strength. '
@@ -152,6 +221,16 @@ class ProtTomoSegmenTV(ProtocolBase):
                             'points, at the risk of generating false positives.\n'
                             'Check the gray level of the membranes of the input images to introduce a proper '
                             'value.')
+        group.addParam('minMembFraction', FloatParam,
+                       label='Minimum fraction of membrane voxels',
+                       default=1e-4,
+                       validators=[GE(0)],
+                       expertLevel=LEVEL_ADVANCED,
+                       help='After the first surfaceness round, the fraction of non-zero voxels of the surfaceness '
+                            'map is computed. If it is lower than this value, the tomogram is considered to contain '
+                            'no membrane signal (e.g. wrong black over white setting, empty tomogram or failed '
+                            'reconstruction), so the remaining steps are skipped for it and an empty mask, '
+                            'flagged as such, is generated. Set to 0 to always run all the steps.')
         group.addParam('sigmaS', FloatParam,
                        label='Sigma for the initial gaussian filtering',
                        default=1,
@@ -194,10 +273,79 @@ class ProtTomoSegmenTV(ProtocolBase):
                            'processed in groups of 2 at the same time with a call of Tomosegmemtv with 3 threads each, so '
                            '6 threads will be used at the same time. Beware the memory of your machine has '
                            'memory enough to load together the number of tomograms specified by Scipion threads.')
+        form.addParam('pinCores', BooleanParam,
+                      label='Pin each tomogram to its own cores?',
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If set to Yes, the Tomosegmemtv programs of each tomogram processed at the same time will '
+                           'be bound (with numactl or taskset) to a disjoint set of Tomosegmemtv threads cores, taken '
+                           'from a single NUMA node (socket) when possible. This avoids the threads to be moved among '
+                           'sockets and the remote memory accesses, which may slow down the tensor voting in multi-'
+                           'socket machines. The cores used are recorded in the run log.')
+        form.addParam('rebalanceThreads', BooleanParam,
+                      label='Give the idle threads to the remaining tomograms?',
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The tomograms are processed from the biggest to the smallest. If set to Yes, when fewer '
+                           'tomograms than Scipion threads are left, the Tomosegmemtv threads of the idle Scipion '
+                           'threads are shared among the remaining ones, so their next programs are called with more '
+                           'threads. If set to No, each program is called with the TomoSegMemTV threads.')
+        form.addParam('oomRetries', IntParam,
+                      label='Retries of the killed programs',
+                      default=2,
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of times a program killed by a signal (e.g. by the system when it runs out of '
+                           'memory) is retried before the protocol fails. The first retry waits for the programs of '
+                           'the other tomograms to finish and runs alone. The next ones split the volume in Z '
+                           'slabs (with a margin to avoid border effects), processed one after the other, doubling '
+                           'the number of slabs each time. Set it to 0 to disable the retries.')
+        form.addParam('oomTiles', IntParam,
+                      label='Z slabs of the first tiled retry',
+                      default=4,
+                      validators=[GE(2)],
+                      condition='oomRetries > 1',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Number of slabs in which the volume is split along Z in the first tiled retry.')
+        form.addParam('stragglerFactor', FloatParam,
+                      label='Straggler factor',
+                      default=0,
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      help='The throughput (voxels per second and thread) of each step is measured on the tomograms '
+                           'already processed. If a step takes longer than this factor times its expected time '
+                           '(and at least %i s), e.g. because of a hung or overloaded node, a copy of it is launched '
+                           'on other cores, writing into the tmp directory, and the result of the first one '
+                           'finishing is kept. The throughput measured on other hosts is not used. Set it to 0 (default) to '
+                           'disable it, or to a value of about 4 to enable it.' % MIN_STAGE_TIMEOUT)
+        form.addParam('executor', EnumParam,
+                      label='Run the tomograms in',
+                      choices=EXECUTOR_NAMES,
+                      default=LOCAL,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='*Local*: the programs are launched from the protocol process.\n'
+                           '*Local processes*: the whole chain of each tomogram is run by a pool of worker '
+                           'processes of this machine.\n'
+                           '*SSH*: the whole chain of each tomogram is run in one of the worker hosts through ssh. '
+                           'The hosts must see the project directory at the same path and have Scipion installed at '
+                           'the same path, and passwordless ssh must be configured.\n'
+                           'In all the cases, the number of tomograms processed at the same time is set by the '
+                           'Scipion threads, and the results are collected into the same output set. The retries, '
+                           'backup copies and core pinning are only available in the local mode.')
+        form.addParam('workerHosts', StringParam,
+                      label='Worker hosts',
+                      condition='executor == %i' % SSH,
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Hosts separated by spaces. The number of tomograms processed at the same time in a host '
+                           'can be specified as host:slots, e.g. node1:2 node2:2.')
+        self.insertDryRunParam(form)
         form.addParallelSection(threads=1, mpi=0)
 
     def _insertAllSteps(self):
         self._initialize()
+        if self.dryRun.get():
+            self._insertFunctionStep(self.planStep, needsGPU=False)
+            return
         stepIds = []
         for tsId in self.inTomosDict.keys():
             cInId = self._insertFunctionStep(self.convertInputStep, tsId,
@@ -217,48 +365,101 @@ class ProtTomoSegmenTV(ProtocolBase):
         
     def _initialize(self):
         self.ih = ImageHandler()
-        self.inTomosDict = {tomo.getTsId(): tomo.clone() for tomo in self.inTomos.get()}
+        inTomos = [tomo.clone() for tomo in self.inTomos.get()]
+        # Voxels processed for each tomogram, read from the headers
+        tomosVoxels = {}
+        for tomo in inTomos:
+            nx, ny, nz, _ = self.ih.getDimensions(tomo)
+            tomosVoxels[tomo.getTsId()] = nx * ny * nz // self.binning.get() ** 3
+        # Longest processing time first, so a big tomogram does not delay the end of the protocol if it comes last
+        inTomos.sort(key=lambda tomo: getSegmentationCost(tomosVoxels[tomo.getTsId()], self.mbScaleFactor.get()),
+                     reverse=True)
+        self.inTomosDict = {tomo.getTsId(): tomo for tomo in inTomos}
+        # Threads shared among the tomograms processed at the same time
+        nSlots = max(1, self.getScipionThreads() - 1)
+        self.threadBudget = ThreadBudget(self.binThreads.get(), nSlots, len(inTomos))
+        self.coreAllocator = CoreAllocator(budget=self.threadBudget.budget) if self.pinCores.get() else None
+        self.stageGate = StageGate()
+        self.throughputModel = ThroughputModel.load(getCalibrationFile())
+        self.tomoExecutor = getExecutor(self.executor.get(), nWorkers=nSlots,
+                                        hosts=self.workerHosts.get('').split(), workDir=self._getTmpPath())
+        # Progress of each tomogram, estimated from the voxels processed and the throughput of each stage
+        tomosVoxels = {tsId: tomosVoxels[tsId] for tsId in self.inTomosDict}
+        self.progress = ProgressTracker(tomosVoxels, SEGMENTATION_STAGES, self._getExtraPath(STATUS_FILE),
+                                        nSlots=nSlots, nThreads=self.binThreads.get(),
+                                        mbScaleFactor=self.mbScaleFactor.get(), throughput=self.throughputModel)
+        self.progress.loadStatus()
 
     def convertInputStep(self, tsId: str):
         tomo = self.inTomosDict[tsId]
         fn = tomo.getFileName()
         newFn = self._getConvertedOrLinkedFn(tsId)
-        logging.info(cyanStr(f'===> Converting or linking file {fn} into {newFn}'))
-        if fn.endswith(MRC):
-            createLink(fn, newFn)
+        binning = self.binning.get()
+        if binning > 1:
+            logging.info(cyanStr(f'===> Binning file {fn} by {binning} into {newFn}'))
+            if fn.endswith(MRC):
+                binVolume(fn, newFn, binning)
+            else:
+                unbinnedFn = self._getExtraPath(f'{tsId}_unbinned{MRC}')
+                self.ih.convert(fn, unbinnedFn)
+                binVolume(unbinnedFn, newFn, binning)
+                remove(unbinnedFn)
         else:
-            self.ih.convert(fn, newFn)
+            logging.info(cyanStr(f'===> Converting or linking file {fn} into {newFn}'))
+            if fn.endswith(MRC):
+                createLink(fn, newFn)
+            else:
+                self.ih.convert(fn, newFn)
 
     def runTomoSegmenTV(self, tsId: str):
         logging.info(cyanStr(f'===> {tsId}: running TomoSegmemTV...'))
+        self.threadBudget.start()
+        self.progress.startUpdating()
+        self.progress.startTomo(tsId)
+        try:
+            self._runTomoSegmenTV(tsId)
+        except Exception:
+            self.progress.finishTomo(tsId, failed=True)
+            raise
+        finally:
+            self.threadBudget.finish()
+        self.progress.finishTomo(tsId)
+
+    def _runTomoSegmenTV(self, tsId: str):
         tomoFile = self._getConvertedOrLinkedFn(tsId)
-        Nthreads = self.binThreads.get()
-
-        # Scale space
-        logging.info(cyanStr(f'======> {tsId}: running program {SCALE_SPACE}...'))
-        s2OutputFile = self._getExtraPath(tsId + S2 + MRC)
-        cmd = self._getScaleSpaceCmd(tomoFile, Nthreads, s2OutputFile)
-        Plugin.runTomoSegmenTV(self, SCALE_SPACE, cmd)
-        # Tensor voting
-        logging.info(cyanStr(f'======> {tsId}: running program {DT_VOTING} round 1...'))
-        tVOutputFile = self._getExtraPath(tsId + TV + MRC)
-        cmd = self._getTensorVotingCmd(s2OutputFile, tVOutputFile, Nthreads)
-        Plugin.runTomoSegmenTV(self, DT_VOTING, cmd)
-        # Surfaceness
-        logging.info(cyanStr(f'======> {tsId}: running program {SURFACENESS} round 1...'))
-        surfOutputFile = self._getExtraPath(tsId + SURF + MRC)
-        cmd = self._getSurfCmd(tVOutputFile, surfOutputFile, Nthreads)
-        Plugin.runTomoSegmenTV(self, SURFACENESS, cmd)
-        # Tensor voting - second round (to fill potential gaps and increase the robustness of the surfaceness map)
-        logging.info(cyanStr(f'======> {tsId}: running program {DT_VOTING} round 2...'))
-        tV2OutputFile = self._getExtraPath(tsId + TV2 + MRC)
-        cmd = self._getTensorVotingCmd(surfOutputFile, tV2OutputFile, Nthreads, isFirstRound=False)
-        Plugin.runTomoSegmenTV(self, DT_VOTING, cmd)
-        # Saliency - second round (apply again the surfaceness program, but this time to produce the saliency)
-        logging.info(cyanStr(f'======> {tsId}: running program {SURFACENESS} round 2...'))
-        salOutputFile = self._getExtraPath(tsId + FLT + MRC)
-        cmd = self._getSalCmd(tV2OutputFile, salOutputFile, Nthreads)
-        Plugin.runTomoSegmenTV(self, SURFACENESS, cmd)
+        if self.executor.get() == LOCAL:
+            taskResult = runTask(pipeline.segmentTomogram, tomoFile, self._getExtraPath(),
+                                 self._getSegmentationParams(),
+                                 runStage=lambda stage, *args, **kwargs: self._runStage(tsId, stage, *args, **kwargs))
+        else:
+            # The whole chain of the tomogram is run by a worker
+            taskResult = self.tomoExecutor.submit(pipeline.segmentTomogram, abspath(tomoFile),
+                                                  abspath(self._getExtraPath()), self._getSegmentationParams(),
+                                                  nThreads=self.binThreads.get()).result()
+            logging.info(cyanStr(f'======> {tsId}: processed by worker {taskResult.worker} in '
+                                 f'{taskResult.elapsed:.1f} s'))
+        results = taskResult.value
+        # Saved to disk, so they are available if the protocol is continued after this step
+        self._saveResults(tsId,
+                          mbThkPix=int(results['mbThkPix']),
+                          surfTh=None if results['surfTh'] is None else float(results['surfTh']),
+                          surfFraction=float(results['surfStats'].nonZeroFraction),
+                          isEmpty=bool(results['isEmpty']),
+                          recovered=self.recoveredDict.get(tsId, []),
+                          worker=taskResult.worker,
+                          throughput=pipeline.loadMmap(tomoFile).size / taskResult.elapsed)
+        self._endRunTomoSegmenTV(tsId, tomoFile, self._getResultingFn(tsId))
+
+    def _endRunTomoSegmenTV(self, tsId, tomoFile, salOutputFile):
+        binning = self.binning.get()
+        if binning > 1:
+            # Upsample the saliency map to the size of the input tomogram, registered with it (the voxels cropped
+            # by the binning take the values of the border)
+            inTomo = self.inTomosDict[tsId]
+            nx, ny, nz, _ = self.ih.getDimensions(inTomo)
+            logging.info(cyanStr(f'======> {tsId}: upsampling the saliency map to ({nx}, {ny}, {nz})...'))
+            pipeline.resize(salOutputFile, (nz, ny, nx), order=1, outFile=salOutputFile, scale=binning,
+                            voxelSize=inTomo.getSamplingRate())
         self.tomoMaskListDelineated.append(salOutputFile)
         # Remove intermediate files if requested
         if not self.keepAllFiles.get():
@@ -268,60 +469,250 @@ class ProtTomoSegmenTV(ProtocolBase):
         with self._lock:
             inTomo = self.inTomosDict[tsId]
             outFileName = self._getResultingFn(tsId)
-            self.addTomoMask(inTomo, outFileName)
+            results = self._loadResults(tsId)
+            self.addTomoMask(inTomo, outFileName,
+                             **{EMPTY_MASK_ATTR: Boolean(results.get('isEmpty', False)),
+                                SURF_FRACTION_ATTR: Float(results.get('surfFraction')),
+                                SURF_TH_ATTR: Float(results.get('surfTh')),
+                                MB_THK_PIX_ATTR: Integer(results.get('mbThkPix')),
+                                RECOVERED_ATTR: String(', '.join(results.get('recovered', []))),
+                                WORKER_ATTR: String(results.get('worker')),
+                                WORKER_THROUGHPUT_ATTR: Float(results.get('throughput'))})
+            self._saveCalibration()
+
+    def _closeOutputSet(self):
+        try:
+            super()._closeOutputSet()
+        finally:
+            self.tomoExecutor.shutdown()
+            self.progress.stopUpdating()
 
     # --------------------------- INFO functions -----------------------------------
     def _summary(self):
-        summary = []
+        summary = self.getPlanSummary()
+        summary += getProgressSummary(self._getExtraPath(STATUS_FILE))
+        outTomoMasks = getattr(self, self._possibleOutputs.tomoMasks.name, None)
+        if outTomoMasks:
+            emptyMsgs = []
+            recoveredMsgs = []
+            workersDict = {}
+            for tomoMask in outTomoMasks.iterItems():
+                worker = getattr(tomoMask, WORKER_ATTR, None)
+                if worker and worker.get():
+                    workersDict.setdefault(worker.get(), []).append(getattr(tomoMask, WORKER_THROUGHPUT_ATTR).get())
+                recovered = getattr(tomoMask, RECOVERED_ATTR, None)
+                if recovered and recovered.get():
+                    recoveredMsgs.append(f'    - {tomoMask.getTsId()}: {recovered.get()}')
+                isEmpty = getattr(tomoMask, EMPTY_MASK_ATTR, None)
+                if isEmpty and isEmpty.get():
+                    surfFraction = getattr(tomoMask, SURF_FRACTION_ATTR).get()
+                    emptyMsgs.append(f'    - {tomoMask.getTsId()}: non-zero fraction of the surfaceness map = '
+                                     f'{surfFraction:.2e}')
+            if emptyMsgs:
+                summary.append(f'*{len(emptyMsgs)}* tomograms with no membrane signal after the first surfaceness '
+                               f'round (fraction < {self.minMembFraction.get()}). Empty masks were generated for '
+                               f'them:')
+                summary.extend(emptyMsgs)
+            if recoveredMsgs:
+                summary.append(f'*{len(recoveredMsgs)}* tomograms with stages killed (e.g. out of memory) and '
+                               f'recovered by retrying them:')
+                summary.extend(recoveredMsgs)
+            if len(workersDict) > 1:
+                summary.append('Throughput per worker:')
+                summary.extend([f'    - {worker}: {len(rates)} tomograms, {sum(rates) / len(rates):.3g} voxels/s'
+                                for worker, rates in sorted(workersDict.items())])
         return summary
 
     def _validate(self):
+        errors = []
         if not os.path.exists(Plugin.getProgram(SCALE_SPACE)):
-            return ["%s is not at %s. Review installation. Please go to %s for instructions." %
-                    (SCALE_SPACE, Plugin.getProgram(SCALE_SPACE), Plugin.getUrl())]
+            errors.append("%s is not at %s. Review installation. Please go to %s for instructions." %
+                          (SCALE_SPACE, Plugin.getProgram(SCALE_SPACE), Plugin.getUrl()))
+        if self.estimateMbThk.get():
+            try:
+                mbThkCandidates = getListFromRangeString(self.mbThkCandidates.get())
+            except ValueError:
+                mbThkCandidates = []
+            if not mbThkCandidates or min(mbThkCandidates) <= 0:
+                errors.append('The candidate membrane thicknesses must be a non-empty list of positive integers.')
+        return errors
+
+    def _warnings(self):
+        return self._checkPlanResources() if self.inTomos.get() else []
 
     # --------------------------- UTIL functions -----------------------------------
+    def _getPlan(self) -> Plan:
+        ih = ImageHandler()
+        tomoDims = {tomo.getTsId(): ih.getDimensions(tomo)[:3] for tomo in self.inTomos.get()}
+        return planSegmentation(tomoDims, max(1, self.getScipionThreads() - 1), self.binThreads.get(),
+                                self.mbScaleFactor.get(), binning=self.binning.get(),
+                                keepAllFiles=self.keepAllFiles.get(),
+                                throughput=ThroughputModel.load(getCalibrationFile()))
+
+    def _saveCalibration(self):
+        try:
+            self.throughputModel.save(getCalibrationFile())
+        except OSError as e:
+            logging.info(yellowStr(f'Unable to save the throughput calibration: {e}'))
+
+    def _getTileHalo(self, stage, *args) -> int:
+        # Wide enough for the support (3 sigma) of the scale-space filter (its second argument is the membrane
+        # thickness) or of the voting and the Gaussian derivatives of the other stages
+        if stage is pipeline.scaleSpace:
+            return int(math.ceil(3 * args[1]))
+        return int(math.ceil(3 * self.mbScaleFactor.get()))
+
     def _getConvertedOrLinkedFn(self, tsId: str) -> str:
         return self._getExtraPath(f'{tsId}{MRC}')
 
     def _getResultingFn(self, tsId: str) -> str:
         return self._getExtraPath(f'{tsId}_flt{MRC}')
 
+    def _getSegmentationParams(self) -> dict:
+        return {'mbThkPix': self.mbThkPix.get(),
+                'mbThkCandidates': getListFromRangeString(self.mbThkCandidates.get()) if self.estimateMbThk.get()
+                else None,
+                'blackOverWhite': self.blackOverWhite.get(),
+                'mbScaleFactor': self.mbScaleFactor.get(),
+                'mbStrengthThMode': self.mbStrengthThMode.get(),
+                'mbStrengthTh': self.mbStrengthTh.get(),
+                'mbStrengthPercentile': self.mbStrengthPercentile.get(),
+                'minMembFraction': self.minMembFraction.get(),
+                'sigmaS': self.sigmaS.get(),
+                'sigmaP': self.sigmaP.get()}
+
     def _removeIntermediateFiles(self, tomoFile):
         tomoBaseName = removeBaseExt(tomoFile)
         for suffix in SUFFiXES_2_REMOVE:
-            remove(abspath(self._getExtraPath(tomoBaseName + suffix + MRC)))
-
-    def _getScaleSpaceCmd(self, inputFile, Nthreads, outputFile):
-        outputCmd = '-s %s ' % self.mbThkPix.get()
-        outputCmd += '%s ' % inputFile
-        outputCmd += '%s ' % outputFile
-        outputCmd += ' -t %i' % Nthreads
-        return outputCmd
+            fileName = abspath(self._getExtraPath(tomoBaseName + suffix + MRC))
+            if exists(fileName):  # Some may not have been generated if the execution was aborted
+                remove(fileName)
+
+    def _runStage(self, tsId: str, stage, *args, **kwargs):
+        """Run a stage of the pipeline with the threads currently assigned to the tomogram, bound to its own cores
+        if requested. If the program is killed (e.g. by the OOM killer), the stage is retried according to the
+        retry policy: first alone in the machine and then in Z-slab tiles."""
+        nThreads = self.threadBudget.getThreads() if self.rebalanceThreads.get() else self.binThreads.get()
+        self.progress.startStage(tsId, stage.__name__)
+        attempt = 0
+        while True:
+            nTiles = self.oomTiles.get() * 2 ** (attempt - 2) if attempt > 1 else 1
+            try:
+                with self.stageGate.exclusive() if attempt == 1 else self.stageGate.shared():
+                    result = self._runPinnedStage(tsId, stage, nThreads, nTiles, *args, **kwargs)
+                break
+            except subprocess.CalledProcessError as e:
+                killSignal = getKillSignal(e.returncode)
+                if killSignal is None or attempt >= self.oomRetries.get():
+                    raise
+                attempt += 1
+                retryMode = 'alone' if attempt == 1 else f'in {self.oomTiles.get() * 2 ** (attempt - 2)} Z tiles'
+                logging.info(yellowStr(f'======> {tsId}: {stage.__name__} killed by {killSignal.name}. Retrying '
+                                       f'{retryMode} (retry {attempt} of {self.oomRetries.get()})...'))
+        if attempt:
+            with self._lock:
+                self.recoveredDict.setdefault(tsId, []).append(f'{stage.__name__} ({retryMode})')
+        self.progress.finishStage(tsId)
+        return result
+
+    def _runPinnedStage(self, tsId: str, stage, nThreads: int, nTiles: int, *args, **kwargs):
+        work = getStageWork(stage.__name__, pipeline.loadMmap(args[0]).size, self.mbScaleFactor.get())
+        timeout = self._getStageTimeout(stage, work, nThreads) if nTiles == 1 else None
+        t0 = time.time()
+        if timeout:
+            result = self._runWithBackup(tsId, stage, nThreads, timeout, *args, **kwargs)
+        else:
+            with self._pinnedCores(tsId, nThreads) as (numaNode, cores):
+                kwargs.update(nThreads=nThreads, runner=lambda program, programArgs:
+                              self._runProgram(program, programArgs, cores=cores, numaNode=numaNode))
+                if nTiles > 1:
+                    # The parameters of the stage are passed by name, as runTiled takes the tiling ones
+                    stageArgs = inspect.signature(stage).bind_partial(*args).arguments
+                    volume = stageArgs.pop('volume')
+                    result = pipeline.runTiled(stage, volume, nTiles=nTiles, halo=self._getTileHalo(stage, *args),
+                                               workDir=self._getTmpPath(), **stageArgs, **kwargs)
+                else:
+                    result = stage(*args, **kwargs)
+        if nTiles == 1:
+            self.throughputModel.record(stage.__name__, work, time.time() - t0, nThreads)
+        return result
+
+    def _runWithBackup(self, tsId: str, stage, nThreads: int, timeout: float, *args, outFile=None, **kwargs):
+        """Run the stage and, if it takes longer than timeout, a copy of it on other cores writing into the
+        tmp directory. The output of the first one finishing is kept. The primary copy is run with runJob, as the
+        rest of the stages, and cancelled by killing the processes writing its output."""
+        backupOutFile = self._getTmpPath(f'{tsId}_backup_{basename(outFile)}')
+        primaryCancelled = threading.Event()
+        backupRunner = pipeline.ProcessRunner()
+
+        def runPrimary():
+            with self._pinnedCores(tsId, nThreads) as (numaNode, cores):
+                def runner(program, programArgs):
+                    if primaryCancelled.is_set():
+                        raise subprocess.CalledProcessError(-signal.SIGTERM, program)
+                    self._runProgram(program, programArgs, cores=cores, numaNode=numaNode)
+                stage(*args, outFile=outFile, nThreads=nThreads, runner=runner, **kwargs)
+
+        def cancelPrimary():
+            primaryCancelled.set()
+            killChildProcesses(outFile)
+
+        def runBackup():
+            logging.info(yellowStr(f'======> {tsId}: {stage.__name__} still running after {timeout:.0f} s. '
+                                   f'Launching a backup copy...'))
+            with self._pinnedCores(tsId, nThreads) as (numaNode, cores):
+                backupRunner.cores, backupRunner.numaNode = cores, numaNode
+                stage(*args, outFile=backupOutFile, nThreads=nThreads, runner=backupRunner, **kwargs)
+
+        winner = runWithBackup((runPrimary, cancelPrimary), (runBackup, backupRunner.cancel), timeout)
+        if winner == BACKUP:
+            logging.info(yellowStr(f'======> {tsId}: the backup copy of {stage.__name__} finished first'))
+            shutil.move(backupOutFile, outFile)
+            with self._lock:
+                self.recoveredDict.setdefault(tsId, []).append(f'{stage.__name__} (backup copy after '
+                                                               f'{timeout:.0f} s)')
+        elif exists(backupOutFile):
+            remove(backupOutFile)
+        return pipeline.loadMmap(outFile)
+
+    def _getStageTimeout(self, stage, work: float, nThreads: int):
+        """Time after which a backup copy of the stage is launched, or None if it is not known yet."""
+        expectedTime = self.throughputModel.getExpectedTime(stage.__name__, work, nThreads)
+        if not self.stragglerFactor.get() or expectedTime is None:
+            return None
+        return max(MIN_STAGE_TIMEOUT, self.stragglerFactor.get() * expectedTime)
+
+    @contextmanager
+    def _pinnedCores(self, tsId: str, nThreads: int):
+        numaNode, cores = None, None
+        if self.coreAllocator:
+            numaNode, cores = self.coreAllocator.acquire(nThreads)
+            logging.info(cyanStr(f'======> {tsId}: pinned to cores {formatCpuList(cores)} (NUMA node '
+                                 f'{"any" if numaNode is None else numaNode})'))
+        elif nThreads != self.binThreads.get():
+            logging.info(cyanStr(f'======> {tsId}: running with {nThreads} threads'))
+        try:
+            yield numaNode, cores
+        finally:
+            if cores:
+                self.coreAllocator.release(cores)
+
+    def _runProgram(self, program: str, args: str, cores=None, numaNode=None):
+        Plugin.runTomoSegmenTV(self, program, args, cores=cores, numaNode=numaNode)
+
+    def _getScaleSpaceCmd(self, inputFile, Nthreads, outputFile, mbThkPix=None):
+        return pipeline.getScaleSpaceArgs(inputFile, outputFile, self.mbThkPix.get() if mbThkPix is None else mbThkPix,
+                                          Nthreads)
 
     def _getTensorVotingCmd(self, inputFile, outputFile, Nthreads, isFirstRound=True):
-        outputCmd = '-s %s ' % self.mbScaleFactor.get()
-        if isFirstRound and not self.blackOverWhite.get():
-            outputCmd += '-w '
-        elif not isFirstRound:
-            outputCmd += '-w '  # After the first tensor voting, the image will be always white over black
-        outputCmd += '%s ' % inputFile
-        outputCmd += '%s ' % outputFile
-        outputCmd += ' -t %i' % Nthreads
-        return outputCmd
-
-    def _getSurfCmd(self, inputFile, outputFile, Nthreads):
-        outputCmd = '-m %s ' % self.mbStrengthTh.get()
-        outputCmd += '%s ' % inputFile
-        outputCmd += '%s ' % outputFile
-        outputCmd += ' -t %i' % Nthreads
-        return outputCmd
+        # After the first tensor voting, the image will be always white over black
+        whiteOverBlack = not isFirstRound or not self.blackOverWhite.get()
+        return pipeline.getTensorVotingArgs(inputFile, outputFile, self.mbScaleFactor.get(), Nthreads,
+                                            whiteOverBlack=whiteOverBlack)
+
+    def _getSurfCmd(self, inputFile, outputFile, Nthreads, mbStrengthTh=None):
+        return pipeline.getSurfArgs(inputFile, outputFile,
+                                    self.mbStrengthTh.get() if mbStrengthTh is None else mbStrengthTh, Nthreads)
 
     def _getSalCmd(self, inputFile, outputFile, Nthreads):
-        outputCmd = '-S '
-        outputCmd += '-s %s ' % self.sigmaS.get()
-        outputCmd += '-p %s ' % self.sigmaP.get()
-        outputCmd += '%s ' % inputFile
-        outputCmd += '%s ' % outputFile
-        outputCmd += ' -t %i' % Nthreads
-        return outputCmd
+        return pipeline.getSalArgs(inputFile, outputFile, self.sigmaS.get(), self.sigmaP.get(), Nthreads)
@@ -0,0 +1,374 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import glob
+import json
+import os
+import queue
+import re
+import shutil
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+from os.path import basename, join
+from statistics import median
+
+from tomosegmemtv.utils import fileLock
+
+NUMA_NODES_DIR = '/sys/devices/system/node'
+REF_MB_SCALE_FACTOR = 10  # The work of the tensor voting stages is referred to this scale factor
+PRIMARY = 'primary'
+BACKUP = 'backup'
+
+
+def parseCpuList(cpuList: str) -> list:
+    """Parse a Linux CPU list, e.g. '0-3,8,10-11' --> [0, 1, 2, 3, 8, 10, 11]."""
+    cores = []
+    for item in cpuList.strip().split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            cores.extend(range(int(first), int(last) + 1))
+        elif item:
+            cores.append(int(item))
+    return cores
+
+
+def formatCpuList(cores) -> str:
+    """Format a list of cores as a Linux CPU list, e.g. [0, 1, 2, 3, 8] --> '0-3,8'."""
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(first) if first == last else '%i-%i' % (first, last) for first, last in ranges)
+
+
+def getNumaNodes() -> dict:
+    """Cores available for this process, grouped by NUMA node ({node: [cores]}). If the topology cannot be read,
+    all the cores are considered to belong to node 0."""
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for nodeDir in glob.glob(join(NUMA_NODES_DIR, 'node[0-9]*')):
+        try:
+            with open(join(nodeDir, 'cpulist')) as f:
+                cores = [core for core in parseCpuList(f.read()) if core in available]
+        except (OSError, ValueError):
+            continue
+        if cores:
+            nodes[int(re.sub(r'\D', '', basename(nodeDir)))] = cores
+    return nodes if nodes else {0: sorted(available)}
+
+
+def getPinningCmd(program: str, args: str, cores, numaNode=None) -> (str, str):
+    """Program and arguments to run a command bound to the given cores (and to the memory of the given NUMA
+    node) with numactl or, if not available, taskset."""
+    cpuList = formatCpuList(cores)
+    if shutil.which('numactl'):
+        pinArgs = '--physcpubind=%s ' % cpuList
+        if numaNode is not None:
+            pinArgs += '--membind=%i ' % numaNode
+        return 'numactl', '%s%s %s' % (pinArgs, program, args)
+    return 'taskset', '-c %s %s %s' % (cpuList, program, args)
+
+
+class CoreAllocator:
+    """Hand out disjoint sets of cores to the tomograms processed at the same time. Each set is taken from a
+    single NUMA node when possible, so the threads of a program and its memory stay in the same socket. The
+    total number of cores handed out is limited by the given budget (e.g. the protocol threads)."""
+
+    def __init__(self, budget: int = None, nodes: dict = None):
+        nodes = nodes if nodes is not None else getNumaNodes()
+        pending = {node: list(cores) for node, cores in sorted(nodes.items())}
+        budget = budget or sum(len(cores) for cores in pending.values())
+        # The budget is taken from the nodes in a balanced way
+        self._nodeCores = {node: [] for node in pending}
+        while budget > 0 and any(pending.values()):
+            for node, cores in pending.items():
+                if cores and budget > 0:
+                    self._nodeCores[node].append(cores.pop(0))
+                    budget -= 1
+        self._freeCores = {node: list(cores) for node, cores in self._nodeCores.items()}
+        self._coreNodes = {core: node for node, cores in self._nodeCores.items() for core in cores}
+        self._condition = threading.Condition()
+
+    def getNumberOfCores(self) -> int:
+        return len(self._coreNodes)
+
+    def acquire(self, nCores: int) -> (int, list):
+        """Wait until nCores are free and return the NUMA node and the cores taken. If nCores is greater than
+        the cores of any node, they are taken from several nodes and the node returned is None."""
+        nCores = max(1, min(nCores, self.getNumberOfCores()))
+        fitsInANode = nCores <= max(len(cores) for cores in self._nodeCores.values())
+        with self._condition:
+            while True:
+                if fitsInANode:
+                    candidates = [node for node, cores in self._freeCores.items() if len(cores) >= nCores]
+                    if candidates:
+                        # The fullest node that can host them, to keep the others free for the next tomograms
+                        node = min(candidates, key=lambda n: len(self._freeCores[n]))
+                        return node, self._take(node, nCores)
+                elif sum(len(cores) for cores in self._freeCores.values()) >= nCores:
+                    cores = []
+                    for node in sorted(self._freeCores, key=lambda n: -len(self._freeCores[n])):
+                        cores += self._take(node, nCores - len(cores))
+                    return None, cores
+                self._condition.wait()
+
+    def release(self, cores):
+        with self._condition:
+            for core in cores:
+                self._freeCores[self._coreNodes[core]].append(core)
+            for freeCores in self._freeCores.values():
+                freeCores.sort()
+            self._condition.notify_all()
+
+    def _take(self, node: int, nCores: int) -> list:
+        cores = self._freeCores[node][:nCores]
+        self._freeCores[node] = self._freeCores[node][nCores:]
+        return cores
+
+
+def getStageWork(stage: str, nVoxels: int, mbScaleFactor=REF_MB_SCALE_FACTOR) -> float:
+    """Work of a stage in voxels. The voxels of the tensor voting stages are weighted with the cube of the voting
+    neighbourhood size, so their throughput does not depend on mbScaleFactor."""
+    if stage == 'tensorVoting':
+        return nVoxels * (float(mbScaleFactor) / REF_MB_SCALE_FACTOR) ** 3
+    return float(nVoxels)
+
+
+def getSegmentationCost(nVoxels: int, mbScaleFactor) -> float:
+    """Estimated relative cost of segmenting a tomogram, dominated by the tensor voting stages, whose cost
+    grows with the number of voxels and the cube of the voting neighbourhood size."""
+    return float(nVoxels) * float(mbScaleFactor) ** 3
+
+
+class ThreadBudget:
+    """Share a thread budget among the tomograms processed at the same time. While there are tomograms waiting,
+    each of the nSlots tomograms being processed gets minThreads. When only a few tomograms are left, the threads
+    of the idle slots are given to the remaining ones, so their programs are called with more threads."""
+
+    def __init__(self, minThreads: int, nSlots: int, nTasks: int):
+        self.minThreads = max(1, minThreads)
+        self.nSlots = max(1, nSlots)
+        self.budget = self.minThreads * self.nSlots
+        self._pending = nTasks
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._pending = max(0, self._pending - 1)
+            self._running += 1
+
+    def finish(self):
+        with self._lock:
+            self._running = max(0, self._running - 1)
+
+    def getThreads(self) -> int:
+        """Threads for the next program call of a running tomogram."""
+        with self._lock:
+            nActive = self._running + min(self._pending, max(0, self.nSlots - self._running))
+            return max(self.minThreads, self.budget // max(1, nActive))
+
+
+def getKillSignal(returnCode: int):
+    """Signal that killed a program given its return code, or None if it exited by itself. Both the code returned
+    by the subprocess module (-signal) and by a shell (128 + signal) are considered. The OOM killer sends
+    SIGKILL."""
+    if returnCode is None:
+        return None
+    if returnCode < 0:
+        signum = -returnCode
+    elif 128 < returnCode < 128 + signal.NSIG:
+        signum = returnCode - 128
+    else:
+        return None
+    try:
+        return signal.Signals(signum)
+    except ValueError:
+        return None
+
+
+class StageGate:
+    """Let the program calls of the different tomograms run at the same time (shared) unless one of them needs
+    the machine for itself (exclusive), e.g. a retry of a program killed because of the lack of memory. An
+    exclusive call waits for the running ones to finish, and no new ones start until it finishes."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._nShared = 0
+        self._nExclusiveWaiting = 0
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            while self._exclusive or self._nExclusiveWaiting:
+                self._condition.wait()
+            self._nShared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._nShared -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._nExclusiveWaiting += 1
+            while self._exclusive or self._nShared:
+                self._condition.wait()
+            self._nExclusiveWaiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+class ThroughputModel:
+    """Throughput of each stage, in voxels (see getStageWork) per second and thread, measured on the stages already
+    finished. It is used to estimate how long a stage should take, and can be saved as a calibration for later
+    executions. The calibration file keeps the rates of each host separately, as the machines sharing it (e.g.
+    through the Scipion user data directory) may be very different."""
+    MAX_SAMPLES = 50  # Per stage, to follow the changes of the machines
+
+    def __init__(self, rates: dict = None, host: str = None):
+        self._rates = rates or {}
+        self.host = host or socket.gethostname()
+        self._nSaved = {stage: len(stageRates) for stage, stageRates in self._rates.items()}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, fileName: str, host: str = None) -> 'ThroughputModel':
+        """Load the calibration of the given host (the current one by default). An empty model is returned if it
+        does not exist or cannot be read."""
+        host = host or socket.gethostname()
+        hostRates = cls._readCalibrations(fileName).get(host, {})
+        try:
+            return cls({stage: [float(rate) for rate in rates] for stage, rates in hostRates.items()}, host=host)
+        except (ValueError, AttributeError, TypeError):
+            return cls(host=host)
+
+    @staticmethod
+    def _readCalibrations(fileName: str) -> dict:
+        """Rates stored in the given file for each host."""
+        try:
+            with open(fileName) as f:
+                calibrations = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(calibrations, dict):
+            return {}
+        # Calibrations of previous versions, not referred to any host, are discarded
+        return {host: rates for host, rates in calibrations.items() if isinstance(rates, dict)}
+
+    def save(self, fileName: str):
+        """Add the rates measured since the last save to the calibration of the host stored in the given file. The
+        file is locked while it is updated, as it is shared by the protocols running at the same time."""
+        with fileLock(fileName), self._lock:
+            calibrations = self._readCalibrations(fileName)
+            stored = calibrations.setdefault(self.host, {})
+            for stage, rates in self._rates.items():
+                newRates = rates[self._nSaved.get(stage, 0):]
+                stored[stage] = (stored.get(stage, []) + newRates)[-self.MAX_SAMPLES:]
+            tmpFileName = fileName + '.tmp%i' % os.getpid()
+            with open(tmpFileName, 'w') as f:
+                json.dump(calibrations, f, indent=2)
+            os.replace(tmpFileName, fileName)
+            self._nSaved = {stage: len(rates) for stage, rates in self._rates.items()}
+
+    def record(self, stage: str, work: float, seconds: float, nThreads: int = 1):
+        if seconds > 0:
+            with self._lock:
+                self._rates.setdefault(stage, []).append(work / (seconds * max(1, nThreads)))
+
+    def getRate(self, stage: str):
+        with self._lock:
+            rates = self._rates.get(stage)
+            return median(rates) if rates else None
+
+    def getExpectedTime(self, stage: str, work: float, nThreads: int = 1):
+        """Expected duration (s) of the stage, or None if it has not been measured yet."""
+        rate = self.getRate(stage)
+        return work / (rate * max(1, nThreads)) if rate else None
+
+
+def runWithBackup(primary, backup, timeout: float) -> str:
+    """Run primary (a pair of callables run and cancel) and, if it has not finished after timeout seconds,
+    launch backup at the same time. The first one finishing successfully is kept and the other is cancelled.
+    Returns PRIMARY or BACKUP. If both fail, the error of the primary is raised."""
+    results = queue.Queue()
+
+    def target(name, run):
+        try:
+            run()
+            results.put((name, None))
+        except BaseException as e:
+            results.put((name, e))
+
+    threading.Thread(target=target, args=(PRIMARY, primary[0]), daemon=True).start()
+    try:
+        name, error = results.get(timeout=timeout)
+    except queue.Empty:
+        threading.Thread(target=target, args=(BACKUP, backup[0]), daemon=True).start()
+    else:
+        if error:
+            raise error
+        return name
+
+    errors = {}
+    for _ in range(2):
+        name, error = results.get()
+        if error is None:
+            # Cancel the other and wait for it to end, so it does not write its outputs afterwards
+            other = BACKUP if name == PRIMARY else PRIMARY
+            if other not in errors:
+                (backup if name == PRIMARY else primary)[1]()
+                results.get()
+            return name
+        errors[name] = error
+    raise errors[PRIMARY]
+
+
+def killChildProcesses(fileName: str) -> int:
+    """Kill the child processes of the current one with the given file among their arguments, e.g. the program
+    run by Protocol.runJob writing it (and the shell that launched it), which cannot be cancelled otherwise.
+    Returns the number of processes killed."""
+    import psutil  # Required by pyworkflow
+    nKilled = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if any(fileName in arg.split() for arg in child.cmdline()):
+                child.kill()
+                nKilled += 1
+        except psutil.Error:  # Already finished
+            pass
+    return nKilled
@@ -0,0 +1,384 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import importlib.util
+import os
+import queue
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+import mrcfile
+import numpy as np
+
+from tomosegmemtv.annotation import AnnotationStatusIndex, InotifyWatcher, ScanWatcher, getMaterialsFile, \
+    AnnotatorSession, AnnotationStore, getMaterialsDataFile, STORE_VAR
+from tomosegmemtv.constants import ANNOTATOR_SESSION_VAR
+from tomosegmemtv.labelling import getLabelIndexFile
+from tomosegmemtv.meshes import getMeshesFile
+
+TS_IDS = ['TS_01', 'TS_02', 'TS_03']
+EVENT_TIMEOUT = 10  # s
+HAS_SKIMAGE = importlib.util.find_spec('skimage') is not None
+
+# Stand-in of MembraneAnnotator: each tomogram annotated writes the materials file (given by outFilename)
+ANNOTATOR_SCRIPT = """#!%s
+import shlex, sys
+def annotate(args):
+    args = dict(zip(args[::2], args[1::2]))
+    open(args['outFilename'] + '_materials.mrc', 'w').close()
+with open(sys.argv[0] + '.starts', 'a') as f:
+    f.write('start\\n')
+if sys.argv[1:] != ['sessionMode']:
+    annotate(sys.argv[1:])
+elif %r:
+    print('loading runtime')
+    print('ready', flush=True)
+    for line in sys.stdin:
+        if line.strip() == 'quit':
+            break
+        annotate(shlex.split(line))
+        print('done', flush=True)
+else:
+    sys.exit('Unknown argument sessionMode')
+"""
+
+
+def writeMaterials(path, tsId):
+    os.makedirs(join(path, tsId), exist_ok=True)
+    with mrcfile.new(getMaterialsFile(path, tsId), overwrite=True) as mrc:
+        mrc.set_data(np.zeros((4, 4, 4), dtype=np.uint16))
+
+
+class TestAnnotationStatusIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(join(self.path, TS_IDS[0]))
+
+    def testScanAndPersistence(self):
+        writeMaterials(self.path, TS_IDS[0])
+        index = AnnotationStatusIndex(self.path, TS_IDS)
+        self.assertEqual((index.getNumberDone(), index.getNumberPending()), (1, 2))
+        writeMaterials(self.path, TS_IDS[2])
+        self.assertFalse(index.isDone(TS_IDS[2]))  # Not scanned yet
+        index.update()
+        self.assertEqual(index.getPending(), [TS_IDS[1]])
+
+        # The index is reloaded, dropping the annotations removed in between
+        os.remove(getMaterialsFile(self.path, TS_IDS[0]))
+        index = AnnotationStatusIndex(self.path, TS_IDS)
+        self.assertEqual(index.getPending(), TS_IDS[:2])
+
+    def _checkWatcher(self, watcherClass):
+        index = AnnotationStatusIndex(self.path, TS_IDS)
+        annotated = queue.Queue()
+        index.addListener(annotated.put)
+        index._watcher = watcherClass(index)
+        index._watcher.start()
+        try:
+            # Directory watched from the beginning and directory created afterwards
+            writeMaterials(self.path, TS_IDS[0])
+            writeMaterials(self.path, TS_IDS[1])
+            self.assertEqual(sorted(annotated.get(timeout=EVENT_TIMEOUT) for _ in range(2)), TS_IDS[:2])
+            self.assertEqual(index.getNumberPending(), 1)
+        finally:
+            index.stopWatching()
+        self.assertTrue(annotated.empty())
+
+    def testScanWatcher(self):
+        self._checkWatcher(lambda index: ScanWatcher(index, interval=0.05))
+
+    def testInotifyWatcher(self):
+        try:
+            InotifyWatcher(AnnotationStatusIndex(tempfile.mkdtemp(), TS_IDS)).stop()
+        except OSError as e:
+            self.skipTest('inotify not available: %s' % e)
+        self._checkWatcher(InotifyWatcher)
+
+
+class TestAnnotatorSession(unittest.TestCase):
+
+    def _createAnnotator(self, supportsSession):
+        self.path = tempfile.mkdtemp()
+        program = join(self.path, 'MembraneAnnotator')
+        with open(program, 'w') as f:
+            f.write(ANNOTATOR_SCRIPT % (sys.executable, supportsSession))
+        os.chmod(program, os.stat(program).st_mode | stat.S_IEXEC)
+        return program
+
+    def _getArguments(self, tsId):
+        return "inTomoFile 'tomo.mrc' outFilename '%s'" % join(self.path, tsId)
+
+    def _getNumberOfStarts(self, program):
+        with open(program + '.starts') as f:
+            return len(f.readlines())
+
+    def testWarmSession(self):
+        program = self._createAnnotator(supportsSession=True)
+        session = AnnotatorSession(program, startTimeout=EVENT_TIMEOUT)
+        try:
+            for tsId in TS_IDS:
+                self.assertTrue(session.annotate(self._getArguments(tsId)))
+                self.assertTrue(os.path.exists(join(self.path, tsId + '_materials.mrc')))
+        finally:
+            session.close()
+        self.assertEqual(self._getNumberOfStarts(program), 1)
+
+    @staticmethod
+    def _getFakeProtocol():
+        class FakeProtocol:
+            jobs = []
+
+            def runJob(self, program, arguments, env=None, cwd=None):
+                self.jobs.append(arguments)
+
+        return FakeProtocol
+
+    def testFallback(self):
+        from tomosegmemtv import Plugin
+        program = self._createAnnotator(supportsSession=False)
+        session = AnnotatorSession(program, startTimeout=EVENT_TIMEOUT)
+        self.assertFalse(session.isSupported())
+
+        FakeProtocol = self._getFakeProtocol()
+        Plugin._annotatorSession = session
+        try:
+            with mock.patch.dict(Plugin._vars, {ANNOTATOR_SESSION_VAR: '1'}):
+                for tsId in TS_IDS[:2]:
+                    Plugin.annotateTomogram(FakeProtocol(), self._getArguments(tsId))
+        finally:
+            Plugin.closeAnnotatorSession()
+        # The session mode is tried only once, then a process is launched per tomogram
+        self.assertEqual(self._getNumberOfStarts(program), 1)
+        self.assertEqual(FakeProtocol.jobs, [self._getArguments(tsId) for tsId in TS_IDS[:2]])
+
+    def testUnsupportedProbedOnce(self):
+        program = self._createAnnotator(supportsSession=False)
+        unsupportedFile = join(self.path, 'cache', 'unsupported')
+        for _ in range(2):
+            session = AnnotatorSession(program, startTimeout=EVENT_TIMEOUT, unsupportedFile=unsupportedFile)
+            self.assertFalse(session.isSupported())
+            session.close()
+        self.assertEqual(self._getNumberOfStarts(program), 1)
+
+        # An updated binary is probed again
+        with open(program, 'a') as f:
+            f.write('\n')
+        self.assertFalse(AnnotatorSession(program, startTimeout=EVENT_TIMEOUT,
+                                          unsupportedFile=unsupportedFile).isSupported())
+        self.assertEqual(self._getNumberOfStarts(program), 2)
+
+    def testSessionDisabledByDefault(self):
+        from tomosegmemtv import Plugin
+        program = self._createAnnotator(supportsSession=True)
+        FakeProtocol = self._getFakeProtocol()
+        Plugin._annotatorSession = AnnotatorSession(program, startTimeout=EVENT_TIMEOUT)
+        try:
+            with mock.patch.dict(Plugin._vars):
+                Plugin._vars.pop(ANNOTATOR_SESSION_VAR, None)
+                Plugin.annotateTomogram(FakeProtocol(), self._getArguments(TS_IDS[0]))
+        finally:
+            Plugin.closeAnnotatorSession()
+        self.assertFalse(os.path.exists(program + '.starts'))
+        self.assertEqual(FakeProtocol.jobs, [self._getArguments(TS_IDS[0])])
+
+    def testSessionRestartedInOtherDir(self):
+        from tomosegmemtv import Plugin
+        program = self._createAnnotator(supportsSession=True)
+        Plugin._annotatorSession = AnnotatorSession(program, cwd=self.path, startTimeout=EVENT_TIMEOUT)
+        otherDir = tempfile.mkdtemp()
+        try:
+            self.assertIs(Plugin.getAnnotatorSession(cwd=self.path), Plugin._annotatorSession)
+            self.assertEqual(Plugin.getAnnotatorSession(cwd=otherDir).cwd, otherDir)
+        finally:
+            Plugin.closeAnnotatorSession()
+            shutil.rmtree(otherDir, ignore_errors=True)
+
+
+class TestAnnotationStore(unittest.TestCase):
+
+    def testPutAndGet(self):
+        path = tempfile.mkdtemp()
+        store = AnnotationStore(join(path, 'store'))
+        maskFile = join(path, 'mask.mrc')
+        with open(maskFile, 'w') as f:
+            f.write('mask')
+        self.assertFalse(store.get(maskFile, path, TS_IDS[1]))
+
+        writeMaterials(path, TS_IDS[0])
+        with open(getMaterialsDataFile(path, TS_IDS[0]), 'w') as f:
+            f.write('vesicles')
+        self.assertTrue(store.put(maskFile, path, TS_IDS[0]))
+        self.assertFalse(store.put(maskFile, path, TS_IDS[0]))  # Not modified since it was stored
+
+        # Found by content, wherever the mask is
+        otherMaskFile = join(path, 'other_mask.mrc')
+        shutil.copyfile(maskFile, otherMaskFile)
+        self.assertTrue(store.get(otherMaskFile, path, TS_IDS[1]))
+        with open(getMaterialsDataFile(path, TS_IDS[1])) as f:
+            self.assertEqual(f.read(), 'vesicles')
+        self.assertFalse(store.put(otherMaskFile, path, TS_IDS[1]))
+        with open(otherMaskFile, 'w') as f:
+            f.write('new mask')
+        self.assertFalse(store.get(otherMaskFile, path, TS_IDS[2]))
+
+    def testLeastRecentlyUsedRemoved(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        masks = {}
+        for tsId in TS_IDS:
+            masks[tsId] = join(path, tsId + '_mask.mrc')
+            with open(masks[tsId], 'w') as f:
+                f.write(tsId)
+            writeMaterials(path, tsId)
+        entrySize = os.path.getsize(getMaterialsFile(path, TS_IDS[0]))
+        store = AnnotationStore(join(path, 'store'), maxSize=2.5 * entrySize)
+        store.put(masks[TS_IDS[0]], path, TS_IDS[0])
+        store.put(masks[TS_IDS[1]], path, TS_IDS[1])
+        os.utime(store._getEntryDir(store.getHash(masks[TS_IDS[1]])), (0, 0))  # Used long ago
+        self.assertTrue(store.get(masks[TS_IDS[0]], path, TS_IDS[0]))
+        # The third one does not fit, so the least recently used is removed
+        self.assertTrue(store.put(masks[TS_IDS[2]], path, TS_IDS[2]))
+        self.assertEqual([tsId for tsId in TS_IDS if store.get(masks[tsId], path, tsId)], [TS_IDS[0], TS_IDS[2]])
+
+    def testHashCache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        store = AnnotationStore(join(path, 'store'))
+        maskFile = join(path, 'mask.mrc')
+        with open(maskFile, 'w') as f:
+            f.write('mask')
+        contentHash = store.getHash(maskFile)
+        with mock.patch('tomosegmemtv.annotation.getContentHash') as getContentHash:
+            self.assertEqual(store.getHash(maskFile), contentHash)
+            getContentHash.assert_not_called()  # The unchanged masks are read only once
+        with open(maskFile, 'w') as f:
+            f.write('modified mask')
+        self.assertNotEqual(store.getHash(maskFile), contentHash)
+
+
+class TestAnnotationOutput(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here, so the rest of the tests can be run without a Scipion installation
+        import pwem
+        from pyworkflow.mapper import SqliteMapper
+        from tomo.objects import SetOfTomoMasks, TomoMask
+
+        self.path = tempfile.mkdtemp()
+        os.environ[STORE_VAR] = join(self.path, 'store')
+        self.mapper = SqliteMapper(join(self.path, 'run.db'), pwem.Domain.getMapperDict())
+        self.tomoMasks = SetOfTomoMasks.create(self.path)
+        self.tomoMasks.setSamplingRate(10)
+        for i, tsId in enumerate(TS_IDS):
+            maskFile = join(self.path, tsId + '_flt.mrc')
+            with mrcfile.new(maskFile) as mrc:
+                mrc.set_data(np.full((4, 4, 4), i, dtype=np.float32))
+            tomoMask = TomoMask()
+            tomoMask.setFileName(maskFile)
+            tomoMask.setTsId(tsId)
+            tomoMask.setSamplingRate(10)
+            self.tomoMasks.append(tomoMask)
+        self.tomoMasks.write()
+        self.mapper.insert(self.tomoMasks)
+
+    def tearDown(self):
+        os.environ.pop(STORE_VAR)
+
+    def _createProtocol(self, name, **kwargs):
+        from tomosegmemtv.protocols import ProtAnnotateMembranes
+        prot = ProtAnnotateMembranes(workingDir=join(self.path, name), mapper=self.mapper, **kwargs)
+        prot.inputTomoMasks.set(self.tomoMasks)
+        self.mapper.insert(prot)
+        os.makedirs(prot._getExtraPath())
+        prot._initialize()
+        prot.convertInputStep()
+        return prot
+
+    @staticmethod
+    def _getOutputTsIds(prot):
+        return sorted(tomoMask.getTsId() for tomoMask in prot.tomoMasks.iterItems())
+
+    def testStreamingOutput(self):
+        prot = self._createProtocol('annotation')
+        # Each annotation is added to the open output set as soon as the index gets it
+        prot._statusIndex.addListener(prot._registerAnnotated)
+        writeMaterials(prot._getExtraPath(), TS_IDS[1])
+        prot._getAnnotationStatus()
+        self.assertEqual(self._getOutputTsIds(prot), [TS_IDS[1]])
+        self.assertTrue(prot.tomoMasks.isStreamOpen())
+
+        # The output is closed when all are annotated, with no duplicates
+        for tsId in TS_IDS:
+            writeMaterials(prot._getExtraPath(), tsId)
+        prot.runMembraneAnnotator()
+        self.assertEqual(self._getOutputTsIds(prot), TS_IDS)
+        self.assertFalse(prot.tomoMasks.isStreamOpen())
+        # In annotation order
+        self.assertEqual(prot.tomoMasks.getFirstItem().getFileName(), prot._getCurrentTomoMaskFile(TS_IDS[1]))
+        # Indexed labels
+        self.assertTrue(all(os.path.exists(getLabelIndexFile(prot._getCurrentTomoMaskFile(tsId))) for tsId in TS_IDS))
+
+    def testFailedAnnotationData(self):
+        from tomosegmemtv.protocols import protocol_annotate_membranes
+        prot = self._createProtocol('annotation')
+        for tsId in TS_IDS:
+            writeMaterials(prot._getExtraPath(), tsId)
+        failingFile = prot._getCurrentTomoMaskFile(TS_IDS[0])
+        originalBuildPyramid = protocol_annotate_membranes.buildPyramid
+
+        def buildPyramid(fileName, *args, **kwargs):
+            if fileName == failingFile:
+                raise ValueError('Unreadable file')
+            return originalBuildPyramid(fileName, *args, **kwargs)
+
+        with mock.patch.object(protocol_annotate_membranes, 'buildPyramid', side_effect=buildPyramid):
+            prot.runMembraneAnnotator()
+        # The output is closed and the rest of the annotations are indexed
+        self.assertEqual(self._getOutputTsIds(prot), TS_IDS)
+        self.assertFalse(prot.tomoMasks.isStreamOpen())
+        self.assertEqual([os.path.exists(getLabelIndexFile(prot._getCurrentTomoMaskFile(tsId))) for tsId in TS_IDS],
+                         [False, True, True])
+
+    def testReusedAnnotations(self):
+        prot = self._createProtocol('annotation', reuseAnnotations=True)
+        for tsId in TS_IDS:
+            writeMaterials(prot._getExtraPath(), tsId)
+        prot.buildMeshes.set(HAS_SKIMAGE)
+        prot.runMembraneAnnotator()
+        if HAS_SKIMAGE:
+            self.assertTrue(os.path.exists(getMeshesFile(prot._getCurrentTomoMaskFile(TS_IDS[0]))))
+
+        # A new protocol with the same masks gets their annotations without opening the annotator
+        newProt = self._createProtocol('annotation_2', reuseAnnotations=True)
+        self.assertEqual(newProt._reusedAnnotations.get(), len(TS_IDS))
+        newProt.runMembraneAnnotator()
+        self.assertEqual(self._getOutputTsIds(newProt), TS_IDS)
+        self.assertFalse(newProt.tomoMasks.isStreamOpen())
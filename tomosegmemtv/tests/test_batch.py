@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os import listdir
+from os.path import join
+from unittest import mock
+
+import numpy as np
+
+from tomosegmemtv import batch, pipeline
+from tomosegmemtv.constants import DT_VOTING, SURFACENESS
+
+TOMO_SHAPE = (8, 6, 4)
+
+
+def runProgram(program, args, cwd=None, stdout=None):
+    """Stand-in of the TomoSegMemTV programs: each call adds 1 to the input volume."""
+    tokens = shlex.split(args)
+    inFile, outFile = tokens[-4], tokens[-3]  # ... inFile outFile -t nThreads
+    pipeline.writeMrc(np.asarray(pipeline.loadMmap(inFile)) + 1, outFile)
+
+
+def runProgramNoMembranes(program, args, cwd=None, stdout=None):
+    """Stand-in whose surfaceness maps are empty."""
+    tokens = shlex.split(args)
+    if program == SURFACENESS:
+        pipeline.writeMrc(np.zeros(TOMO_SHAPE, dtype=np.float32), tokens[-3])
+    else:
+        runProgram(program, args)
+
+
+def runProgramKilled(program, args, cwd=None, stdout=None):
+    if program == DT_VOTING:
+        raise subprocess.CalledProcessError(-9, program)
+    runProgram(program, args)
+
+
+class TestBatch(unittest.TestCase):
+    """The CLI run with the programs replaced by a stand-in. The workers are forked, so they see it too."""
+
+    def setUp(self):
+        self.inDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.inDir, ignore_errors=True)
+        self.outDir = join(self.inDir, 'out')
+        for tsId in ['TS_01', 'TS_02']:
+            pipeline.writeMrc(np.zeros(TOMO_SHAPE, dtype=np.float32), join(self.inDir, tsId + '.mrc'))
+
+    def _runBatch(self, runner, *args) -> (int, dict):
+        with mock.patch.object(pipeline, 'runProgram', runner), \
+                mock.patch.object(pipeline, 'registerPlugin', lambda: None):
+            exitCode = batch.main([self.inDir, self.outDir, '--jobs', '2', '--threads', '2', *args])
+        with open(join(self.outDir, batch.MANIFEST)) as f:
+            return exitCode, json.load(f)
+
+    def testSegmentation(self):
+        exitCode, manifest = self._runBatch(runProgram, '--binning', '2')
+        self.assertEqual(exitCode, 0)
+        self.assertEqual(sorted(listdir(self.outDir)),
+                         ['TS_01.log', 'TS_01_flt.mrc', 'TS_02.log', 'TS_02_flt.mrc', batch.MANIFEST])
+        for entry in manifest['tomograms']:
+            self.assertEqual(entry['status'], 'done')
+            self.assertEqual(list(entry['stages']), ['scaleSpace', 'tensorVoting', 'surfaceness', 'tensorVoting_2',
+                                                     'saliency'])
+            self.assertFalse(entry['isEmpty'])
+            # Each of the 5 programs adds 1, and the output is upsampled to the size of the tomogram
+            flt = np.asarray(pipeline.loadMmap(join(self.outDir, entry['tsId'] + '_flt.mrc')))
+            self.assertEqual(flt.shape, TOMO_SHAPE)
+            self.assertTrue(np.allclose(flt, 5))
+
+    def testEmptyTomogramsAborted(self):
+        exitCode, manifest = self._runBatch(runProgramNoMembranes, '--mbStrengthThMode', 'otsu')
+        self.assertEqual(exitCode, 0)
+        for entry in manifest['tomograms']:
+            self.assertTrue(entry['isEmpty'])
+            self.assertEqual(list(entry['stages']), ['scaleSpace', 'tensorVoting', 'surfaceness'])
+            self.assertFalse(np.any(pipeline.loadMmap(join(self.outDir, entry['tsId'] + '_flt.mrc'))))
+
+    def testFailedTomograms(self):
+        exitCode, manifest = self._runBatch(runProgramKilled)
+        self.assertEqual(exitCode, 1)
+        for entry in manifest['tomograms']:
+            self.assertEqual(entry['status'], 'failed')
+            self.assertTrue(entry['error'].startswith('tensorVoting: '))
+
+    def testBinnedIntoInputDir(self):
+        with mock.patch.object(pipeline, 'registerPlugin', lambda: None):
+            self.assertEqual(batch.main([self.inDir, self.inDir, '--binning', '2']), 1)
+        self.assertEqual(sorted(listdir(self.inDir)), ['TS_01.mrc', 'TS_02.mrc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import subprocess
+import tempfile
+import unittest
+
+from tomosegmemtv.executors import LocalExecutor, ProcessExecutor, SshExecutor
+
+# Stand-in of ssh that runs the remote command locally: fakessh host cmd
+FAKE_SSH = "sh -c 'eval \"$2\"' fakessh"
+
+
+def getPid(x):
+    return os.getpid(), x * 2
+
+
+def failingTask():
+    raise ValueError('failed in the worker')
+
+
+class TestExecutors(unittest.TestCase):
+
+    def testLocalExecutor(self):
+        result = LocalExecutor().submit(getPid, 2).result()
+        self.assertEqual(result.value, (os.getpid(), 4))
+        self.assertIn(str(os.getpid()), result.worker)
+        with self.assertRaises(ValueError):
+            LocalExecutor().submit(failingTask).result()
+
+    def testProcessExecutor(self):
+        executor = ProcessExecutor(nWorkers=2)
+        try:
+            results = [future.result() for future in [executor.submit(getPid, i) for i in range(6)]]
+        finally:
+            executor.shutdown()
+        self.assertEqual([result.value[1] for result in results], [0, 2, 4, 6, 8, 10])
+        self.assertNotIn(os.getpid(), [result.value[0] for result in results])
+        # Each result is tagged with the worker process that computed it
+        for result in results:
+            self.assertTrue(result.worker.endswith(':%i' % result.value[0]))
+
+    def testSshExecutor(self):
+        workDir = tempfile.mkdtemp()
+        executor = SshExecutor(['node1:2', 'node2'], workDir, sshCmd=FAKE_SSH)
+        # Run by a fresh interpreter, which must be able to import this module
+        env = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))), env]))
+        try:
+            results = [future.result() for future in [executor.submit(getPid, i) for i in range(4)]]
+            with self.assertRaises(ValueError):
+                executor.submit(failingTask).result()
+        finally:
+            executor.shutdown()
+            if env is None:
+                os.environ.pop('PYTHONPATH')
+            else:
+                os.environ['PYTHONPATH'] = env
+        self.assertEqual([result.value[1] for result in results], [0, 2, 4, 6])
+        self.assertTrue({result.worker for result in results} <= {'node1', 'node2'})
+        self.assertEqual(os.listdir(workDir), [])
+
+    def testSshExecutorFailedConnection(self):
+        workDir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, workDir)
+        executor = SshExecutor(['node1'], workDir, sshCmd='false')
+        try:
+            with self.assertRaises(subprocess.CalledProcessError):
+                executor.submit(getPid, 1).result()
+        finally:
+            executor.shutdown()
+        # The pickled task is removed although it was not run
+        self.assertEqual(os.listdir(workDir), [])
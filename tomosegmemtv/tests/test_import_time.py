@@ -0,0 +1,65 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import subprocess
+import sys
+import unittest
+
+# Plugin modules that must not be loaded by a headless worker
+GUI_MODULES = ['tomosegmemtv.viewers_interactive.memb_annotator_tomo_viewer',
+               'tomosegmemtv.viewers_interactive.memb_annotator_tree',
+               'tomosegmemtv.viewers.annotation_results_viewer']
+# Dependencies loaded on demand, which the modules run by the workers must not import
+LAZY_MODULES = ['mrcfile', 'scipy', 'skimage', 'tkinter', 'pyworkflow.gui']
+
+PROTOCOLS_SCRIPT = """
+import json, sys
+import pwem.protocols, tomo.objects
+import tomosegmemtv.protocols
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % GUI_MODULES
+
+WORKER_SCRIPT = """
+import json, sys
+import tomosegmemtv.executors, tomosegmemtv.pipeline
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % LAZY_MODULES
+
+
+def getLoadedModules(script: str) -> list:
+    # Fresh interpreter, so the modules loaded by other tests do not count
+    output = subprocess.check_output([sys.executable, '-c', script], text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestImportTime(unittest.TestCase):
+    """The modules loaded are checked instead of the time spent importing them, which depends on the machine."""
+
+    def testProtocolsImport(self):
+        self.assertEqual(getLoadedModules(PROTOCOLS_SCRIPT), [], 'GUI modules loaded when importing the protocols')
+
+    def testWorkerImport(self):
+        self.assertEqual(getLoadedModules(WORKER_SCRIPT), [], 'Modules loaded when importing the worker modules')
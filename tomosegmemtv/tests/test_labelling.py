@@ -0,0 +1,204 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import tempfile
+import unittest
+import time
+from os.path import join
+
+import mrcfile
+import numpy as np
+from scipy.ndimage import label, generate_binary_structure
+
+from tomosegmemtv import pipeline
+from tomosegmemtv.annotation import getMaterialsFile
+from tomosegmemtv.labelling import labelComponents, UnionFind, LabelIndex, getLabelIndex, getLabelIndexFile
+
+
+def writeVolume(fileName, data):
+    with mrcfile.new(fileName, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = 10
+    return fileName
+
+
+class TestLabelling(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def testUnionFind(self):
+        unionFind = UnionFind(3)
+        unionFind.extend(4)
+        unionFind.union(5, 2)
+        unionFind.union(6, 5)
+        unionFind.union(1, 3)
+        self.assertEqual(len(unionFind), 7)
+        self.assertEqual(unionFind.getRoots().tolist(), [0, 1, 2, 1, 4, 2, 2])
+
+    def testSameAsWholeVolume(self):
+        data = np.random.default_rng(0).random((30, 20, 20)).astype(np.float32)
+        fileName = writeVolume(join(self.path, 'tomo_flt.mrc'), data)
+        outFile = join(self.path, 'tomo_materials.mrc')
+        for connectivity in [1, 2, 3]:
+            # Slabs smaller than most of the components, so many of them are merged across the slab borders
+            sizes = labelComponents(fileName, outFile, 0.7, minSize=4, connectivity=connectivity, slabSize=3)
+            expected, _ = label(data > 0.7, generate_binary_structure(3, connectivity))
+            expectedSizes = np.bincount(expected.ravel())[1:]
+            expectedSizes = expectedSizes[expectedSizes >= 4]
+            with mrcfile.open(outFile, permissive=True) as mrc:
+                labels = mrc.data.copy()
+                self.assertEqual(float(mrc.voxel_size.x), 10)
+            self.assertEqual(labels.dtype, np.uint16)
+            self.assertEqual(sorted(sizes, reverse=True), sorted(expectedSizes, reverse=True))
+            self.assertEqual(np.bincount(labels.ravel())[1:].tolist(), sizes.tolist())
+            # Same partition: one to one correspondence between the labels and the expected ones
+            inLabels = labels > 0
+            pairs = set(zip(labels[inLabels].tolist(), expected[inLabels].tolist()))
+            self.assertEqual(len(pairs), len(sizes))
+            self.assertEqual(len({pair[1] for pair in pairs}), len(sizes))
+        self.assertEqual(sorted(os.listdir(self.path)), ['tomo_flt.mrc', 'tomo_materials.mrc'])
+
+    def testSizeFilterAndOrder(self):
+        data = np.zeros((12, 10, 10), dtype=np.float32)
+        data[1:3, 1:3, 1:3] = 1  # 8 voxels
+        data[0:12, 6, 6] = 1  # 12 voxels, across all the slabs
+        data[9, 1, 1] = 1  # 1 voxel
+        fileName = writeVolume(join(self.path, 'tomo_flt.mrc'), data)
+        outFile = join(self.path, 'tomo_materials.mrc')
+        sizes = labelComponents(fileName, outFile, 0.5, minSize=2, slabSize=4)
+        self.assertEqual(sizes.tolist(), [12, 8])
+        labels = mrcfile.read(outFile)
+        self.assertTrue(np.all(labels[:, 6, 6] == 1))
+        self.assertTrue(np.all(labels[1:3, 1:3, 1:3] == 2))
+        self.assertEqual(labels[9, 1, 1], 0)
+
+
+class TestLabelIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.data = np.zeros((17, 23, 29), dtype=np.uint16)
+        for material in [1, 2, 3, 7]:
+            z, y, x = rng.integers(0, 12), rng.integers(0, 18), rng.integers(0, 24)
+            self.data[z:z + 5, y:y + 5, x:x + 5][rng.random((5, 5, 5)) < 0.5] = material
+        self.fileName = writeVolume(join(self.path, 'TS_01_materials.mrc'), self.data)
+
+    def _assertSameIndex(self, index, expected):
+        self.assertEqual(index.shape, expected.shape)
+        for attrName in ['labels', 'counts', 'bboxes', 'deltas']:
+            np.testing.assert_array_equal(getattr(index, attrName), getattr(expected, attrName))
+
+    def testIndex(self):
+        index = getLabelIndex(self.fileName, slabSize=4)
+        self.assertTrue(os.path.exists(getLabelIndexFile(self.fileName)))
+        self.assertEqual(index.getLabels(), [1, 2, 3, 7])
+        for material in index.getLabels():
+            np.testing.assert_array_equal(index.getCoordinates(material), np.argwhere(self.data == material))
+            self.assertEqual(index.getCount(material), np.count_nonzero(self.data == material))
+            mask, origin = index.getMask(material, margin=1)
+            np.testing.assert_array_equal(mask, self.data[index.getSlices(material, margin=1)] == material)
+            self.assertEqual(origin, tuple(max(0, o - 1) for o in index.getBoundingBox(material)[0]))
+        with self.assertRaises(KeyError):
+            index.getCount(4)
+
+        # The saved index is used while the volume does not change
+        self._assertSameIndex(LabelIndex.load(getLabelIndexFile(self.fileName)), index)
+        time.sleep(0.01)
+        self.data[self.data == 7] = 0
+        writeVolume(self.fileName, self.data)
+        self.assertEqual(getLabelIndex(self.fileName).getLabels(), [1, 2, 3])
+
+    def testResized(self):
+        index = LabelIndex.build(self.fileName)
+        for outShape in [(34, 46, 58), (9, 11, 14), (20, 13, 40)]:
+            resizedFile = join(self.path, 'resized.mrc')
+            pipeline.resize(self.fileName, outShape, order=0, outFile=resizedFile)
+            self._assertSameIndex(index.resized(outShape), LabelIndex.build(resizedFile))
+
+    def testResizeProtocolIndex(self):
+        from tomosegmemtv.protocols import ProtResizeSegmentedVolume
+        resizedFile = join(self.path, 'TS_01.mrc')
+        pipeline.resize(self.fileName, (34, 46, 58), order=0, outFile=resizedFile)
+        # Label volumes not indexed are indexed
+        ProtResizeSegmentedVolume._resizeLabelIndex(self.fileName, resizedFile)
+        expected = LabelIndex.load(getLabelIndexFile(resizedFile))
+        self._assertSameIndex(expected, LabelIndex.build(resizedFile))
+        # The index of the input volume is carried over
+        os.remove(getLabelIndexFile(resizedFile))
+        getLabelIndex(self.fileName)
+        ProtResizeSegmentedVolume._resizeLabelIndex(self.fileName, resizedFile)
+        self._assertSameIndex(LabelIndex.load(getLabelIndexFile(resizedFile)), expected)
+
+
+class TestLabelMembranes(unittest.TestCase):
+
+    def testProtocol(self):
+        # Imported here, so the rest of the tests can be run without a Scipion installation
+        import pwem
+        from pyworkflow.mapper import SqliteMapper
+        from tomo.objects import SetOfTomoMasks, TomoMask
+        from tomosegmemtv.constants import LABEL_TH_MANUAL
+        from tomosegmemtv.protocols import ProtLabelMembranes
+
+        path = tempfile.mkdtemp()
+        mapper = SqliteMapper(join(path, 'run.db'), pwem.Domain.getMapperDict())
+        tomoMasks = SetOfTomoMasks.create(path)
+        tomoMasks.setSamplingRate(10)
+        for nPlanes, tsId in enumerate(['TS_01', 'TS_02'], start=1):
+            data = np.zeros((16, 8, 8), dtype=np.float32)
+            data[2:2 + 4 * nPlanes:4] = 1  # Membranes: planes separated by background
+            tomoMask = TomoMask()
+            tomoMask.setFileName(writeVolume(join(path, tsId + '_flt.mrc'), data))
+            tomoMask.setVolName(join(path, tsId + '.mrc'))
+            tomoMask.setTsId(tsId)
+            tomoMask.setSamplingRate(10)
+            tomoMasks.append(tomoMask)
+        tomoMasks.write()
+        mapper.insert(tomoMasks)
+
+        prot = ProtLabelMembranes(workingDir=join(path, 'labelling'), mapper=mapper)
+        prot.inTomoMasks.set(tomoMasks)
+        prot.thresholdMode.set(LABEL_TH_MANUAL)
+        prot.threshold.set(0.5)
+        prot.minSize.set(10)
+        mapper.insert(prot)
+        os.makedirs(prot._getExtraPath())
+        prot._initialize()
+        for tsId in prot.tomoMaskDict:
+            prot.labelStep(tsId)
+            prot.createOutputStep(tsId)
+
+        outTomoMasks = {tomoMask.getTsId(): tomoMask.clone() for tomoMask in prot.tomoMasks}
+        for nPlanes, tsId in enumerate(['TS_01', 'TS_02'], start=1):
+            tomoMask = outTomoMasks[tsId]
+            # Same layout of the annotated TomoMasks
+            self.assertEqual(tomoMask.getFileName(), getMaterialsFile(prot._getExtraPath(), tsId))
+            self.assertEqual(tomoMask.getVolName(), join(path, tsId + '.mrc'))
+            self.assertEqual(tomoMask._nMembranes.get(), nPlanes)
+            self.assertEqual(np.unique(mrcfile.read(tomoMask.getFileName())).tolist(), list(range(nPlanes + 1)))
+            self.assertEqual(getLabelIndex(tomoMask.getFileName()).getNumberOfLabels(), nPlanes)
@@ -0,0 +1,91 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import importlib.util
+import tempfile
+import unittest
+from collections import Counter
+from os.path import join, getmtime
+
+import mrcfile
+import numpy as np
+
+from tomosegmemtv.meshes import getMeshes, getMeshesFile, decimateMesh
+
+HAS_SKIMAGE = importlib.util.find_spec('skimage') is not None
+
+
+def getOpenEdges(faces) -> int:
+    """Edges not shared by exactly two faces, zero for a closed surface."""
+    edges = Counter(tuple(sorted(edge)) for face in faces for edge in ((face[0], face[1]), (face[1], face[2]),
+                                                                         (face[2], face[0])))
+    return sum(count != 2 for count in edges.values())
+
+
+@unittest.skipUnless(HAS_SKIMAGE, 'scikit-image is not installed')
+class TestMeshes(unittest.TestCase):
+
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        z, y, x = np.mgrid[:40, :32, :32]
+        r = np.sqrt((z - 20) ** 2 + (y - 16) ** 2 + (x - 16) ** 2)
+        self.labels = np.zeros((40, 32, 32), dtype=np.uint16)
+        self.labels[(r > 8) & (r < 11)] = 1  # Vesicle
+        self.labels[2:6, 2:30, 2:5] = 2  # Box touching several slabs
+        self.fileName = join(self.testDir, 'TS_01_materials.mrc')
+        with mrcfile.new(self.fileName) as mrc:
+            mrc.set_data(self.labels)
+
+    def testLabelMeshes(self):
+        meshes = getMeshes(self.fileName, maxTriangles=10 ** 6, slabSize=8)
+        self.assertEqual(sorted(meshes), [1, 2])
+        for verts, faces in meshes.values():
+            # The seams between slabs are welded, so the surfaces are closed
+            self.assertEqual(getOpenEdges(faces), 0)
+        verts = meshes[2][0]
+        np.testing.assert_allclose(verts.min(axis=0), [1.5, 1.5, 1.5])  # x, y, z
+        np.testing.assert_allclose(verts.max(axis=0), [4.5, 29.5, 5.5])
+
+        # Cached until the volume is modified or the parameters change
+        mtime = getmtime(getMeshesFile(self.fileName))
+        getMeshes(self.fileName, maxTriangles=10 ** 6, slabSize=8)
+        self.assertEqual(getmtime(getMeshesFile(self.fileName)), mtime)
+        decimated = getMeshes(self.fileName, maxTriangles=500, slabSize=8)
+        self.assertLessEqual(len(decimated[1][1]), 500)
+
+    def testThresholdedMap(self):
+        fltFile = join(self.testDir, 'TS_01_flt.mrc')
+        with mrcfile.new(fltFile) as mrc:
+            mrc.set_data((self.labels == 1).astype(np.float32) * 0.8)
+        meshes = getMeshes(fltFile, threshold=0.5, slabSize=16)
+        self.assertEqual(list(meshes), [1])
+        self.assertEqual(getOpenEdges(meshes[1][1]), 0)
+
+    def testDecimation(self):
+        verts = np.random.default_rng(0).random((3000, 3)) * 50
+        faces = np.arange(3000).reshape(-1, 3)
+        newVerts, newFaces = decimateMesh(verts, faces, maxTriangles=200)
+        self.assertLessEqual(len(newFaces), 200)
+        self.assertEqual(newFaces.max(), len(newVerts) - 1)
@@ -0,0 +1,97 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import unittest
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+
+class TestPagedTree(unittest.TestCase):
+
+    def setUp(self):
+        # Imported here, so the rest of the tests can be run without a Scipion installation
+        from tomo.objects import SetOfTomoMasks, TomoMask
+
+        testDir = tempfile.mkdtemp()
+        stubFile = join(testDir, 'stub.mrc')
+        with mrcfile.new(stubFile) as mrc:
+            mrc.set_data(np.zeros((4, 4, 4), dtype=np.float32))
+        self.sets = []
+        self.tsIds = []
+        for i, size in enumerate([5, 7]):
+            tomoMasks = SetOfTomoMasks.create(testDir, suffix=str(i))
+            for j in range(size):
+                tomoMask = TomoMask()
+                tomoMask.setFileName(stubFile)
+                tomoMask.setVolName(join(testDir, 'TS_%i%i.mrc' % (i, j)))
+                tomoMask.setTsId('TS_%i%i' % (i, j))
+                tomoMasks.append(tomoMask)
+                self.tsIds.append(tomoMask.getTsId())
+            tomoMasks.write()
+            self.sets.append(tomoMasks)
+
+    def testPagedSet(self):
+        from tomosegmemtv.viewers_interactive.paged_tree import PagedSet
+        pagedSet = PagedSet(*self.sets, pageSize=4, maxCachedPages=2)
+        self.assertEqual(len(pagedSet), 12)
+        self.assertEqual(pagedSet.getNumberOfPages(), 3)
+        self.assertEqual(pagedSet._pages, {})  # Nothing read until an item is required
+        # The second page spans both sets
+        self.assertEqual([tomoMask.getTsId() for tomoMask in pagedSet.getPage(1)], self.tsIds[4:8])
+        self.assertEqual(pagedSet[-1].getTsId(), self.tsIds[-1])
+        self.assertEqual([tomoMask.getTsId() for tomoMask in pagedSet], self.tsIds)
+        self.assertEqual(list(pagedSet._pages), [1, 2])
+
+    def testPagedProvider(self):
+        from tomosegmemtv.viewers.memb_annotator_results_tree import MembAnnotatorResultsProvider
+        from tomosegmemtv.viewers_interactive.paged_tree import PagedSet
+        provider = MembAnnotatorResultsProvider(PagedSet(*self.sets, pageSize=5), None, None, pageSize=5)
+        self.assertEqual(provider.getNumberOfPages(), 3)
+        self.assertEqual([provider.getObjectInfo(tomoMask)['key'] for tomoMask in provider.getObjects()],
+                         [tsId + '_materials.mrc' for tsId in self.tsIds[:5]])
+        self.assertTrue(provider.setPage(5))
+        self.assertEqual(provider.getPage(), 2)
+        self.assertEqual(len(provider.getObjects()), 2)
+        self.assertFalse(provider.setPage(2))
+
+        # The row info is computed once per tsId, until it is invalidated
+        tomoMask = provider.getObjects()[0]
+        info = provider.getObjectInfo(tomoMask)
+        self.assertIs(provider.getObjectInfo(tomoMask), info)
+        provider.invalidate(tomoMask.getTsId())
+        self.assertIsNot(provider.getObjectInfo(tomoMask), info)
+
+    def testObjectInfoRequired(self):
+        from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
+        from tomosegmemtv.viewers_interactive.paged_tree import PagedTreeProvider
+
+        class Provider(PagedTreeProvider, TomogramsTreeProvider):
+            pass
+
+        with self.assertRaises(TypeError):
+            Provider([], None, None)
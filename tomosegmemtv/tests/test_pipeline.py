@@ -0,0 +1,157 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import shlex
+import tempfile
+import unittest
+from unittest import mock
+from os import listdir
+from os.path import join
+
+import numpy as np
+
+from tomosegmemtv import pipeline
+from tomosegmemtv.constants import SCALE_SPACE, DT_VOTING, SURFACENESS, MB_STRENGTH_TH_MANUAL
+
+
+class FakeRunner:
+    """Stand-in of the TomoSegMemTV programs: each call adds 1 to the input volume."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, program, args):
+        tokens = shlex.split(args)
+        inFile, outFile = tokens[-4], tokens[-3]  # ... inFile outFile -t nThreads
+        self.calls.append((program, args))
+        pipeline.writeMrc(np.asarray(pipeline.loadMmap(inFile)) + 1, outFile)
+
+
+class SmoothingRunner(FakeRunner):
+    """Stand-in whose output depends on the neighbourhood: moving average of 2 * radius + 1 slices along Z."""
+
+    def __init__(self, radius):
+        super().__init__()
+        self.radius = radius
+
+    def __call__(self, program, args):
+        tokens = shlex.split(args)
+        data = np.asarray(pipeline.loadMmap(tokens[-4]))
+        padded = np.pad(data, ((self.radius, self.radius), (0, 0), (0, 0)), mode='edge')
+        smoothed = np.mean([padded[i:i + data.shape[0]] for i in range(2 * self.radius + 1)], axis=0)
+        self.calls.append((program, args))
+        pipeline.writeMrc(smoothed, tokens[-3])
+
+
+class TestPipeline(unittest.TestCase):
+
+    def testStagesAcceptArraysAndReturnMmaps(self):
+        runner = FakeRunner()
+        workDir = tempfile.mkdtemp()
+        data = np.zeros((6, 5, 4), dtype=np.float32)
+        s2 = pipeline.scaleSpace(data, 3, nThreads=2, workDir=workDir, runner=runner)
+        self.assertIsInstance(s2, np.memmap)
+        self.assertTrue(np.all(s2 == 1))
+        # A memory-map of a whole MRC file is passed to the program without being copied
+        tv = pipeline.tensorVoting(s2, 10, outFile=join(workDir, 'tv.mrc'), runner=runner)
+        self.assertTrue(np.all(tv == 2))
+        self.assertIn(s2.filename, runner.calls[-1][1])
+        self.assertEqual(runner.calls[0][1], pipeline.getScaleSpaceArgs(join(workDir, 'scale_space_in.mrc'),
+                                                                        join(workDir, 'scale_space.mrc'), 3, 2))
+        # The arrays and outputs are not written into temporary directories that would be left behind
+        with self.assertRaises(ValueError):
+            pipeline.scaleSpace(data, 3, runner=runner)
+        with self.assertRaises(ValueError):
+            pipeline.tensorVoting(s2, 10, runner=runner)
+
+    def testLazyPipeline(self):
+        runner = FakeRunner()
+        workDir = tempfile.mkdtemp()
+        outFile = join(workDir, 'tomo_flt.mrc')
+        chain = (pipeline.Pipeline(np.zeros((6, 5, 4), dtype=np.float32), nThreads=4, workDir=workDir,
+                                   runner=runner)
+                 .scaleSpace(mbThkPix=2)
+                 .tensorVoting(mbScaleFactor=10)
+                 .surfaceness(mbStrengthTh=0.3)
+                 .tensorVoting(mbScaleFactor=10, whiteOverBlack=True)
+                 .saliency(sigmaS=1, sigmaP=0)
+                 .resize((12, 10, 8), order=0))
+        self.assertEqual(runner.calls, [])  # Nothing is executed until run is called
+
+        flt = chain.run(outFile)
+        self.assertEqual([call[0] for call in runner.calls],
+                         [SCALE_SPACE, DT_VOTING, SURFACENESS, DT_VOTING, SURFACENESS])
+        self.assertEqual(flt.shape, (12, 10, 8))
+        self.assertTrue(np.all(flt == 5))
+        # Only the input written from the array and the result are kept
+        self.assertEqual(sorted(listdir(workDir)), ['scale_space_in.mrc', 'tomo_flt.mrc'])
+
+    def testPipelineIntermediatesInMemory(self):
+        runner = FakeRunner()
+        workDir = tempfile.mkdtemp()
+        shmDir = tempfile.mkdtemp()
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline(np.zeros((6, 5, 4), dtype=np.float32), workDir=None)
+        with mock.patch.object(pipeline, 'SHM_DIR', shmDir):
+            flt = (pipeline.Pipeline(np.zeros((6, 5, 4), dtype=np.float32), workDir=workDir, inMemory=True,
+                                     runner=runner)
+                   .scaleSpace(mbThkPix=2)
+                   .tensorVoting(mbScaleFactor=10)
+                   .run())
+        self.assertTrue(np.all(flt == 2))
+        # Only the result is kept, and the temporary directory in shared memory is removed
+        self.assertEqual(listdir(workDir), ['01_tensorVoting.mrc'])
+        self.assertEqual(listdir(shmDir), [])
+
+    def testTiledStage(self):
+        workDir = tempfile.mkdtemp()
+        data = np.random.default_rng(0).random((40, 6, 5)).astype(np.float32)
+        whole = pipeline.tensorVoting(data, 10, workDir=workDir, runner=SmoothingRunner(2))
+        runner = SmoothingRunner(2)
+        tiled = pipeline.runTiled(pipeline.tensorVoting, data, nTiles=4, halo=2, outFile=join(workDir, 'tiled.mrc'),
+                                  workDir=workDir, mbScaleFactor=10, runner=runner)
+        self.assertEqual(len(runner.calls), 4)
+        np.testing.assert_allclose(tiled, whole, rtol=1e-5)
+        self.assertFalse([fileName for fileName in listdir(workDir) if fileName.startswith('tiles_')])
+
+    def testSegmentTomogram(self):
+        runner = FakeRunner()
+        workDir = tempfile.mkdtemp()
+        tomoFile = pipeline.writeMrc(np.zeros((6, 5, 4), dtype=np.float32), join(workDir, 'tomo.mrc'))
+        params = {'mbThkPix': 2, 'mbThkCandidates': None, 'blackOverWhite': True, 'mbScaleFactor': 10,
+                  'mbStrengthThMode': MB_STRENGTH_TH_MANUAL, 'mbStrengthTh': 0.3, 'mbStrengthPercentile': 90,
+                  'minMembFraction': 1e-4, 'sigmaS': 1, 'sigmaP': 0}
+        stages = []
+
+        def runStage(stage, *args, **kwargs):
+            stages.append(stage.__name__)
+            return stage(*args, nThreads=2, runner=runner, **kwargs)
+
+        results = pipeline.segmentTomogram(tomoFile, workDir, params, runStage=runStage)
+        self.assertEqual(stages, ['scaleSpace', 'tensorVoting', 'surfaceness', 'tensorVoting', 'saliency'])
+        self.assertEqual(results['output'], join(workDir, 'tomo_flt.mrc'))
+        self.assertFalse(results['isEmpty'])
+        self.assertIsNone(results['surfTh'])  # Only determined in the automatic modes
+        self.assertTrue(np.all(pipeline.loadMmap(results['output']) == 5))
@@ -0,0 +1,79 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import unittest
+from os.path import join
+
+from tomosegmemtv.planner import planSegmentation, planResize, checkResources, Plan, FLOAT_BYTES, STAGE_RAM, \
+    DEFAULT_THROUGHPUT
+from tomosegmemtv.scheduling import ThroughputModel
+
+TOMO_DIMS = {'big': (200, 200, 100), 'small1': (100, 100, 50), 'small2': (100, 100, 50)}
+
+
+class TestPlanner(unittest.TestCase):
+
+    def testSegmentationPlan(self):
+        plan = planSegmentation(TOMO_DIMS, nSlots=2, nThreads=4, mbScaleFactor=10)
+        bigVoxels = 200 * 200 * 100
+        smallVoxels = 100 * 100 * 50
+        self.assertEqual([step['stage'] for step in plan.tomos[0]['steps'][1:-1]],
+                         ['scaleSpace', 'tensorVoting', 'surfaceness', 'tensorVoting', 'saliency'])
+        # The big one and a small one running the tensor voting at the same time
+        self.assertEqual(plan.getPeakRam(), STAGE_RAM['tensorVoting'] * (bigVoxels + smallVoxels))
+        # The intermediates are only needed while processing them
+        self.assertEqual(plan.getDisk(), FLOAT_BYTES * (bigVoxels + 2 * smallVoxels + 4 * (bigVoxels + smallVoxels)))
+        keepAllPlan = planSegmentation(TOMO_DIMS, nSlots=2, nThreads=4, mbScaleFactor=10, keepAllFiles=True)
+        self.assertEqual(keepAllPlan.getDisk(), FLOAT_BYTES * 5 * (bigVoxels + 2 * smallVoxels))
+        # Largest first: the small ones are processed one after the other in the second slot
+        self.assertAlmostEqual(plan.getWallTime(), plan.getTomoTime(plan.tomos[0]))
+
+    def testCalibrationAndBinning(self):
+        calibrationFile = join(tempfile.mkdtemp(), 'calibration.json')
+        model = ThroughputModel()
+        model.record('tensorVoting', DEFAULT_THROUGHPUT['tensorVoting'] * 2, 1)  # Twice the default throughput
+        model.save(calibrationFile)
+        model.save(calibrationFile)  # Already saved rates are not added twice
+        calibrated = ThroughputModel.load(calibrationFile)
+        self.assertEqual(calibrated.getRate('tensorVoting'), DEFAULT_THROUGHPUT['tensorVoting'] * 2)
+
+        dims = {'tomo': (200, 200, 100)}
+        plan = planSegmentation(dims, nSlots=1, nThreads=1, mbScaleFactor=10)
+        calibratedPlan = planSegmentation(dims, nSlots=1, nThreads=1, mbScaleFactor=10, throughput=calibrated)
+        votingTime = lambda p: sum(step['time'] for step in p.tomos[0]['steps'] if step['stage'] == 'tensorVoting')
+        self.assertAlmostEqual(votingTime(calibratedPlan), votingTime(plan) / 2)
+        binnedPlan = planSegmentation(dims, nSlots=1, nThreads=1, mbScaleFactor=10, binning=2)
+        self.assertLess(binnedPlan.getPeakRam(), plan.getPeakRam())
+
+    def testResizePlanAndResources(self):
+        plan = planResize({'tomo': ((100, 100, 50), (200, 200, 100))}, nSlots=1)
+        self.assertEqual(plan.getDisk(), FLOAT_BYTES * 200 * 200 * 100)
+        planFile = join(tempfile.mkdtemp(), 'plan.json')
+        plan.save(planFile)
+        self.assertEqual(Plan.load(planFile).getSummary(), plan.getSummary())
+        self.assertEqual(checkResources(plan, tempfile.gettempdir()), [])
+        hugePlan = planResize({'tomo': ((100, 100, 50), (10 ** 5, 10 ** 5, 10 ** 4))}, nSlots=1)
+        self.assertEqual(len(checkResources(hugePlan, tempfile.gettempdir())), 2)
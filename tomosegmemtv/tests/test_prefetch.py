@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import tempfile
+import time
+import unittest
+from collections import namedtuple
+from os.path import join, realpath, exists
+from unittest import mock
+
+import mrcfile
+import numpy as np
+
+from tomosegmemtv.prefetch import Prefetcher
+
+TS_IDS = ['TS_01', 'TS_02', 'TS_03']
+STAGE_TIMEOUT = 10  # s
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.storageDir = tempfile.mkdtemp()  # Stands for the network storage
+        self.extraDir = tempfile.mkdtemp()
+        self.links = {}
+        for tsId in TS_IDS:
+            tomoFile = join(self.storageDir, tsId + '.mrc')
+            with mrcfile.new(tomoFile) as mrc:
+                mrc.set_data(np.ones((8, 8, 8), dtype=np.float32))
+            os.makedirs(join(self.extraDir, tsId))
+            link = join(self.extraDir, tsId, tsId + '.mrc')
+            os.symlink(tomoFile, link)
+            self.links[tsId] = [link]
+
+    def _waitStaged(self, prefetcher, tsId, staged=True):
+        t0 = time.time()
+        while prefetcher.isStaged(tsId) != staged:
+            self.assertLess(time.time() - t0, STAGE_TIMEOUT, '%s not %s' % (tsId, 'staged' if staged else 'released'))
+            time.sleep(0.01)
+
+    def _isLocal(self, prefetcher, tsId):
+        return realpath(prefetcher.getStagedFile(self.links[tsId][0])).startswith(realpath(prefetcher.scratchDir))
+
+    def testPrefetch(self):
+        prefetcher = Prefetcher(self.links, scratchDir=tempfile.mkdtemp(), nAhead=1)
+        prefetcher.start()
+        try:
+            self._waitStaged(prefetcher, TS_IDS[0])
+            self.assertTrue(self._isLocal(prefetcher, TS_IDS[0]))
+            localFile = prefetcher.getStagedFile(self.links[TS_IDS[0]][0])
+            self.assertEqual(os.path.basename(localFile), os.path.basename(self.links[TS_IDS[0]][0]))
+            with mrcfile.open(localFile) as mrc:
+                self.assertEqual(mrc.data.shape, (8, 8, 8))
+
+            # The next tomogram is staged while the current one is annotated, and the annotated ones are released
+            prefetcher.setCurrent(TS_IDS[0])
+            self._waitStaged(prefetcher, TS_IDS[1])
+            prefetcher.skip(TS_IDS[0])
+            prefetcher.skip(TS_IDS[2])
+            prefetcher.setCurrent(TS_IDS[1])
+            self._waitStaged(prefetcher, TS_IDS[0], staged=False)
+            self.assertFalse(prefetcher.isStaged(TS_IDS[2]))
+            self.assertEqual(prefetcher.getStagedFile(self.links[TS_IDS[0]][0]), self.links[TS_IDS[0]][0])
+            self.assertTrue(prefetcher.isStaged(TS_IDS[1]))
+            # The links are never modified, so they are valid even if the process dies
+            for tsId in TS_IDS:
+                self.assertEqual(realpath(self.links[tsId][0]), join(realpath(self.storageDir), tsId + '.mrc'))
+        finally:
+            prefetcher.close()
+        for tsId in TS_IDS:
+            self.assertFalse(self._isLocal(prefetcher, tsId))
+        self.assertFalse(exists(prefetcher.scratchDir))
+
+    def testNotEnoughScratch(self):
+        prefetcher = Prefetcher(self.links, scratchDir=tempfile.mkdtemp(), nAhead=1)
+        with mock.patch('shutil.disk_usage', return_value=DiskUsage(total=100, used=100, free=0)):
+            prefetcher.start()
+            try:
+                prefetcher.setCurrent(TS_IDS[2])
+                t0 = time.time()
+                while TS_IDS[0] not in prefetcher._skipped:
+                    self.assertLess(time.time() - t0, STAGE_TIMEOUT)
+                    time.sleep(0.01)
+                self.assertFalse(prefetcher.isStaged(TS_IDS[0]))
+                self.assertFalse(self._isLocal(prefetcher, TS_IDS[0]))
+            finally:
+                prefetcher.close()
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import time
+import unittest
+from os.path import join, getmtime
+
+import mrcfile
+import numpy as np
+
+from tomosegmemtv.previews import buildPyramid, getPyramidLevels, getLevelFile
+
+
+class TestPreviews(unittest.TestCase):
+
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.cacheDir = join(self.testDir, 'pyramid')
+
+    def _writeVolume(self, fileName, data):
+        fileName = join(self.testDir, fileName)
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(data)
+        return fileName
+
+    def testPyramid(self):
+        data = np.random.default_rng(0).random((32, 24, 16)).astype(np.float32)
+        fileName = self._writeVolume('tomo.mrc', data)
+        self.assertEqual(getPyramidLevels(fileName, self.cacheDir), [1])
+        self.assertEqual(buildPyramid(fileName, self.cacheDir), [8, 4, 2, 1])
+        with mrcfile.open(getLevelFile(fileName, 8, self.cacheDir)) as mrc:
+            np.testing.assert_allclose(mrc.data, data.reshape(4, 8, 3, 8, 2, 8).mean(axis=(1, 3, 5)), rtol=1e-5)
+
+        # Only the outdated levels are computed again
+        mtimes = [getmtime(getLevelFile(fileName, binning, self.cacheDir)) for binning in [2, 4, 8]]
+        self.assertEqual(buildPyramid(fileName, self.cacheDir),  [8, 4, 2, 1])
+        self.assertEqual(mtimes, [getmtime(getLevelFile(fileName, binning, self.cacheDir)) for binning in [2, 4, 8]])
+        time.sleep(0.01)
+        self._writeVolume('tomo.mrc', data + 1)
+        self.assertEqual(getPyramidLevels(fileName, self.cacheDir), [1])
+        buildPyramid(fileName, self.cacheDir, binnings=[4])
+        self.assertEqual(getPyramidLevels(fileName, self.cacheDir), [4, 1])
+
+    def testLabelsPyramid(self):
+        labels = np.zeros((16, 16, 16), dtype=np.uint16)
+        labels[5, 6:9, 2:12] = 3  # One voxel thick membrane
+        fileName = self._writeVolume('tomo_materials.mrc', labels)
+        buildPyramid(fileName, self.cacheDir, binnings=[2, 4], labels=True)
+        with mrcfile.open(getLevelFile(fileName, 4, self.cacheDir)) as mrc:
+            self.assertEqual(mrc.data.dtype, np.uint16)
+            self.assertEqual(mrc.data.shape, (4, 4, 4))
+            self.assertEqual(set(np.unique(mrc.data)), {0, 3})
+            self.assertTrue(np.all(mrc.data[1, 1:3, 0:3] == 3))
+        # Levels smaller than a voxel are not computed
+        self.assertEqual(buildPyramid(fileName, self.cacheDir, binnings=[8, 32], labels=True), [8, 1])
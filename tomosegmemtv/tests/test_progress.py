@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import tempfile
+import unittest
+from os.path import join
+
+from tomosegmemtv.planner import SEGMENTATION_STAGES
+from tomosegmemtv.progress import ProgressTracker, getProgressSummary, DONE, RUNNING, PENDING
+from tomosegmemtv.scheduling import ThroughputModel
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        # 1 s per stage and 1000 voxels
+        self.throughput = ThroughputModel({stage: [1000.] for stage in SEGMENTATION_STAGES})
+        self.statusFile = join(tempfile.mkdtemp(), 'extra', 'status.json')
+        self.tracker = ProgressTracker({'TS_01': 1000, 'TS_02': 1000, 'TS_03': 1000}, SEGMENTATION_STAGES,
+                                       self.statusFile, nSlots=2, throughput=self.throughput)
+
+    def testProgressAndEta(self):
+        status = self.tracker.getStatus()
+        self.assertEqual(status['percent'], 0)
+        self.assertEqual(status['eta'], 10)  # 3 tomograms of 5 s in 2 slots
+
+        self.tracker.startTomo('TS_01')
+        self.tracker.startStage('TS_01', 'scaleSpace')
+        self.tracker.finishStage('TS_01')
+        self.tracker.startStage('TS_01', 'tensorVoting')
+        with open(self.statusFile) as f:
+            status = json.load(f)
+        self.assertEqual(status['tomos']['TS_01']['status'], RUNNING)
+        self.assertEqual(status['tomos']['TS_01']['stage'], 'tensorVoting')
+        self.assertAlmostEqual(status['tomos']['TS_01']['percent'], 20, delta=1)
+        self.assertEqual(status['tomos']['TS_02']['status'], PENDING)
+        self.assertIn('TS_01: tensorVoting', '\n'.join(getProgressSummary(self.statusFile)))
+
+        # Early abort: the remaining stages are not run
+        self.tracker.finishTomo('TS_01')
+        status = self.tracker.getStatus()
+        self.assertEqual(status['tomos']['TS_01']['status'], DONE)
+        self.assertAlmostEqual(status['percent'], 100 / 3, delta=0.1)
+        self.assertEqual(status['eta'], 5)
+
+    def testFinished(self):
+        for tsId in ['TS_01', 'TS_02', 'TS_03']:
+            self.tracker.startTomo(tsId)
+            self.tracker.finishTomo(tsId)
+        self.assertEqual(self.tracker.getStatus()['percent'], 100)
+        self.assertEqual(getProgressSummary(self.statusFile), [])
+
+    def testUpdatingStartedOnce(self):
+        self.tracker.startUpdating(interval=0.01)
+        updater = self.tracker._updater
+        self.tracker.startUpdating(interval=0.01)
+        self.assertIs(self.tracker._updater, updater)
+        self.tracker.stopUpdating()
+        self.assertFalse(updater.is_alive())
+
+    def testContinuedRun(self):
+        self.tracker.startTomo('TS_01')
+        self.tracker.finishTomo('TS_01')
+        self.tracker.startTomo('TS_02')
+        # Continued: TS_01 is not run again and TS_02 was interrupted
+        tracker = ProgressTracker({'TS_01': 1000, 'TS_02': 1000, 'TS_03': 1000}, SEGMENTATION_STAGES,
+                                  self.statusFile, nSlots=2, throughput=self.throughput)
+        tracker.loadStatus()
+        status = tracker.getStatus()
+        self.assertEqual([tomo['status'] for tomo in status['tomos'].values()], [DONE, PENDING, PENDING])
+        self.assertAlmostEqual(status['percent'], 100 / 3, delta=0.1)
@@ -0,0 +1,311 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import unittest
+from os.path import join
+from unittest import mock
+
+import numpy as np
+
+from tomosegmemtv import pipeline
+from tomosegmemtv.constants import DT_VOTING
+
+TOMO_SHAPE = (16, 6, 6)
+TS_ID = 'TS_01'
+
+
+class KillingRunner:
+    """Stand-in of the TomoSegMemTV programs: each call adds 1 to the input volume, except the tensor voting of
+    volumes with more than maxSlices slices, which is killed as the OOM killer would do."""
+
+    def __init__(self, maxSlices):
+        self.maxSlices = maxSlices
+        self.calls = []
+
+    def __call__(self, program, args, cores=None, numaNode=None):
+        tokens = shlex.split(args)
+        inFile, outFile = tokens[-4], tokens[-3]  # ... inFile outFile -t nThreads
+        data = np.asarray(pipeline.loadMmap(inFile))
+        self.calls.append((program, data.shape))
+        if program == DT_VOTING and data.shape[0] > self.maxSlices:
+            raise subprocess.CalledProcessError(-signal.SIGKILL, program)
+        pipeline.writeMrc(data + 1, outFile)
+
+
+class SmoothingRunner(KillingRunner):
+    """Stand-in whose tensor voting reaches radius slices along Z (moving average) and whose other programs copy
+    their input, so the seams of the tiles differ from the whole volume if their halo is too narrow."""
+
+    def __init__(self, maxSlices, radius):
+        super().__init__(maxSlices)
+        self.radius = radius
+
+    def __call__(self, program, args, cores=None, numaNode=None):
+        tokens = shlex.split(args)
+        inFile, outFile = tokens[-4], tokens[-3]
+        data = np.asarray(pipeline.loadMmap(inFile))
+        self.calls.append((program, data.shape))
+        if program == DT_VOTING:
+            if data.shape[0] > self.maxSlices:
+                raise subprocess.CalledProcessError(-signal.SIGKILL, program)
+            padded = np.pad(data, ((self.radius, self.radius), (0, 0), (0, 0)), mode='edge')
+            data = np.mean([padded[i:i + data.shape[0]] for i in range(2 * self.radius + 1)], axis=0)
+        pipeline.writeMrc(data, outFile)
+
+
+class TestSegmentationProtocol(unittest.TestCase):
+    """Steps of ProtTomoSegmenTV run directly, with the programs replaced by a stand-in."""
+
+    def setUp(self):
+        from tomosegmemtv.planner import CALIBRATION_VAR
+        self.outDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outDir, ignore_errors=True)
+        # Do not touch the user calibration
+        prevCalibration = os.environ.get(CALIBRATION_VAR)
+        os.environ[CALIBRATION_VAR] = join(self.outDir, 'calibration.json')
+        self.addCleanup(self._restoreEnv, CALIBRATION_VAR, prevCalibration)
+
+    @staticmethod
+    def _restoreEnv(name, value):
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    def _createProtocol(self, workingDir='segmentation', tomoData=None, **kwargs):
+        # Imported here, so the rest of the tests can be collected without a Scipion installation
+        import pwem
+        from pyworkflow.mapper import SqliteMapper
+        from tomo.objects import SetOfTomograms, Tomogram
+        from tomosegmemtv.protocols import ProtTomoSegmenTV
+
+        tomoFile = join(self.outDir, f'{TS_ID}.mrc')
+        pipeline.writeMrc(np.zeros(TOMO_SHAPE, dtype=np.float32) if tomoData is None else tomoData, tomoFile)
+        mapper = SqliteMapper(join(self.outDir, 'run.db'), pwem.Domain.getMapperDict())
+        inTomos = SetOfTomograms.create(self.outDir, template='tomograms%s.sqlite')
+        inTomos.setSamplingRate(10)
+        tomo = Tomogram()
+        tomo.setFileName(tomoFile)
+        tomo.setTsId(TS_ID)
+        tomo.setSamplingRate(10)
+        inTomos.append(tomo)
+        inTomos.write()
+        mapper.insert(inTomos)
+
+        prot = ProtTomoSegmenTV(workingDir=join(self.outDir, workingDir), mapper=mapper, **kwargs)
+        prot.inTomos.set(inTomos)
+        mapper.insert(prot)
+        mapper.commit()
+        os.makedirs(prot._getExtraPath(), exist_ok=True)
+        os.makedirs(prot._getTmpPath(), exist_ok=True)
+        prot._lock = threading.RLock()  # Set by the project when the protocol is launched
+        prot._initialize()
+        self.addCleanup(prot.progress.stopUpdating)
+        return prot
+
+    def testKilledStageRetriedInTiles(self):
+        prot = self._createProtocol(mbScaleFactor=2, oomRetries=2, oomTiles=2, stragglerFactor=0)
+        runner = KillingRunner(maxSlices=TOMO_SHAPE[0] - 1)
+        prot._runProgram = runner
+        prot.convertInputStep(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)
+        prot.createOutputStep(TS_ID)
+
+        # Both tensor votings are killed with the whole volume and alone, then run in 2 Z tiles with their halo
+        votingSlices = [shape[0] for program, shape in runner.calls if program == DT_VOTING]
+        self.assertEqual(len(votingSlices), 8)
+        self.assertEqual(votingSlices[:2], [TOMO_SHAPE[0]] * 2)
+        self.assertEqual(votingSlices[4:6], [TOMO_SHAPE[0]] * 2)
+        self.assertTrue(all(nSlices < TOMO_SHAPE[0] for nSlices in votingSlices[2:4] + votingSlices[6:]))
+        self.assertEqual(prot.recoveredDict[TS_ID], ['tensorVoting (in 2 Z tiles)'] * 2)
+        # Each of the 5 programs of the chain adds 1
+        saliency = np.asarray(pipeline.loadMmap(prot._getResultingFn(TS_ID)))
+        self.assertEqual(saliency.shape, TOMO_SHAPE)
+        self.assertTrue(np.all(saliency == 5))
+
+    def testTiledStagesMatchWholeVolume(self):
+        # The voting of the stand-in reaches 3 * mbScaleFactor slices, as the real one
+        data = np.random.default_rng(0).random(TOMO_SHAPE).astype(np.float32)
+        saliencies = []
+        for workingDir, maxSlices in [('whole', TOMO_SHAPE[0]), ('tiled', TOMO_SHAPE[0] - 1)]:
+            prot = self._createProtocol(workingDir, tomoData=data, mbScaleFactor=1, oomRetries=2, oomTiles=2,
+                                        keepAllFiles=True)
+            prot._runProgram = SmoothingRunner(maxSlices, radius=3)
+            prot.convertInputStep(TS_ID)
+            prot.runTomoSegmenTV(TS_ID)
+            saliencies.append(np.asarray(pipeline.loadMmap(prot._getResultingFn(TS_ID))))
+        self.assertEqual(prot.recoveredDict[TS_ID], ['tensorVoting (in 2 Z tiles)'] * 2)
+        np.testing.assert_allclose(saliencies[1], saliencies[0], rtol=1e-5)
+
+    def testResultsKeptWhenContinued(self):
+        from tomosegmemtv.protocols.protocol_tomosegmentv import EMPTY_MASK_ATTR, MB_THK_PIX_ATTR, \
+            SURF_FRACTION_ATTR
+        prot = self._createProtocol(mbThkPix=3)
+        prot._runProgram = KillingRunner(maxSlices=TOMO_SHAPE[0])
+        prot.convertInputStep(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)
+        # Continued: the output is created by another instance of the protocol
+        prot = self._createProtocol(mbThkPix=3)
+        prot.createOutputStep(TS_ID)
+        outTomoMask = getattr(prot, prot._possibleOutputs.tomoMasks.name).getFirstItem()
+        self.assertEqual(getattr(outTomoMask, MB_THK_PIX_ATTR).get(), 3)
+        self.assertEqual(getattr(outTomoMask, SURF_FRACTION_ATTR).get(), 1)
+        self.assertFalse(getattr(outTomoMask, EMPTY_MASK_ATTR).get())
+
+    def testProgressWhenContinued(self):
+        from tomosegmemtv.progress import DONE, STATUS_FILE, getProgressSummary
+        prot = self._createProtocol()
+        prot._runProgram = KillingRunner(maxSlices=TOMO_SHAPE[0])
+        prot.convertInputStep(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)
+        # Continued: the tomogram is not processed again
+        prot = self._createProtocol()
+        prot.progress.write()
+        self.assertEqual(prot.progress.getStatus()['tomos'][TS_ID]['status'], DONE)
+        self.assertEqual(getProgressSummary(prot._getExtraPath(STATUS_FILE)), [])
+
+    def testStragglerBackupsDisabledByDefault(self):
+        prot = self._createProtocol()
+        self.assertEqual(prot.stragglerFactor.get(), 0)
+        prot.throughputModel.record('tensorVoting', 1, 1000)
+        self.assertIsNone(prot._getStageTimeout(pipeline.tensorVoting, 1e6, 1))
+
+    def testThreadsNotRebalancedByDefault(self):
+        prot = self._createProtocol(binThreads=2)
+        self.assertFalse(prot.rebalanceThreads.get())
+        runner = KillingRunner(maxSlices=TOMO_SHAPE[0])
+        prot._runProgram = runner
+        with mock.patch.object(prot, '_runPinnedStage', wraps=prot._runPinnedStage) as runPinnedStage:
+            prot.convertInputStep(TS_ID)
+            prot.runTomoSegmenTV(TS_ID)
+        self.assertEqual({call.args[2] for call in runPinnedStage.call_args_list}, {2})
+
+    def testPrimaryCopyRunWithRunJob(self):
+        from tomosegmemtv.planner import SEGMENTATION_STAGES
+        prot = self._createProtocol(mbScaleFactor=2, stragglerFactor=4)
+        for stage in SEGMENTATION_STAGES:
+            prot.throughputModel.record(stage, 1e6, 1)  # So a backup copy would be launched if they took long
+        runner = KillingRunner(maxSlices=TOMO_SHAPE[0])
+        prot._runProgram = runner
+        prot.convertInputStep(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)
+        # The 5 programs of the chain are run by the protocol, not by a separate runner
+        self.assertEqual(len(runner.calls), 5)
+        self.assertTrue(np.all(np.asarray(pipeline.loadMmap(prot._getResultingFn(TS_ID))) == 5))
+
+    def testExecutorShutDownWhenClosed(self):
+        from pyworkflow.protocol import Protocol
+        prot = self._createProtocol()
+        # Also if the outputs cannot be closed
+        with mock.patch.object(Protocol, '_closeOutputSet', side_effect=RuntimeError), \
+                mock.patch.object(prot.tomoExecutor, 'shutdown') as shutdown:
+            with self.assertRaises(RuntimeError):
+                prot._closeOutputSet()
+        shutdown.assert_called_once_with()
+
+    def testProgressUpdatedWhileRunning(self):
+        prot = self._createProtocol()
+        prot._runProgram = KillingRunner(maxSlices=TOMO_SHAPE[0])
+        prot.convertInputStep(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)
+        prot.runTomoSegmenTV(TS_ID)  # E.g. re-run after a failure
+        updater = prot.progress._updater
+        self.assertTrue(updater.is_alive())
+        with mock.patch('pyworkflow.protocol.Protocol._closeOutputSet'):
+            prot._closeOutputSet()
+        self.assertFalse(updater.is_alive())
+
+
+class TestProtocolBase(unittest.TestCase):
+
+    def testProtocolsWithoutPlan(self):
+        from tomosegmemtv.protocols import ProtLabelMembranes
+        prot = ProtLabelMembranes()
+        self.assertIsNone(prot._getPlan())
+        self.assertEqual(prot._checkPlanResources(), [])
+
+
+class TestLabelProtocol(unittest.TestCase):
+    """Steps of ProtLabelMembranes run directly."""
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outDir, ignore_errors=True)
+
+    def _createProtocol(self, workingDir, inTomoMasks, mapper):
+        from tomosegmemtv.protocols import ProtLabelMembranes
+        prot = ProtLabelMembranes(workingDir=workingDir, mapper=mapper, minSize=1)
+        prot.inTomoMasks.set(inTomoMasks)
+        mapper.insert(prot)
+        mapper.commit()
+        os.makedirs(prot._getExtraPath(), exist_ok=True)
+        prot._lock = threading.RLock()  # Set by the project when the protocol is launched
+        prot._initialize()
+        return prot
+
+    def testResultsKeptWhenContinued(self):
+        import pwem
+        from pyworkflow.mapper import SqliteMapper
+        from tomo.objects import SetOfTomoMasks, TomoMask
+        from tomosegmemtv.protocols.protocol_label_membranes import N_LABELS_ATTR, LABEL_TH_ATTR
+
+        # Two separate membranes over a weak background
+        data = np.full(TOMO_SHAPE, 0.1, dtype=np.float32)
+        data[2:4] = 1
+        data[8:10] = 1
+        maskFile = pipeline.writeMrc(data, join(self.outDir, f'{TS_ID}_flt.mrc'))
+        mapper = SqliteMapper(join(self.outDir, 'run.db'), pwem.Domain.getMapperDict())
+        inTomoMasks = SetOfTomoMasks.create(self.outDir, template='tomomasks%s.sqlite')
+        inTomoMasks.setSamplingRate(10)
+        tomoMask = TomoMask()
+        tomoMask.setFileName(maskFile)
+        tomoMask.setVolName(join(self.outDir, f'{TS_ID}.mrc'))
+        tomoMask.setTsId(TS_ID)
+        tomoMask.setSamplingRate(10)
+        inTomoMasks.append(tomoMask)
+        inTomoMasks.write()
+        mapper.insert(inTomoMasks)
+
+        workingDir = join(self.outDir, 'labelling')
+        self._createProtocol(workingDir, inTomoMasks, mapper).labelStep(TS_ID)
+        # Continued: the output is created by another instance of the protocol
+        prot = self._createProtocol(workingDir, inTomoMasks, mapper)
+        prot.createOutputStep(TS_ID)
+        outTomoMask = getattr(prot, prot._possibleOutputs.tomoMasks.name).getFirstItem()
+        self.assertEqual(getattr(outTomoMask, N_LABELS_ATTR).get(), 2)
+        self.assertIsNotNone(getattr(outTomoMask, LABEL_TH_ATTR).get())
+        self.assertEqual(outTomoMask.getVolName(), tomoMask.getVolName())
+        self.assertEqual(len(prot._summary()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
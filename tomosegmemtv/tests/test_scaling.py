@@ -0,0 +1,161 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+# Comma separated list of the number of tomograms of the synthetic sets, e.g. 10,100,1000,10000. It is a
+# benchmark whose big sizes take minutes, so it is only run if this variable is set
+SCALING_SIZES_VAR = 'TOMOSEGMEMTV_SCALING_SIZES'
+# Maximum growth of the time per item from one size to the next one. A linear cost keeps it close to 1, while a
+# quadratic one multiplies it by the size ratio
+MAX_GROWTH = 3
+# Resolution (s) of the measurements, to avoid failing because of the noise when they are too short
+TIME_RESOLUTION = 0.05
+STUB_SHAPE = (4, 4, 4)
+
+
+def getScalingSizes() -> list:
+    return sorted(int(size) for size in os.environ.get(SCALING_SIZES_VAR, '').split(',') if size.strip())
+
+
+def timeIt(func, *args) -> float:
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+@unittest.skipUnless(getScalingSizes(), f'benchmark, set {SCALING_SIZES_VAR} (e.g. 10,100) to run it')
+class TestScaling(unittest.TestCase):
+    """Python side overhead of the protocols (set cloning, step insertion, output registration, annotation
+    status) with synthetic sets of tomograms backed by tiny MRC stubs, so only the metadata handling is measured."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Imported here, so the rest of the tests can be collected without a Scipion installation
+        import pwem
+        from pyworkflow.mapper import SqliteMapper
+        from tomo.objects import SetOfTomograms, Tomogram
+        from tomosegmemtv.planner import CALIBRATION_VAR
+        from tomosegmemtv.protocols import ProtTomoSegmenTV, ProtAnnotateMembranes
+
+        cls.outDir = tempfile.mkdtemp()
+        cls.prevCalibration = os.environ.get(CALIBRATION_VAR)
+        os.environ[CALIBRATION_VAR] = join(cls.outDir, 'calibration.json')  # Do not touch the user calibration
+        stubFile = join(cls.outDir, 'stub.mrc')
+        with mrcfile.new(stubFile) as mrc:
+            mrc.set_data(np.zeros(STUB_SHAPE, dtype=np.float32))
+
+        cls.timings = {}
+        cls.objectsToGo = {}
+        for size in getScalingSizes():
+            sizeDir = join(cls.outDir, str(size))
+            os.makedirs(sizeDir)
+            mapper = SqliteMapper(join(sizeDir, 'run.db'), pwem.Domain.getMapperDict())
+            inTomos = SetOfTomograms.create(sizeDir, template='tomograms%s.sqlite')
+            inTomos.setSamplingRate(10)
+            for i in range(size):
+                tomo = Tomogram()
+                tomo.setFileName(stubFile)
+                tomo.setTsId('TS_%05d' % i)
+                tomo.setSamplingRate(10)
+                inTomos.append(tomo)
+            inTomos.write()
+            mapper.insert(inTomos)
+
+            segProt = cls._createProtocol(ProtTomoSegmenTV, join(sizeDir, 'segmentation'), mapper)
+            segProt.inTomos.set(inTomos)
+            insertion = timeIt(segProt._insertAllSteps)
+            registration = timeIt(lambda: [segProt.createOutputStep(tsId) for tsId in segProt.inTomosDict])
+            segProt._closeOutputSet()
+
+            annProt = cls._createProtocol(ProtAnnotateMembranes, join(sizeDir, 'annotation'), mapper)
+            annProt.inputTomoMasks.set(getattr(segProt, segProt._possibleOutputs.tomoMasks.name))
+            initialization = timeIt(annProt._initialize)
+            # Half of the tomograms annotated
+            for tsId in list(annProt._tomoMaskDict)[::2]:
+                os.makedirs(annProt._getExtraPath(tsId))
+                open(annProt._getCurrentTomoMaskFile(tsId), 'w').close()
+            status = timeIt(annProt._getAnnotationStatus)
+            cls.objectsToGo[size] = annProt._objectsToGo.get()
+
+            cls.timings[size] = {'insertion': insertion, 'registration': registration,
+                                 'annotationInit': initialization, 'annotationStatus': status}
+        cls._printTimings()
+
+    @classmethod
+    def tearDownClass(cls):
+        from tomosegmemtv.planner import CALIBRATION_VAR
+        if cls.prevCalibration is None:
+            os.environ.pop(CALIBRATION_VAR, None)
+        else:
+            os.environ[CALIBRATION_VAR] = cls.prevCalibration
+        shutil.rmtree(cls.outDir, ignore_errors=True)
+
+    @staticmethod
+    def _createProtocol(protClass, workingDir, mapper):
+        prot = protClass(workingDir=workingDir, mapper=mapper)
+        mapper.insert(prot)
+        mapper.commit()
+        os.makedirs(prot._getExtraPath())
+        prot._lock = threading.RLock()  # Set by the project when the protocol is launched
+        return prot
+
+    @classmethod
+    def _printTimings(cls):
+        names = list(next(iter(cls.timings.values())))
+        print('\n%8s' % 'size' + ''.join('%22s' % name for name in names) + '   (ms per item)')
+        for size, timings in cls.timings.items():
+            print('%8d' % size + ''.join('%22.3f' % (1000 * timings[name] / size) for name in names))
+
+    def _checkScaling(self, name):
+        sizes = list(self.timings)
+        for prevSize, size in zip(sizes, sizes[1:]):
+            prevPerItem = self.timings[prevSize][name] / prevSize
+            perItem = self.timings[size][name] / size
+            self.assertLess(perItem, MAX_GROWTH * prevPerItem + TIME_RESOLUTION / size,
+                            f'{name}: {1000 * perItem:.3f} ms per item with {size} tomograms vs '
+                            f'{1000 * prevPerItem:.3f} ms with {prevSize}')
+
+    def testStepInsertion(self):
+        self._checkScaling('insertion')
+
+    def testOutputRegistration(self):
+        self._checkScaling('registration')
+
+    def testAnnotationInitialization(self):
+        self._checkScaling('annotationInit')
+
+    def testAnnotationStatus(self):
+        self._checkScaling('annotationStatus')
+        self.assertEqual(self.objectsToGo, {size: size // 2 for size in self.timings})
@@ -0,0 +1,199 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import multiprocessing
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from os.path import join
+
+from tomosegmemtv.scheduling import parseCpuList, formatCpuList, getNumaNodes, getPinningCmd, CoreAllocator, \
+    ThreadBudget, StageGate, getSegmentationCost, getKillSignal, \
+    ThroughputModel, runWithBackup, killChildProcesses, PRIMARY, BACKUP
+
+NODES = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+
+def saveRate(calibrationFile, rate):
+    model = ThroughputModel()
+    model.record('tensorVoting', rate, 1)
+    for _ in range(10):  # Same rate saved once, however many times the model is saved
+        model.save(calibrationFile)
+
+
+class TestScheduling(unittest.TestCase):
+
+    def testCpuLists(self):
+        self.assertEqual(parseCpuList('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(formatCpuList([11, 0, 1, 2, 3, 8, 10]), '0-3,8,10-11')
+        cores = sum(getNumaNodes().values(), [])
+        self.assertTrue(cores)
+        self.assertEqual(len(cores), len(set(cores)))
+
+    def testPinningCmd(self):
+        program, args = getPinningCmd('/bin/dtvoting', '-s 10 in.mrc out.mrc  -t 2', [4, 5], numaNode=1)
+        self.assertIn(program, ['numactl', 'taskset'])
+        self.assertTrue(args.endswith('/bin/dtvoting -s 10 in.mrc out.mrc  -t 2'))
+        self.assertIn('4-5', args)
+
+    def testAllocatorKeepsTomogramsInANode(self):
+        allocator = CoreAllocator(budget=6, nodes=NODES)
+        self.assertEqual(allocator.getNumberOfCores(), 6)  # Balanced: 3 cores per node
+        placements = [allocator.acquire(3) for _ in range(2)]
+        self.assertEqual(sorted(node for node, _ in placements), [0, 1])
+        for node, cores in placements:
+            self.assertTrue(set(cores) <= set(NODES[node]))
+
+        # No free cores: the next tomogram waits until one finishes
+        acquired = []
+        waiting = threading.Thread(target=lambda: acquired.append(allocator.acquire(3)))
+        waiting.start()
+        waiting.join(0.2)
+        self.assertEqual(acquired, [])
+        allocator.release(placements[0][1])
+        waiting.join(5)
+        self.assertEqual(acquired, [placements[0]])
+
+    def testAllocatorSpansNodes(self):
+        allocator = CoreAllocator(nodes=NODES)
+        node, cores = allocator.acquire(6)
+        self.assertIsNone(node)
+        self.assertEqual(len(set(cores)), 6)
+
+    def testLongestFirstCost(self):
+        # A small tomogram with a large voting neighbourhood may be costlier than a bigger one
+        self.assertGreater(getSegmentationCost(100 ** 3, 20), getSegmentationCost(150 ** 3, 10))
+
+    def testThreadBudgetRebalancing(self):
+        budget = ThreadBudget(minThreads=2, nSlots=3, nTasks=4)
+        for _ in range(3):
+            budget.start()
+        self.assertEqual(budget.getThreads(), 2)  # One tomogram waiting: no idle threads
+        budget.finish()
+        budget.start()
+        self.assertEqual(budget.getThreads(), 2)
+        budget.finish()
+        self.assertEqual(budget.getThreads(), 3)  # 2 tomograms left for 3 slots of 2 threads
+        budget.finish()
+        self.assertEqual(budget.getThreads(), 6)
+
+    def testKillSignal(self):
+        self.assertEqual(getKillSignal(-9), signal.SIGKILL)
+        self.assertEqual(getKillSignal(137), signal.SIGKILL)  # Killed child of a shell
+        self.assertIsNone(getKillSignal(1))
+        proc = subprocess.run('kill -9 $$', shell=True)
+        self.assertEqual(getKillSignal(proc.returncode), signal.SIGKILL)
+
+    def testExclusiveStageWaitsForTheOthers(self):
+        gate = StageGate()
+        events = []
+
+        def runShared(name, seconds):
+            with gate.shared():
+                events.append(name + ' start')
+                time.sleep(seconds)
+                events.append(name + ' end')
+
+        def runExclusive():
+            with gate.exclusive():
+                events.append('exclusive start')
+                events.append('exclusive end')
+
+        first = threading.Thread(target=runShared, args=('first', 0.3))
+        first.start()
+        time.sleep(0.05)
+        exclusive = threading.Thread(target=runExclusive)
+        exclusive.start()
+        time.sleep(0.05)
+        second = threading.Thread(target=runShared, args=('second', 0))  # Waits for the exclusive one
+        second.start()
+        for thread in (first, exclusive, second):
+            thread.join(5)
+        self.assertEqual(events, ['first start', 'first end', 'exclusive start', 'exclusive end', 'second start',
+                                  'second end'])
+
+    def testThroughputModel(self):
+        model = ThroughputModel()
+        self.assertIsNone(model.getExpectedTime('tensorVoting', 1000))
+        model.record('tensorVoting', 1000, 10, nThreads=2)
+        self.assertAlmostEqual(model.getExpectedTime('tensorVoting', 4000, nThreads=4), 20)
+
+    def testCalibrationPerHost(self):
+        outDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outDir, ignore_errors=True)
+        calibrationFile = join(outDir, 'calibration.json')
+        for host, rate in (('fast', 1000), ('slow', 10)):
+            model = ThroughputModel(host=host)
+            model.record('tensorVoting', rate, 1)
+            model.save(calibrationFile)
+        self.assertEqual(ThroughputModel.load(calibrationFile, host='fast').getRate('tensorVoting'), 1000)
+        self.assertEqual(ThroughputModel.load(calibrationFile, host='slow').getRate('tensorVoting'), 10)
+        self.assertIsNone(ThroughputModel.load(calibrationFile, host='other').getRate('tensorVoting'))
+        # The rates of previous versions are not referred to any host, so they are not used
+        with open(calibrationFile, 'w') as f:
+            json.dump({'tensorVoting': [1000]}, f)
+        self.assertIsNone(ThroughputModel.load(calibrationFile).getRate('tensorVoting'))
+
+    def testConcurrentCalibrationSaves(self):
+        outDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outDir, ignore_errors=True)
+        calibrationFile = join(outDir, 'calibration.json')
+        nProcesses = 8
+        with multiprocessing.Pool(nProcesses) as pool:
+            pool.starmap(saveRate, [(calibrationFile, rate) for rate in range(1, nProcesses + 1)])
+        # No rate is lost when the protocols save their calibration at the same time
+        self.assertEqual(sorted(ThroughputModel.load(calibrationFile)._rates['tensorVoting']),
+                         list(range(1, nProcesses + 1)))
+
+    def testKillChildProcesses(self):
+        outFile = join(tempfile.gettempdir(), 'tomosegmemtv_test_out.mrc')
+        process = subprocess.Popen(['sh', '-c', 'sleep 30', 'sh', outFile])
+        other = subprocess.Popen(['sh', '-c', 'sleep 30', 'sh', outFile + '.other'])
+        self.addCleanup(other.wait)
+        self.addCleanup(other.kill)
+        self.assertEqual(killChildProcesses(outFile), 1)
+        self.assertEqual(process.wait(5), -signal.SIGKILL)
+        self.assertIsNone(other.poll())
+
+    def testStragglerIsReplacedByBackup(self):
+        cancelled = threading.Event()
+
+        def hungPrimary():
+            cancelled.wait(10)
+            raise subprocess.CalledProcessError(-signal.SIGKILL, 'dtvoting')
+
+        self.assertEqual(runWithBackup((hungPrimary, cancelled.set), (lambda: None, lambda: None), timeout=0.1),
+                         BACKUP)
+        self.assertTrue(cancelled.is_set())
+        # A primary finishing in time does not launch the backup
+        backupCalls = []
+        self.assertEqual(runWithBackup((lambda: None, lambda: None), (lambda: backupCalls.append(1), lambda: None),
+                                       timeout=1), PRIMARY)
+        self.assertEqual(backupCalls, [])
@@ -31,7 +31,7 @@ from tomo.protocols.protocol_import_tomograms import OUTPUT_NAME
 from tomo.tests import TOMOSEGMEMTV_TEST_DATASET, DataSet_Tomosegmemtv
 from tomo.tests.test_base_centralized_layer import TestBaseCentralizedLayer
 from tomosegmemtv.protocols import ProtTomoSegmenTV
-from tomosegmemtv.protocols.protocol_tomosegmentv import outputObjects
+from tomosegmemtv.protocols.protocol_tomosegmentv import outputObjects, EMPTY_MASK_ATTR
 
 
 class TestTomosegmemTV(TestBaseCentralizedLayer):
@@ -82,4 +82,7 @@ class TestTomosegmemTV(TestBaseCentralizedLayer):
                             expectedSetSize=2,
                             expectedSRate=self.samplingRate,
                             expectedDimensions=self.tomoDims,
-                            isHeterogeneousSet=False)
\ No newline at end of file
+                            isHeterogeneousSet=False)
+        # The membranes were detected, so no empty mask should have been generated
+        for tomoMask in tomoMasks:
+            self.assertFalse(getattr(tomoMask, EMPTY_MASK_ATTR).get())
\ No newline at end of file
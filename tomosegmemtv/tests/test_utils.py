@@ -0,0 +1,145 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import unittest
+from os.path import join
+
+import mrcfile
+import numpy as np
+
+from tomosegmemtv.utils import getNonZeroStats, getOtsuThreshold, thresholdVolume, estimateMembraneThickness, \
+    binVolume, resizeVolume, resizeFile
+
+
+class TestVolumeUtils(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testDir = tempfile.mkdtemp()
+
+    def _writeVolume(self, fileName, data):
+        fileName = join(self.testDir, fileName)
+        with mrcfile.new(fileName, overwrite=True) as mrc:
+            mrc.set_data(data.astype(np.float32))
+        return fileName
+
+    def testNonZeroStatsAndOtsu(self):
+        # Bimodal surfaceness-like map: a few strong voxels, a lot of weak ones and the rest set to 0
+        data = np.zeros((40, 30, 20), dtype=np.float32)
+        rng = np.random.default_rng(0)
+        data[:10] = rng.normal(0.1, 0.01, size=(10, 30, 20))
+        data[30:] = rng.normal(0.8, 0.01, size=(10, 30, 20))
+        fileName = self._writeVolume('bimodal.mrc', data)
+
+        stats = getNonZeroStats(fileName, slabSize=7)
+        self.assertEqual(stats.nVoxels, data.size)
+        self.assertEqual(stats.nNonZero, np.count_nonzero(data))
+        self.assertAlmostEqual(stats.nonZeroFraction, 0.5)
+        self.assertEqual(stats.hist.sum(), stats.nNonZero)
+
+        threshold = getOtsuThreshold(stats)
+        self.assertTrue(0.2 < threshold < 0.7)
+
+        thresholdVolume(fileName, threshold, slabSize=7)
+        self.assertAlmostEqual(getNonZeroStats(fileName).nonZeroFraction, 0.25)
+
+    def testEmptyVolumeStats(self):
+        fileName = self._writeVolume('empty.mrc', np.zeros((8, 8, 8)))
+        stats = getNonZeroStats(fileName)
+        self.assertEqual(stats.nonZeroFraction, 0)
+        self.assertEqual(getOtsuThreshold(stats), 0)
+
+    def testEstimateMembraneThickness(self):
+        # Dark membranes with a Gaussian profile (two planes and a sphere) over a noisy background
+        mbThk = 3
+        z, y, x = np.meshgrid(*[np.arange(96)] * 3, indexing='ij')
+        data = -np.exp(-0.5 * ((x - 20) / mbThk) ** 2) - np.exp(-0.5 * ((x - 80) / mbThk) ** 2)
+        r = np.sqrt((z - 48) ** 2 + (y - 48) ** 2 + (x - 48) ** 2)
+        data -= np.exp(-0.5 * ((r - 30) / mbThk) ** 2)
+        data += np.random.default_rng(0).normal(0, 0.3, data.shape)
+        fileName = self._writeVolume('membranes.mrc', data)
+
+        estimated = estimateMembraneThickness(fileName, list(np.arange(1, 9)), blackOverWhite=True)
+        self.assertEqual(estimated, mbThk)
+        self.assertIs(type(estimated), int)
+        for sigmas in ([], [1, 2.5], [0, 1]):
+            with self.assertRaises(ValueError):
+                estimateMembraneThickness(fileName, sigmas)
+
+    def testBinAndResize(self):
+        data = np.random.default_rng(0).random((21, 18, 13)).astype(np.float32)
+        inFileName = self._writeVolume('unbinned.mrc', data)
+        outFileName = join(self.testDir, 'binned.mrc')
+        binning = 2
+        binVolume(inFileName, outFileName, binning, slabSize=4)
+        with mrcfile.open(outFileName) as mrc:
+            binnedData = mrc.data.copy()
+        expected = data[:20, :18, :12].reshape(10, 2, 9, 2, 6, 2).mean(axis=(1, 3, 5))
+        self.assertEqual(binnedData.shape, (10, 9, 6))
+        self.assertTrue(np.allclose(binnedData, expected, atol=1e-6))
+
+        # Nearest neighbour resizing to an anisotropic shape keeps the labels
+        labels = np.zeros((10, 9, 6), dtype=np.float32)
+        labels[2:5, 3:7, 1:4] = 3
+        resized = resizeVolume(labels, (21, 18, 13), order=0)
+        self.assertEqual(resized.shape, (21, 18, 13))
+        self.assertEqual(set(np.unique(resized)), {0, 3})
+
+    def testBinnedUpsamplingRegistered(self):
+        # Step edges in a volume whose dimensions are not multiples of the binning stay in place after binning and
+        # upsampling back with the binning factor as scale
+        binning = 3
+        data = np.zeros((23, 20, 17), dtype=np.float32)
+        data[9:, :, :] = 1
+        data[:, 12:, :] += 1
+        data[:, :, 6:] += 1
+        inFileName = self._writeVolume('steps.mrc', data)
+        binnedFileName = join(self.testDir, 'stepsBinned.mrc')
+        binVolume(inFileName, binnedFileName, binning)
+        with mrcfile.open(binnedFileName) as mrc:
+            binnedData = mrc.data.copy()
+        resized = resizeVolume(binnedData, data.shape, order=1, scale=binning)
+        self.assertEqual(resized.shape, data.shape)
+        for axis, edge in enumerate((9, 12, 6)):
+            profile = resized.mean(axis=tuple(ax for ax in range(3) if ax != axis))
+            self.assertLess(profile[edge - 2], profile[edge - 1])
+            self.assertLess(profile[edge], profile[edge + 1])
+            self.assertTrue(np.allclose(profile[:edge - 2], profile[0]))
+            self.assertTrue(np.allclose(profile[edge + 2:], profile[-1]))
+        # The voxels cropped by the binning take the values of the border
+        self.assertTrue(np.allclose(resized[-2:], resized[-3]))
+
+    def testResizeFileBySlabs(self):
+        data = np.random.default_rng(1).random((11, 9, 7)).astype(np.float32)
+        inFileName = self._writeVolume('toResize.mrc', data)
+        outFileName = join(self.testDir, 'resized.mrc')
+        for order, outShape, scale in ((1, (25, 20, 15), None), (1, (33, 27, 21), 3), (0, (7, 5, 4), None)):
+            resizeFile(inFileName, outFileName, outShape, order=order, scale=scale, slabSize=4)
+            with mrcfile.open(outFileName) as mrc:
+                self.assertTrue(np.allclose(mrc.data, resizeVolume(data, outShape, order=order, scale=scale),
+                                            atol=1e-6))
+        with self.assertRaises(ValueError):
+            resizeVolume(data, (5, 5, 5), order=3)
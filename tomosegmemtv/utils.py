@@ -0,0 +1,334 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import fcntl
+import importlib
+import os
+from contextlib import contextmanager
+from os.path import dirname
+
+import numpy as np
+
+# Number of Z slices read at once when a volume is streamed from disk
+SLAB_SIZE = 32
+HIST_BINS = 256
+
+
+class LazyModule:
+    """Module imported on the first access to one of its attributes, so importing the plugin (e.g. by a headless
+    worker) does not load it (see tests/test_import_time.py)."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+mrcfile = LazyModule('mrcfile')
+
+
+def iterSlabs(data, slabSize: int = SLAB_SIZE):
+    """Iterate a (memory-mapped) volume in Z slabs, yielding the first slice index and the slab data."""
+    for z0 in range(0, data.shape[0], slabSize):
+        yield z0, np.asarray(data[z0:z0 + slabSize])
+
+
+class VolumeStats:
+    """Fraction of non-zero voxels of a volume and histogram of its non-zero values."""
+
+    def __init__(self, nVoxels: int, nNonZero: int, hist: np.ndarray, binEdges: np.ndarray):
+        self.nVoxels = nVoxels
+        self.nNonZero = nNonZero
+        self.hist = hist
+        self.binEdges = binEdges
+
+    @property
+    def nonZeroFraction(self) -> float:
+        return self.nNonZero / self.nVoxels if self.nVoxels else 0.
+
+    def getPercentile(self, percentile: float) -> float:
+        """Value below which the given percentage of the non-zero voxels fall, read from the histogram."""
+        if not self.nNonZero:
+            return 0.
+        cumHist = np.cumsum(self.hist)
+        ind = np.searchsorted(cumHist, percentile / 100 * cumHist[-1])
+        return float(self.binEdges[min(ind + 1, len(self.binEdges) - 1)])
+
+    def __str__(self):
+        msg = f'{self.nNonZero} / {self.nVoxels} non-zero voxels ({100 * self.nonZeroFraction:.4f} %)'
+        if self.nNonZero:
+            msg += (f', non-zero values in [{self.binEdges[0]:.4g}, {self.binEdges[-1]:.4g}], '
+                    f'median {self.getPercentile(50):.4g}')
+        return msg
+
+
+def getNonZeroStats(fileName: str, nBins: int = HIST_BINS, slabSize: int = SLAB_SIZE) -> VolumeStats:
+    """Compute the non-zero voxel fraction and the histogram of the non-zero values of an MRC file. The volume
+    is memory-mapped and read in Z slabs, so only a slab is kept in memory at a time. Two passes are made:
+    the first one gets the value range and the second one fills the histogram."""
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        nNonZero = 0
+        vMin, vMax = np.inf, -np.inf
+        for _, slab in iterSlabs(data, slabSize):
+            nonZero = slab[slab != 0]
+            if nonZero.size:
+                nNonZero += nonZero.size
+                vMin = min(vMin, float(nonZero.min()))
+                vMax = max(vMax, float(nonZero.max()))
+
+        hist = np.zeros(nBins, dtype=np.int64)
+        if not nNonZero:
+            return VolumeStats(data.size, 0, hist, np.zeros(nBins + 1))
+
+        binEdges = np.linspace(vMin, vMax if vMax > vMin else vMin + 1, nBins + 1)
+        for _, slab in iterSlabs(data, slabSize):
+            hist += np.histogram(slab[slab != 0], bins=binEdges)[0]
+
+        return VolumeStats(data.size, nNonZero, hist, binEdges)
+
+
+def getOtsuThreshold(stats: VolumeStats) -> float:
+    """Otsu threshold of the histogram of the non-zero values, the one that maximizes the between-class
+    variance."""
+    if not stats.nNonZero:
+        return 0.
+    hist = stats.hist.astype(np.float64)
+    binCenters = 0.5 * (stats.binEdges[:-1] + stats.binEdges[1:])
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    cumMean = np.cumsum(hist * binCenters)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu0 = cumMean / w0
+        mu1 = (cumMean[-1] - cumMean) / w1
+        betweenVar = np.nan_to_num(w0 * w1 * (mu0 - mu1) ** 2)
+    # The threshold is the upper edge of the last bin of the lower class. If there are empty bins between both
+    # classes, the variance is the same for all of them, so the central one is taken
+    maxInds = np.flatnonzero(betweenVar >= betweenVar.max() * (1 - 1e-9))
+    return float(stats.binEdges[maxInds[len(maxInds) // 2] + 1])
+
+
+def thresholdVolume(fileName: str, threshold: float, slabSize: int = SLAB_SIZE):
+    """Set to zero, in place and slab by slab, the voxels of an MRC file with values lower than the threshold."""
+    with mrcfile.mmap(fileName, mode='r+', permissive=True) as mrc:
+        data = mrc.data
+        for z0, slab in iterSlabs(data, slabSize):
+            slab[slab < threshold] = 0
+            data[z0:z0 + slabSize] = slab
+        mrc.update_header_stats()
+
+
+def _sampleBlocks(data, blockSize: int, nBlocks: int, seed: int = 0):
+    """Read nBlocks cubic blocks from random positions of a (memory-mapped) volume."""
+    rng = np.random.default_rng(seed)
+    blockShape = [min(blockSize, dim) for dim in data.shape]
+    blocks = []
+    for _ in range(nBlocks):
+        origin = [rng.integers(0, dim - bDim + 1) for dim, bDim in zip(data.shape, blockShape)]
+        sl = tuple(slice(o, o + bDim) for o, bDim in zip(origin, blockShape))
+        blocks.append(np.asarray(data[sl], dtype=np.float32))
+    return blocks
+
+
+def _symEigVals3(hxx, hyy, hzz, hxy, hxz, hyz) -> np.ndarray:
+    """Eigenvalues of the symmetric 3x3 matrices with the given (voxel-wise) components, computed in closed form
+    (trigonometric method), which is much faster than numpy.linalg.eigvalsh for large arrays of matrices."""
+    q = (hxx + hyy + hzz) / 3
+    p1 = hxy ** 2 + hxz ** 2 + hyz ** 2
+    p = np.sqrt(((hxx - q) ** 2 + (hyy - q) ** 2 + (hzz - q) ** 2 + 2 * p1) / 6)
+    pInv = np.divide(1, p, out=np.zeros_like(p), where=p > 0)
+    bxx, byy, bzz = (hxx - q) * pInv, (hyy - q) * pInv, (hzz - q) * pInv
+    bxy, bxz, byz = hxy * pInv, hxz * pInv, hyz * pInv
+    detB = bxx * (byy * bzz - byz ** 2) - bxy * (bxy * bzz - byz * bxz) + bxz * (bxy * byz - byy * bxz)
+    phi = np.arccos(np.clip(detB / 2, -1, 1)) / 3
+    eig1 = q + 2 * p * np.cos(phi)
+    eig3 = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+    return np.stack([eig1, 3 * q - eig1 - eig3, eig3], axis=-1)
+
+
+def getMembraneResponses(block: np.ndarray, sigmas, blackOverWhite: bool = True,
+                         percentile: float = 99) -> np.ndarray:
+    """Scale-normalized membrane response of a block at each of the given scales. The FFT of the block is
+    computed once and shared by all the scales: for each one, the Hessian is obtained multiplying it by the
+    Gaussian derivative kernels in Fourier space. The membrane response of a voxel is the eigenvalue of the
+    Hessian with the largest magnitude (expected across the membrane) minus the magnitude of the second one,
+    normalized with sigma^(3/2) so that it peaks when sigma matches the standard deviation of a Gaussian
+    membrane profile (ridge scale selection with gamma = 3/4). The response at each scale is summarized by
+    the given percentile over the voxels of the block."""
+    block = (block - block.mean()) / (block.std() or 1)
+    fBlock = np.fft.rfftn(block)
+    freqs = np.meshgrid(*[2 * np.pi * np.fft.fftfreq(n) for n in block.shape[:-1]],
+                        2 * np.pi * np.fft.rfftfreq(block.shape[-1]), indexing='ij')
+    k2 = sum(f ** 2 for f in freqs)
+    sign = 1 if blackOverWhite else -1  # Dark membranes are maxima of the second derivative across them
+    hessianInds = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+    responses = np.zeros(len(sigmas))
+    for i, sigma in enumerate(sigmas):
+        fSmooth = fBlock * np.exp(-0.5 * sigma ** 2 * k2)
+        hessian = [np.fft.irfftn(-freqs[a] * freqs[b] * fSmooth, s=block.shape) for a, b in hessianInds]
+        eigVals = _symEigVals3(*hessian)
+        eigVals = np.take_along_axis(eigVals, np.argsort(-np.abs(eigVals), axis=-1), axis=-1)
+        response = sigma ** 1.5 * (sign * eigVals[..., 0] - np.abs(eigVals[..., 1]))
+        responses[i] = np.percentile(np.maximum(response, 0), percentile)
+    return responses
+
+
+def estimateMembraneThickness(fileName: str, sigmas, blackOverWhite: bool = True, nBlocks: int = 8,
+                              blockSize: int = 64) -> int:
+    """Estimate the membrane thickness (voxels) of a tomogram as the scale with the maximum membrane response,
+    averaged over a set of randomly sampled blocks of it. The candidate scales (sigmas) must be positive integers,
+    as the thickness given to the scale-space program."""
+    if not sigmas or any(sigma <= 0 or int(sigma) != sigma for sigma in sigmas):
+        raise ValueError(f'The candidate membrane thicknesses must be positive integers: {sigmas}')
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        blocks = _sampleBlocks(mrc.data, blockSize, nBlocks)
+    responses = np.mean([getMembraneResponses(block, sigmas, blackOverWhite) for block in blocks], axis=0)
+    return int(sigmas[int(np.argmax(responses))])
+
+
+def writeEmptyVolume(fileName: str, refFileName: str):
+    """Write a zero-filled float32 MRC file with the same dimensions and voxel size as the reference one."""
+    with mrcfile.mmap(refFileName, mode='r', permissive=True) as ref:
+        shape = ref.data.shape
+        voxelSize = ref.voxel_size
+    with mrcfile.new_mmap(fileName, shape, mrc_mode=2, fill=0, overwrite=True) as mrc:
+        mrc.voxel_size = voxelSize
+
+
+def binVolume(inFileName: str, outFileName: str, binning: int, slabSize: int = SLAB_SIZE, labels: bool = False):
+    """Downsample an MRC file averaging blocks of binning^3 voxels. The input is memory-mapped and processed in
+    Z slabs and the output is written to a memory-mapped file, so only a slab is kept in memory at a time. The
+    dimensions not divisible by the binning factor are cropped. Label volumes (labels=True) keep their data type
+    and the maximum label of each block, so thin labelled structures are not lost."""
+    with mrcfile.mmap(inFileName, mode='r', permissive=True) as inMrc:
+        data = inMrc.data
+        outShape = tuple(dim // binning for dim in data.shape)
+        mrcMode = mrcfile.utils.mode_from_dtype(data.dtype) if labels else 2
+        with mrcfile.new_mmap(outFileName, outShape, mrc_mode=mrcMode, overwrite=True) as outMrc:
+            outData = outMrc.data
+            nzSlab = max(1, slabSize // binning)  # Binned slices computed at once
+            for z0 in range(0, outShape[0], nzSlab):
+                z1 = min(z0 + nzSlab, outShape[0])
+                slab = np.asarray(data[z0 * binning:z1 * binning, :outShape[1] * binning, :outShape[2] * binning],
+                                  dtype=data.dtype if labels else np.float32)
+                blocks = slab.reshape(z1 - z0, binning, outShape[1], binning, outShape[2], binning)
+                outData[z0:z1] = blocks.max(axis=(1, 3, 5)) if labels else blocks.mean(axis=(1, 3, 5))
+            outMrc.voxel_size = tuple(binning * float(inMrc.voxel_size[ax]) for ax in 'xyz')
+            outMrc.update_header_stats()
+
+
+def getResizeScales(inShape, outShape, scale=None) -> list:
+    """Scale of each axis: the given one (a number for all the axes or one per axis) or outDim / inDim."""
+    if scale is None:
+        return [outDim / inDim for outDim, inDim in zip(outShape, inShape)]
+    return list(scale) if np.iterable(scale) else [scale] * len(outShape)
+
+
+def getResizeCoords(inDim: int, outDim: int, scale: float = None) -> np.ndarray:
+    """Input coordinate of the center of each output voxel when an axis is resized by the given scale (outDim /
+    inDim by default). The voxel centers are aligned as in binVolume, so a binned volume upsampled with the
+    binning factor as scale is registered with the unbinned one. The coordinates out of the input (e.g. of the
+    voxels cropped by the binning) are clamped, so they take the values of the border."""
+    scale = scale or outDim / inDim
+    return np.clip((np.arange(outDim) + 0.5) / scale - 0.5, 0, inDim - 1)
+
+
+def getNearestIndices(inDim: int, outDim: int, scale: float = None) -> np.ndarray:
+    """Input index taken by each output index when an axis is resized with nearest neighbour interpolation."""
+    return np.floor(getResizeCoords(inDim, outDim, scale) + 0.5).astype(np.int64)
+
+
+def _resizeAxis(data: np.ndarray, axis: int, coords: np.ndarray, order: int) -> np.ndarray:
+    """Interpolate the data along an axis at the given coordinates, with nearest neighbour (order 0) or linear
+    (order 1) interpolation."""
+    if order == 0:
+        return np.take(data, np.floor(coords + 0.5).astype(np.int64), axis=axis)
+    i0 = np.floor(coords).astype(np.int64)
+    i1 = np.minimum(i0 + 1, data.shape[axis] - 1)
+    weightsShape = [1] * data.ndim
+    weightsShape[axis] = -1
+    weights = (coords - i0).astype(np.float32).reshape(weightsShape)
+    return np.take(data, i0, axis=axis) * (1 - weights) + np.take(data, i1, axis=axis) * weights
+
+
+def _checkResizeOrder(order: int):
+    if order not in (0, 1):
+        raise ValueError(f'Only nearest neighbour (0) and linear (1) interpolation are supported, not order {order}')
+
+
+def resizeVolume(data: np.ndarray, outShape, order: int = 0, scale=None) -> np.ndarray:
+    """Resize a volume to the given shape (same axes order as the data), one axis after the other, with nearest
+    neighbour (order 0, which keeps the values of label volumes) or linear (order 1) interpolation. By default, the
+    volume is scaled to fill the output shape. See getResizeCoords for the given scale."""
+    _checkResizeOrder(order)
+    scales = getResizeScales(data.shape, outShape, scale)
+    resized = data if order == 0 else np.asarray(data, dtype=np.float32)
+    for axis, (inDim, outDim, axisScale) in enumerate(zip(data.shape, outShape, scales)):
+        resized = _resizeAxis(resized, axis, getResizeCoords(inDim, outDim, axisScale), order)
+    return resized
+
+
+def resizeFile(inFileName: str, outFileName: str, outShape, order: int = 0, scale=None, voxelSize: float = None,
+               slabSize: int = SLAB_SIZE):
+    """Resize an MRC file as resizeVolume, computing the output by Z slabs from the slices of the memory-mapped
+    input they need, so the volumes are not loaded into memory. If not provided, the voxel size is scaled
+    according to the scale along X. The output file can be the input one."""
+    _checkResizeOrder(order)
+    tmpFileName = outFileName + '.tmp'
+    with mrcfile.mmap(inFileName, mode='r', permissive=True) as inMrc:
+        data = inMrc.data
+        scales = getResizeScales(data.shape, outShape, scale)
+        zCoords, yCoords, xCoords = [getResizeCoords(inDim, outDim, axisScale)
+                                     for inDim, outDim, axisScale in zip(data.shape, outShape, scales)]
+        if not voxelSize and float(inMrc.voxel_size.x):
+            voxelSize = float(inMrc.voxel_size.x) / scales[-1]
+        mrcMode = mrcfile.utils.mode_from_dtype(data.dtype) if order == 0 else 2
+        with mrcfile.new_mmap(tmpFileName, tuple(outShape), mrc_mode=mrcMode, overwrite=True) as outMrc:
+            for z0 in range(0, outShape[0], slabSize):
+                coords = zCoords[z0:z0 + slabSize]
+                first = int(np.floor(coords[0]))
+                last = min(int(np.floor(coords[-1])) + 2, data.shape[0])
+                slab = np.asarray(data[first:last], dtype=data.dtype if order == 0 else np.float32)
+                slab = _resizeAxis(slab, 0, coords - first, order)
+                slab = _resizeAxis(slab, 1, yCoords, order)
+                outMrc.data[z0:z0 + len(coords)] = _resizeAxis(slab, 2, xCoords, order)
+            if voxelSize:
+                outMrc.voxel_size = voxelSize
+            outMrc.update_header_stats()
+    os.replace(tmpFileName, outFileName)
+
+
+@contextmanager
+def fileLock(fileName: str):
+    """Exclusive lock of a file shared by several processes (e.g. protocols running at the same time), held on
+    an auxiliary file fileName.lock, so the file can still be replaced atomically while locked."""
+    os.makedirs(dirname(fileName) or '.', exist_ok=True)
+    with open(fileName + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -23,29 +23,74 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from pyworkflow.gui.dialog import ToolbarListDialog
+import threading
+from os.path import exists
+
+from pyworkflow.gui.dialog import ToolbarListDialog, ToolbarButton
+from pyworkflow.utils import Icon
 from tomoviz.viewers.viewer_mrc import MrcPlot
 from tomoviz.viewers.viewer_triangulations import guiThread
+from tomosegmemtv.viewers_interactive.paged_tree import PagedDialogMixin
+from tomosegmemtv.previews import getPyramidDir, getPyramidLevels, buildPyramid, getLevelFile, PYRAMID_BINNINGS
 
 
-class AnnotatedVesicleViewerDialog(ToolbarListDialog):
+class AnnotatedVesicleViewerDialog(PagedDialogMixin, ToolbarListDialog):
     """
     This class allows to  call a MembraneAnnotator subprocess from a list of Tomograms.
+    The annotations are opened at the coarsest level of their preview pyramid, so they are shown at once, and the
+    finer levels are opened on request.
     """
 
     def __init__(self, parent, **kwargs):
         self.provider = kwargs.get("provider", None)
+        self._opened = None  # Last tomo mask opened and its binning
+        toolbarButtons = [ToolbarButton('Finer resolution', self.openFinerLevel, Icon.ACTION_ZOOM,
+                                        tooltip='Open the last annotation at the next finer resolution')]
+        toolbarButtons += self.getPagingButtons()
         ToolbarListDialog.__init__(self, parent,
                                    "Annotated Vesicle Object Manager",
                                    allowsEmptySelection=False,
                                    itemDoubleClick=self.launchAnnotationViewer,
                                    allowSelect=False,
+                                   toolbarButtons=toolbarButtons,
                                    **kwargs)
 
     @staticmethod
-    def launchAnnotationViewer(tomoMask):
-        print("\n==> Running Annotated Vesicle Viewer:")
+    def _getLevels(tomoMask):
+        """Binning factors available for both the annotation and its tomogram, from the coarsest one."""
+        materialsName = tomoMask.getFileName()
+        tomoName = tomoMask.getVolName()
+        cacheDir = getPyramidDir(materialsName)
+        levels = set(getPyramidLevels(materialsName, cacheDir))
+        if exists(tomoName):
+            levels &= set(getPyramidLevels(tomoName, cacheDir))
+        return sorted(levels, reverse=True)
+
+    def launchAnnotationViewer(self, tomoMask):
+        threading.Thread(target=self._openLevel, args=(tomoMask, None), daemon=True).start()
+
+    def openFinerLevel(self, e=None):
+        if self._opened is not None:
+            tomoMask, binning = self._opened
+            finerBinnings = [b for b in [1] + PYRAMID_BINNINGS if b < binning]
+            if finerBinnings:
+                threading.Thread(target=self._openLevel, args=(tomoMask, max(finerBinnings)), daemon=True).start()
+
+    def _openLevel(self, tomoMask, binning=None):
+        """Open the annotation at the given binning, the coarsest one available if None. The missing levels are
+        computed first, when the coarsest one is requested only that one."""
         materialsName = tomoMask.getFileName()
         tomoName = tomoMask.getVolName()
-        args = {'tomo_mrc': tomoName, 'mask_mrc': materialsName}
+        cacheDir = getPyramidDir(materialsName)
+        levels = self._getLevels(tomoMask)
+        if binning is None:
+            binning = levels[0] if len(levels) > 1 else max(PYRAMID_BINNINGS)
+        if binning not in levels:
+            buildPyramid(materialsName, cacheDir, binnings=[binning], labels=True)
+            if exists(tomoName):
+                buildPyramid(tomoName, cacheDir, binnings=[binning])
+        self._opened = (tomoMask, binning)
+        print("\n==> Running Annotated Vesicle Viewer (binning %i):" % binning)
+        args = {'tomo_mrc': getLevelFile(tomoName, binning, cacheDir) if exists(tomoName) else tomoName,
+                'mask_mrc': getLevelFile(materialsName, binning, cacheDir)}
         guiThread(MrcPlot, 'initializePlot', **args)
@@ -24,15 +24,19 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
-from os.path import join, isfile
-
 from pyworkflow.utils import removeBaseExt
 from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
+from tomosegmemtv.viewers_interactive.paged_tree import PagedTreeProvider, PAGE_SIZE
+
 
+class MembAnnotatorResultsProvider(PagedTreeProvider, TomogramsTreeProvider):
 
-class MembAnnotatorResultsProvider(TomogramsTreeProvider):
+    def __init__(self, tomoList, path, mode, pageSize=PAGE_SIZE):
+        """ The tomo masks (a list or a PagedSet) are shown in pages of pageSize rows. """
+        super().__init__(tomoList, path, mode)
+        self._initPaging(tomoList, pageSize)
 
-    def getObjectInfo(self, inTomo):
+    def _getObjectInfo(self, inTomo):
         tomogramName = removeBaseExt(inTomo.getVolName()) + "_materials.mrc"
 
         return {'key': tomogramName, 'parent': None}
@@ -28,8 +28,6 @@ import pyworkflow.viewer as pwviewer
 import pwem.viewers.views as vi
 from tomo.objects import SetOfTomoMasks
 from tomosegmemtv.protocols import ProtAnnotateMembranes
-from tomosegmemtv.viewers.annotation_results_viewer import AnnotatedVesicleViewerDialog
-from tomosegmemtv.viewers.memb_annotator_results_tree import MembAnnotatorResultsProvider
 
 
 class TomoViz4TomoSegMemDataViewer(pwviewer.Viewer):
@@ -48,13 +46,14 @@ class TomoViz4TomoSegMemDataViewer(pwviewer.Viewer):
             self._project, obj.strId(), fn, viewParams=viewParams)
 
     def _visualize(self, obj, **kwargs):
+        from tomosegmemtv.viewers.annotation_results_viewer import AnnotatedVesicleViewerDialog
+        from tomosegmemtv.viewers.memb_annotator_results_tree import MembAnnotatorResultsProvider
+        from tomosegmemtv.viewers_interactive.paged_tree import PagedSet
         views = []
         cls = type(obj)
 
-        tomoMaskList = []
-        for name, output in obj.iterOutputAttributes(outputClass=SetOfTomoMasks):
-            for tomoMask in output.iterItems():
-                tomoMaskList.append(tomoMask.clone())
+        # The tomo masks are read in pages when they are shown
+        tomoMaskList = PagedSet(*[output for name, output in obj.iterOutputAttributes(outputClass=SetOfTomoMasks)])
 
         vesicleProvider = MembAnnotatorResultsProvider(tomoMaskList, None, None)
 
@@ -24,15 +24,17 @@
 # *
 # **************************************************************************
 
+import queue
 import threading
 from os import symlink
 from os.path import abspath, basename, join, exists
 from pyworkflow.gui.dialog import ToolbarListDialog
 from pyworkflow.utils.path import getParentFolder, removeBaseExt
 from tomosegmemtv import Plugin
+from tomosegmemtv.viewers_interactive.paged_tree import PagedDialogMixin
 
 
-class MembAnnotatorDialog(ToolbarListDialog):
+class MembAnnotatorDialog(PagedDialogMixin, ToolbarListDialog):
     """
     This class allows to  call a MembraneAnnotator subprocess from a list of Tomograms.
     """
@@ -44,18 +46,37 @@ class MembAnnotatorDialog(ToolbarListDialog):
         self.path = path
         self.provider = kwargs.get("provider", None)
         self.prot = kwargs.get('prot', None)
+        # Tomograms annotated, notified by the status index from its watcher thread. Tk is not thread safe, so
+        # they are queued and the tree items are updated from the GUI loop
+        self.annotated = queue.Queue()
+        statusIndex = getattr(self.provider, 'statusIndex', None)
+        if statusIndex is not None:
+            statusIndex.addListener(self.annotated.put)
         ToolbarListDialog.__init__(self, parent,
                                    "Membrane Annotator Object Manager",
                                    allowsEmptySelection=False,
                                    itemDoubleClick=self.doubleClickOnTomogram,
                                    allowSelect=False,
+                                   toolbarButtons=self.getPagingButtons(),
                                    **kwargs)
 
-    def refresh_gui(self):
+    def refresh_gui(self, lastCheck=False):
+        if getattr(self.provider, 'statusIndex', None) is None:
+            if self.proc.is_alive():
+                self.after(1000, self.refresh_gui)
+            else:
+                self.tree.update()
+            return
+        # Only the items of the tomograms annotated are updated
+        while not self.annotated.empty():
+            tsId = self.annotated.get()
+            if self.tree.exists(tsId):
+                self.tree.item(tsId, values=("DONE",), tags=("done",))
         if self.proc.is_alive():
             self.after(1000, self.refresh_gui)
-        else:
-            self.tree.update()
+        elif not lastCheck:
+            # The events of the files written when the annotator exits may arrive a bit later
+            self.after(1000, self.refresh_gui, True)
 
     def doubleClickOnTomogram(self, e=None):
         self.tomo = e
@@ -68,9 +89,9 @@ class MembAnnotatorDialog(ToolbarListDialog):
         # different protocols. MembraneAnnotator expects both to be in the same location, so a symbolic link is
         # is generated in the extra dir of the segmentation protocol pointing to the selected tomogram
         print("\n==> Running Membrane Annotator:")
-        tomoName =  abspath(self.prot.getfltFile(tomoMask, '.mrc'))
-
         tsId = tomoMask.getTsId()
+        self.prot.notifyAnnotationStart(tsId)
+        tomoName = abspath(self.prot.getAnnotatorTomoFile(tomoMask))
         arguments = "inTomoFile '%s' " % tomoName
         arguments += "outFilename '%s'" % abspath(self.prot._getExtraPath(tsId, tsId))
-        Plugin.runMembraneAnnotator(self.prot, arguments, env=Plugin.getMembSegEnviron(), cwd=self.path)
+        Plugin.annotateTomogram(self.prot, arguments, cwd=self.path)
@@ -24,20 +24,34 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
-from os.path import join, isfile
+from os.path import isfile
 
-from pyworkflow.utils import removeBaseExt
 from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
+from tomosegmemtv.annotation import getMaterialsFile
+from tomosegmemtv.viewers_interactive.paged_tree import PagedTreeProvider, PAGE_SIZE
 
 
-class MembAnnotatorProvider(TomogramsTreeProvider):
+class MembAnnotatorProvider(PagedTreeProvider, TomogramsTreeProvider):
 
-    def getObjectInfo(self, inTomo):
+    def __init__(self, tomoList, path, mode, statusIndex=None, pageSize=PAGE_SIZE):
+        """ If an AnnotationStatusIndex is provided, the status of each tomo mask is taken from it instead of
+        checking its materials file. The tomo masks are shown in pages of pageSize rows. """
+        super().__init__(tomoList, path, mode)
+        self._initPaging(tomoList, pageSize)
+        self.statusIndex = statusIndex
+        if statusIndex is not None:
+            statusIndex.addListener(self.invalidate)
+
+    def isDone(self, tsId):
+        if self.statusIndex is None:
+            return isfile(getMaterialsFile(self._path, tsId))
+        return self.statusIndex.isDone(tsId)
+
+    def _getObjectInfo(self, inTomo):
 
         tsId = inTomo.getTsId()
-        filePath = join(self._path, tsId, tsId + "_materials.mrc")
 
-        if not isfile(filePath):
+        if not self.isDone(tsId):
             return {'key': tsId, 'parent': None,
                     'text': tsId, 'values': "PENDING",
                     'tags': "pending"}
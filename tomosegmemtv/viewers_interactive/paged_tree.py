@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * your institution
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'you@yourinstitution.email'
+# *
+# **************************************************************************
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+PAGE_SIZE = 200  # Rows shown at once in the trees
+MAX_CACHED_PAGES = 8
+
+
+class PagedSet:
+    """Read-only sequence over the items of one or more pyworkflow sets. The items are read (and cloned) in pages
+    on demand, with a limited number of pages kept in memory, so the sets are not loaded at once."""
+
+    def __init__(self, *sets, pageSize=PAGE_SIZE, maxCachedPages=MAX_CACHED_PAGES):
+        self._sets = sets
+        self._sizes = [setObj.getSize() for setObj in sets]
+        self.pageSize = pageSize
+        self.maxCachedPages = maxCachedPages
+        self._pages = OrderedDict()  # Least recently used first
+
+    def __len__(self):
+        return sum(self._sizes)
+
+    def getNumberOfPages(self) -> int:
+        return max(1, -(-len(self) // self.pageSize))
+
+    def getPage(self, page: int) -> list:
+        if page in self._pages:
+            self._pages.move_to_end(page)
+            return self._pages[page]
+        items = []
+        start, end = page * self.pageSize, min((page + 1) * self.pageSize, len(self))
+        offset = 0
+        # The page may span the end of a set and the beginning of the next one
+        for setObj, size in zip(self._sets, self._sizes):
+            if start < offset + size and end > offset:
+                first = max(start, offset) - offset
+                count = min(end, offset + size) - offset - first
+                items += [item.clone() for item in setObj.iterItems(limit=(count, first))]
+            offset += size
+        self._pages[page] = items
+        if len(self._pages) > self.maxCachedPages:
+            self._pages.popitem(last=False)
+        return items
+
+    def __getitem__(self, index: int):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('PagedSet index out of range')
+        return self.getPage(index // self.pageSize)[index % self.pageSize]
+
+    def __iter__(self):
+        for page in range(self.getNumberOfPages()):
+            yield from self.getPage(page)
+
+
+class PagedTreeProvider(ABC):
+    """Mixin of the tree providers that show their objects (a list or a PagedSet of tomograms or tomo masks) one
+    page at a time, caching the info of each row by tsId. It must be placed before the TreeProvider class in the
+    bases."""
+
+    def _initPaging(self, objects, pageSize: int = PAGE_SIZE):
+        self._pagedObjects = objects
+        self.pageSize = pageSize
+        self._page = 0
+        self._rowsInfo = {}
+
+    def _getObjectList(self):
+        start = self._page * self.pageSize
+        if isinstance(self._pagedObjects, PagedSet) and self._pagedObjects.pageSize == self.pageSize:
+            return self._pagedObjects.getPage(self._page)
+        return [self._pagedObjects[i] for i in range(start, min(start + self.pageSize, len(self._pagedObjects)))]
+
+    def getObjects(self):
+        return self._getObjectList()
+
+    def getNumberOfPages(self) -> int:
+        return max(1, -(-len(self._pagedObjects) // self.pageSize))
+
+    def getPage(self) -> int:
+        return self._page
+
+    def setPage(self, page: int) -> bool:
+        """Change the page shown, returning True if it has changed, so the tree has to be updated."""
+        page = min(max(page, 0), self.getNumberOfPages() - 1)
+        changed = page != self._page
+        self._page = page
+        return changed
+
+    def getObjectInfo(self, obj):
+        key = obj.getTsId()
+        if key not in self._rowsInfo:
+            self._rowsInfo[key] = self._getObjectInfo(obj)
+        return self._rowsInfo[key]
+
+    @abstractmethod
+    def _getObjectInfo(self, obj):
+        """Info of a row, computed once (see invalidate)."""
+
+    def invalidate(self, tsId: str = None):
+        """Compute again the info of the row of the given tsId, or of all of them."""
+        if tsId is None:
+            self._rowsInfo.clear()
+        else:
+            self._rowsInfo.pop(tsId, None)
+
+
+class PagedDialogMixin:
+    """Page navigation of the ToolbarListDialogs with a PagedTreeProvider (self.provider and self.tree)."""
+
+    def getPagingButtons(self) -> list:
+        if self.provider is None or self.provider.getNumberOfPages() < 2:
+            return []
+        from pyworkflow.gui.dialog import ToolbarButton
+        from pyworkflow.utils import Icon
+        return [ToolbarButton('Previous page', self.previousPage, Icon.ACTION_FIND_PREVIOUS,
+                              tooltip='Show the previous %i rows' % self.provider.pageSize),
+                ToolbarButton('Next page', self.nextPage, Icon.ACTION_FIND_NEXT,
+                              tooltip='Show the next %i rows' % self.provider.pageSize)]
+
+    def _showPage(self, page):
+        if self.provider.setPage(page):
+            self.tree.update()
+
+    def previousPage(self, e=None):
+        self._showPage(self.provider.getPage() - 1)
+
+    def nextPage(self, e=None):
+        self._showPage(self.provider.getPage() + 1)